@@ -0,0 +1,246 @@
+# admission.py
+"""
+Adaptive concurrency limit (load shedding) for database lookups.
+
+Each worker admits at most `limit` lookups to the database at once; the
+rest wait in a priority queue for at most ADMISSION_QUEUE_TIMEOUT_MS, and
+are shed with Overloaded (503 + Retry-After) when the queue is full or the
+wait runs out. Shedding early keeps the requests that are admitted fast,
+instead of every request queueing for a pool connection until all of them
+time out.
+
+The limit follows AIMD on observed latency. Completions are grouped into
+windows of about `limit` samples (at least ADMISSION_WINDOW_MIN, at most
+one second):
+ - congestion (a failed lookup, or a window average above
+   ADMISSION_TOLERANCE x the baseline) multiplies the limit by
+   ADMISSION_BACKOFF
+ - otherwise, if the window used at least half the limit, it grows by one
+The baseline is the lowest window average of the last ADMISSION_BASELINE_S
+seconds, so it follows the dataset and the hardware without a fixed target.
+
+Priority: lower numbers are served first and, when the queue is full,
+displace the lowest-priority waiter instead of being shed (auth.py maps the
+keys.json "tier" to a priority).
+
+Cost: bulk lookups (/check/batch, /check/binary, /range) hold `cost`
+units of the limit instead of one, about one per ADMISSION_COST_KEYS
+hashes (see cost_for) or ADMISSION_RANGE_COST per range scan (a few
+hundred adjacent rows), capped at the current limit so any request can
+still run alone. Their latency is not comparable with single lookups, so
+only failures feed the AIMD signal.
+"""
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import request_timing
+from metrics import Counter, register_collector
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_INITIAL_LIMIT = int(os.getenv("ADMISSION_INITIAL_LIMIT", "32"))
+ADMISSION_MIN_LIMIT = int(os.getenv("ADMISSION_MIN_LIMIT", "2"))
+ADMISSION_MAX_LIMIT = int(os.getenv("ADMISSION_MAX_LIMIT", "512"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))               # waiters per worker
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "100"))
+ADMISSION_TOLERANCE = float(os.getenv("ADMISSION_TOLERANCE", "2.0"))
+ADMISSION_BACKOFF = float(os.getenv("ADMISSION_BACKOFF", "0.9"))
+ADMISSION_BASELINE_S = int(os.getenv("ADMISSION_BASELINE_S", "60"))              # seconds
+ADMISSION_WINDOW_MIN = int(os.getenv("ADMISSION_WINDOW_MIN", "10"))              # samples
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))             # seconds
+ADMISSION_COST_KEYS = int(os.getenv("ADMISSION_COST_KEYS", "100"))               # hashes per unit
+ADMISSION_RANGE_COST = int(os.getenv("ADMISSION_RANGE_COST", "4"))              # units per /range scan
+
+ADMISSIONS = Counter("pwned_admission_total",
+                     "Lookups admitted (immediately or after queueing) or shed, by priority",
+                     ("result", "priority"))
+
+class Overloaded(Exception):
+    """The lookup was shed; answer 503 with Retry-After."""
+
+    def __init__(self, reason: str, retry_after: int = ADMISSION_RETRY_AFTER):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+def cost_for(keys: int) -> int:
+    """Admission units for one bulk database call over `keys` hashes."""
+    return max(1, -(-keys // max(1, ADMISSION_COST_KEYS)))
+
+class AdaptiveLimiter:
+    """Per-worker, event-loop only (no locks)."""
+
+    def __init__(self, initial: int = ADMISSION_INITIAL_LIMIT, min_limit: int = ADMISSION_MIN_LIMIT,
+                 max_limit: int = ADMISSION_MAX_LIMIT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout_ms: float = ADMISSION_QUEUE_TIMEOUT_MS):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout_ms / 1000.0
+        self.in_flight = 0
+        self._queue: List[Tuple[int, int, asyncio.Future, int]] = []  # (priority, seq, future, cost)
+        self._seq = itertools.count()
+        # current window
+        self._started = time.monotonic()
+        self._samples = 0
+        self._latency_sum = 0.0
+        self._dropped = 0
+        self._peak = 0
+        self._baselines: deque = deque(maxlen=max(1, ADMISSION_BASELINE_S))  # [second, lowest average]
+        self.shed = 0
+        self.decreases = 0
+
+    # -------- admission --------
+    def _queued(self) -> int:
+        return sum(1 for _, _, fut, _ in self._queue if not fut.done())
+
+    def _fits(self, cost: int) -> bool:
+        return self.in_flight + cost <= int(self.limit)
+
+    async def acquire(self, priority: int = 1, cost: int = 1) -> int:
+        """Wait for `cost` units; returns the units actually held, for release()."""
+        cost = max(1, min(cost, int(self.limit)))
+        # waiters exist only while the limit is reached (or the best one does not
+        # fit yet): release() admits them first
+        if self._fits(cost):
+            self._admit(cost)
+            ADMISSIONS.inc("admitted", str(priority))
+            return cost
+        if self._queued() >= self.max_queue and not self._displace(priority):
+            self._shed("shed_queue_full", priority)
+        if len(self._queue) > 2 * self.max_queue:
+            self._queue = [entry for entry in self._queue if not entry[2].done()]
+            heapq.heapify(self._queue)
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), fut, cost))
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._granted(fut):
+                self.release(None, cost=fut.result())  # granted just as the deadline passed
+            fut.cancel()
+            self._shed("shed_timeout", priority)
+        except Overloaded:
+            self._shed("shed_displaced", priority)
+        except asyncio.CancelledError:
+            if self._granted(fut):
+                self.release(None, cost=fut.result())
+            fut.cancel()
+            raise
+        ADMISSIONS.inc("queued", str(priority))
+        return fut.result()
+
+    @staticmethod
+    def _granted(fut: asyncio.Future) -> bool:
+        return fut.done() and not fut.cancelled() and fut.exception() is None
+
+    def _displace(self, priority: int) -> bool:
+        """Full queue: shed the newest waiter of the lowest priority below `priority`."""
+        waiting = [entry for entry in self._queue if not entry[2].done()]
+        worst = max(waiting, key=lambda e: (e[0], e[1]), default=None)
+        if worst is None or worst[0] <= priority:
+            return False
+        worst[2].set_exception(Overloaded("displaced by a higher-priority request"))
+        return True
+
+    def _shed(self, result: str, priority: int):
+        self.shed += 1
+        ADMISSIONS.inc(result, str(priority))
+        raise Overloaded("too many lookups in flight")
+
+    def _admit(self, cost: int = 1):
+        self.in_flight += cost
+        if self.in_flight > self._peak:
+            self._peak = self.in_flight
+
+    def release(self, latency: Optional[float] = None, dropped: bool = False, cost: int = 1):
+        """A lookup finished (latency in seconds; None when it never ran)."""
+        self.in_flight -= cost
+        if latency is not None:
+            self._record(latency, dropped)
+        while self._queue:
+            _, _, fut, waiting_cost = self._queue[0]
+            if fut.done():
+                heapq.heappop(self._queue)
+                continue
+            # the best waiter goes first even if smaller ones behind it would fit
+            waiting_cost = min(waiting_cost, max(1, int(self.limit)))
+            if not self._fits(waiting_cost):
+                break
+            heapq.heappop(self._queue)
+            self._admit(waiting_cost)
+            fut.set_result(waiting_cost)
+
+    # -------- limit --------
+    def _record(self, latency: float, dropped: bool):
+        self._samples += 1
+        self._latency_sum += latency
+        self._dropped += dropped
+        now = time.monotonic()
+        if self._samples < max(ADMISSION_WINDOW_MIN, int(self.limit)) and now - self._started < 1.0:
+            return
+        average = self._latency_sum / self._samples
+        baseline = min((low for _, low in self._baselines), default=average)
+        second = int(now)
+        if self._baselines and self._baselines[-1][0] == second:
+            self._baselines[-1][1] = min(self._baselines[-1][1], average)
+        else:
+            self._baselines.append([second, average])
+        if self._dropped or average > ADMISSION_TOLERANCE * baseline:
+            self.limit = max(self.min_limit, self.limit * ADMISSION_BACKOFF)
+            self.decreases += 1
+        elif self._peak * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+        self._started, self._samples, self._latency_sum, self._dropped = now, 0, 0.0, 0
+        self._peak = self.in_flight
+
+    @asynccontextmanager
+    async def slot(self, priority: int = 1, cost: int = 1):
+        """Hold `cost` units for the block; failures in it count as congestion."""
+        with request_timing.phase("admission"):
+            held = await self.acquire(priority, cost)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.release(time.perf_counter() - started, dropped=True, cost=held)
+            raise
+        except BaseException:
+            self.release(None, cost=held)  # cancelled: says nothing about the database
+            raise
+        else:
+            # a bulk call's latency would skew the single-lookup baseline
+            self.release(time.perf_counter() - started if cost == 1 else None, cost=held)
+
+    def stats(self) -> Dict:
+        return {
+            "limit": int(self.limit),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": self._queued(),
+            "max_queue": self.max_queue,
+            "queue_timeout_ms": self.queue_timeout * 1000,
+            "baseline_ms": (round(min(low for _, low in self._baselines) * 1000, 3)
+                            if self._baselines else None),
+            "shed": self.shed,
+            "decreases": self.decreases,
+        }
+
+def _metrics_samples():
+    if limiter is None:
+        return []
+    stats = limiter.stats()
+    return [("pwned_admission_limit", "gauge", "Current adaptive concurrency limit", (), (), stats["limit"]),
+            ("pwned_admission_in_flight", "gauge", "Admitted lookups in flight", (), (), stats["in_flight"]),
+            ("pwned_admission_queued", "gauge", "Lookups waiting for admission", (), (), stats["queued"])]
+
+register_collector(_metrics_samples)
+
+limiter = AdaptiveLimiter() if ADMISSION_ENABLED else None
@@ -1,23 +1,29 @@
 # auth.py
 from __future__ import annotations
+import hashlib
 import json
-import time
-import threading
 from pathlib import Path
 from typing import Dict
 from fastapi import Header, HTTPException
 
+import request_timing
+from metrics import AUTH_REQUESTS
+from ratelimit import ALLOWED, DENIED, RATE_LIMIT_WINDOW, TOO_LARGE, limiter
+
 KEYS_PATH = Path("keys.json")
+# keys.json "tier": who keeps being served when lookups are shed (admission.py)
+TIER_PRIORITY = {"high": 0, "normal": 1, "low": 2}
 
-_lock = threading.Lock()
 _api_keys: Dict[str, Dict] = {}
-_rate_buckets: Dict[str, Dict[int, int]] = {}  # key -> {window:int -> count:int}
-RATE_LIMIT_WINDOW = 60  # seconds
+_key_labels: Dict[str, str] = {}
 
 def load_api_keys() -> Dict[str, Dict]:
     """
     Loads keys.json into _api_keys. Keys file format:
-    { "bankdev123": { "limit": 1000 }, "anotherkey": { "limit": 100 } }
+    { "bankdev123": { "limit": 1000, "burst": 200 }, "anotherkey": { "limit": 100 } }
+    limit is per RATE_LIMIT_WINDOW (a minute); burst defaults to limit.
+    An optional "name" labels the key in /metrics, and "tier" (high, normal,
+    low; default normal) orders its lookups under load.
     """
     global _api_keys
     if KEYS_PATH.exists():
@@ -29,8 +35,23 @@ def load_api_keys() -> Dict[str, Dict]:
         # create sample file
         KEYS_PATH.write_text(json.dumps({"bankdev123": {"limit": 1000}}, indent=2))
         _api_keys = json.loads(KEYS_PATH.read_text())
+    _key_labels.clear()
     return _api_keys
 
+def key_label(key: str) -> str:
+    """Metrics label for a known key: its "name", or a short fingerprint (never the key itself)."""
+    label = _key_labels.get(key)
+    if label is None:
+        entry = _api_keys.get(key, {})
+        name = entry.get("name") or entry.get("label")  # "label": older manage_api_keys.py
+        if not name:
+            name = "key-" + hashlib.sha256(key.encode()).hexdigest()[:8]
+        label = _key_labels[key] = str(name)
+    return label
+
+def key_priority(key: str) -> int:
+    return TIER_PRIORITY.get(_api_keys.get(key, {}).get("tier", "normal"), TIER_PRIORITY["normal"])
+
 def api_key_ok(key: str) -> bool:
     return key in _api_keys
 
@@ -40,46 +61,58 @@ def get_limit_for(key: str) -> int:
     except Exception:
         return 60
 
-def check_rate_limit(key: str) -> bool:
+def get_burst_for(key: str) -> int:
+    """The most units one request of this key may cost (larger ones get TOO_LARGE, never ALLOWED)."""
+    try:
+        return int(_api_keys.get(key, {}).get("burst", get_limit_for(key)))
+    except Exception:
+        return get_limit_for(key)
+
+def check_rate_limit(key: str, cost: int = 1) -> str:
     """
-    Fixed-window per-minute rate limiting.
-    Returns True if allowed, False if limit exceeded.
+    Token-bucket (GCRA) rate limiting, shared by all workers on the host.
+    `cost` is the number of units charged (1 per request, or the number of
+    hashes for batch lookups).
+    Returns ALLOWED, DENIED if the limit is exceeded, or TOO_LARGE if cost
+    is above the key's burst.
     """
     limit = get_limit_for(key)
     if limit <= 0:
-        return False  # disabled key
-
-    now = int(time.time())
-    window = now - (now % RATE_LIMIT_WINDOW)  # window start epoch
+        return DENIED  # disabled key
+    return limiter.acquire(key, limit, get_burst_for(key), cost)
 
-    with _lock:
-        buckets = _rate_buckets.setdefault(key, {})
-        count = buckets.get(window, 0)
-        if count + 1 > limit:
-            # keep state (do not advance window)
-            buckets[window] = count
-            return False
-        buckets[window] = count + 1
-
-        # prune old windows to keep memory small
-        if len(buckets) > 5:
-            keys_to_remove = [w for w in list(buckets.keys()) if w < window]
-            for w in keys_to_remove:
-                buckets.pop(w, None)
-
-    return True
-
-def verify_api_key(x_api_key: str = Header(...)):
+def authenticate_api_key(x_api_key: str = Header(...)) -> str:
     """
-    FastAPI dependency. Raises HTTPException on invalid key / rate limit.
+    FastAPI dependency for endpoints that charge their own quota.
+    Raises HTTPException on invalid key, returns the key.
     """
     if not _api_keys:
         load_api_keys()
 
-    if not x_api_key or not api_key_ok(x_api_key):
+    with request_timing.phase("auth"):
+        ok = bool(x_api_key) and api_key_ok(x_api_key)
+    if not ok:
+        # unknown keys share one label: they are unbounded and may be typos of real ones
+        AUTH_REQUESTS.inc("invalid", "invalid")
         raise HTTPException(status_code=401, detail="Invalid or missing API key")
 
-    if not check_rate_limit(x_api_key):
+    return x_api_key
+
+def enforce_rate_limit(key: str, cost: int = 1):
+    with request_timing.phase("rate_limit"):
+        result = check_rate_limit(key, cost)
+    AUTH_REQUESTS.inc(key_label(key), result)
+    if result == TOO_LARGE:
+        # more units than the bucket holds can never pass: 429 would be retried forever
+        raise HTTPException(status_code=413,
+                            detail=f"at most {max(get_burst_for(key), 1)} hashes per request for this key")
+    if result != ALLOWED:
         raise HTTPException(status_code=429, detail="Rate limit exceeded")
 
-    return True
+def verify_api_key(x_api_key: str = Header(...)) -> str:
+    """
+    FastAPI dependency. Raises HTTPException on invalid key / rate limit,
+    returns the key.
+    """
+    enforce_rate_limit(authenticate_api_key(x_api_key))
+    return x_api_key
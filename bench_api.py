@@ -0,0 +1,367 @@
+# bench_api.py
+"""
+Load generator and latency benchmark for the API (main.py).
+
+Usage:
+    python3 bench_api.py --backend mmap --rows 1000000 --concurrency 64 --duration 30
+    python3 bench_api.py --backend postgres --db-name pwned_bench --rows 5000000
+    python3 bench_api.py --url http://127.0.0.1:8000 --api-key bankdev123   (existing server)
+
+Unless --url is given it:
+ - seeds a synthetic dataset: password i is "benchpw<i>", stored with a
+   count, as an mmap store file (LOOKUP_BACKEND=mmap stand-in) or as the
+   `hashes` table of a dedicated Postgres database (--db-name; never the
+   production one unless asked to)
+ - starts uvicorn main:app in a scratch directory with its own keys.json
+   (an unlimited bench key) and rate-limit state
+ - drives /check/{sha1}, /check_password/{password} and /healthz with
+   --concurrency keep-alive connections for --duration seconds after a
+   --warmup, picking hit keys with Zipf(--zipf) popularity and misses with
+   probability 1 - --hit-ratio
+
+Results (requests/s, p50/p95/p99/p999 latency per endpoint, status codes)
+are printed and written as JSON (--output) together with the git commit,
+so runs can be compared across commits.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import bisect
+import hashlib
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_KEY = "bench-key"
+ENDPOINTS = ("check", "password", "healthz")
+PERCENTILES = (50, 95, 99, 99.9)
+SEED_BATCH = 1_000_000
+
+def bench_password(i: int) -> str:
+    return f"benchpw{i}"
+
+def bench_count(i: int) -> int:
+    return (i * 7919) % 100_000 + 1
+
+def bench_digest(i: int) -> bytes:
+    return hashlib.sha1(bench_password(i).encode()).digest()
+
+# =========================
+# SEEDING
+# =========================
+def seed_store(rows: int, path: str) -> str:
+    from mmap_store import RECORD, write_store
+    digests = sorted((bench_digest(i), i) for i in range(rows))
+    write_store((RECORD.pack(d, bench_count(i)) for d, i in digests), path)
+    return path
+
+def seed_postgres(rows: int, env: Dict[str, str]):
+    """(Re)create `hashes` in the bench database unless it already holds exactly `rows` rows."""
+    os.environ.update(env)  # db_loader reads DB_* at import time
+    from io import BytesIO
+    from db_loader import detect_layout, get_conn, hashes_table_ddl, mark_dataset_imported
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        layout = detect_layout(cur)
+        cur.execute("SELECT to_regclass('hashes') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT count(*) FROM hashes;")
+            if cur.fetchone()[0] == rows:
+                print(f"📦 Reusing bench table with {rows:,} rows")
+                return
+        cur.execute("DROP TABLE IF EXISTS hashes;")
+        cur.execute(hashes_table_ddl(layout, primary_key=False))
+        for start in range(0, rows, SEED_BATCH):
+            lines = []
+            for i in range(start, min(rows, start + SEED_BATCH)):
+                hex_digest = bench_digest(i).hex().upper()
+                key = f"\\\\x{hex_digest}" if layout == "compact" else hex_digest
+                lines.append(f"{key}\t{bench_count(i)}\n")
+            cur.copy_expert("COPY hashes (sha1, count) FROM STDIN", BytesIO("".join(lines).encode()))
+            print(f"   ... seeded {min(rows, start + SEED_BATCH):,} rows")
+        cur.execute("ALTER TABLE hashes ADD CONSTRAINT hashes_pkey PRIMARY KEY (sha1);")
+        cur.execute("ANALYZE hashes;")
+        mark_dataset_imported(cur, f"bench-{rows}")
+        conn.commit()
+    finally:
+        conn.close()
+
+# =========================
+# SERVER
+# =========================
+def start_server(args, workdir: str, env: Dict[str, str]) -> Tuple[subprocess.Popen, str]:
+    with open(os.path.join(workdir, "keys.json"), "w") as fh:
+        json.dump({BENCH_KEY: {"limit": 10 ** 12, "burst": 10 ** 12}}, fh)
+    # per-run metrics snapshots and timing switch, so a server already running on this
+    # host neither loses its files to the benchmark nor has its own counted in it
+    run_files = {"METRICS_DIR": os.path.join(workdir, "metrics"),
+                 "TIMING_CONTROL_PATH": os.path.join(workdir, "timing.json")}
+    env = {**os.environ, **run_files, **env, "RATE_LIMIT_SHM_PATH": os.path.join(workdir, "ratelimit")}
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO_DIR,
+           "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(args.workers),
+           "--log-level", "warning", "--no-access-log"]
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env)
+    return proc, f"http://127.0.0.1:{args.port}"
+
+async def wait_ready(host: str, port: int, proc: Optional[subprocess.Popen], timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise SystemExit(f"❌ server exited with status {proc.returncode}")
+        try:
+            conn = HttpConnection(host, port)
+            # /readyz: the pool is warm and the dataset loaded, not just the port open
+            status, _ = await conn.get("/readyz", {})
+            await conn.close()
+            if status == 200:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("❌ server did not become ready in time")
+
+# =========================
+# CLIENT
+# =========================
+class HttpConnection:
+    """Minimal keep-alive HTTP/1.1 client (stdlib only, Content-Length bodies)."""
+
+    def __init__(self, host: str, port: int):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def get(self, path: str, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        head = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        self.writer.write(f"GET {path} HTTP/1.1\r\nHost: {self.host}\r\n{head}\r\n".encode())
+        status_line = await self.reader.readline()
+        if not status_line:
+            await self.close()
+            raise ConnectionResetError("server closed the connection")
+        status = int(status_line.split()[1])
+        length, close = 0, False
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection" and value.strip().lower() == "close":
+                close = True
+        body = await self.reader.readexactly(length) if length else b""
+        if close:
+            await self.close()
+        return status, body
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+class Workload:
+    """Zipf-popular hits over the seeded keys, uniform random misses."""
+
+    def __init__(self, rows: int, hit_ratio: float, zipf_s: float, mix: Dict[str, float], seed: int):
+        self.rng = random.Random(seed)
+        self.rows = max(1, rows)
+        self.hit_ratio = hit_ratio
+        # rank r has weight 1/r^s; ranks map to shuffled key ids so popular keys are spread out
+        ranks = min(self.rows, 1_000_000)
+        total, self.cum = 0.0, []
+        for r in range(1, ranks + 1):
+            total += 1.0 / r ** zipf_s
+            self.cum.append(total)
+        self.ids = list(range(self.rows))
+        self.rng.shuffle(self.ids)
+        self.endpoints = list(mix)
+        self.endpoint_cum = list(itertools.accumulate(mix[e] for e in self.endpoints))
+
+    def _hit_id(self) -> int:
+        rank = bisect.bisect_left(self.cum, self.rng.random() * self.cum[-1])
+        return self.ids[min(rank, len(self.ids) - 1)]
+
+    def next(self) -> Tuple[str, str, bool]:
+        """(endpoint, path, expect_hit)"""
+        endpoint = self.endpoints[bisect.bisect_left(self.endpoint_cum,
+                                                     self.rng.random() * self.endpoint_cum[-1])]
+        if endpoint == "healthz":
+            return endpoint, "/healthz", False
+        hit = self.rng.random() < self.hit_ratio
+        password = bench_password(self._hit_id()) if hit else f"miss-{self.rng.getrandbits(64):x}"
+        if endpoint == "password":
+            return endpoint, f"/check_password/{password}", hit
+        return endpoint, f"/check/{hashlib.sha1(password.encode()).hexdigest().upper()}", hit
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))  # nearest rank
+    return sorted_values[k]
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    values = sorted(latencies)
+    out = {"requests": len(values), "rps": round(len(values) / elapsed, 1) if elapsed else 0.0}
+    for p in PERCENTILES:
+        out[f"p{str(p).replace('.', '')}_ms"] = round(percentile(values, p) * 1000, 3)
+    out["mean_ms"] = round(sum(values) / len(values) * 1000, 3) if values else 0.0
+    out["max_ms"] = round(values[-1] * 1000, 3) if values else 0.0
+    return out
+
+async def run_load(url: str, api_key: str, workload: Workload, concurrency: int,
+                   warmup: float, duration: float) -> Dict:
+    host_port = url.split("://", 1)[1].rstrip("/")
+    host, _, port = host_port.partition(":")
+    port = int(port or 80)
+    headers = {"x-api-key": api_key}
+    latencies: Dict[str, List[float]] = {e: [] for e in ENDPOINTS}
+    statuses: Dict[str, int] = {}
+    wrong = errors = 0
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    async def client():
+        nonlocal wrong, errors
+        conn = HttpConnection(host, port)
+        while True:
+            endpoint, path, expect_hit = workload.next()
+            t0 = time.perf_counter()
+            if t0 >= stop_at:
+                break
+            try:
+                status, body = await conn.get(path, headers)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                errors += 1
+                await conn.close()
+                continue
+            t1 = time.perf_counter()
+            if t0 < measure_from:
+                continue
+            latencies[endpoint].append(t1 - t0)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if status == 200 and endpoint != "healthz":
+                if (b'"found":true' in body.replace(b" ", b"")) != expect_hit:
+                    wrong += 1
+        await conn.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = min(time.perf_counter(), stop_at) - measure_from
+    result = {"overall": summarize(list(itertools.chain(*latencies.values())), elapsed)}
+    for endpoint, values in latencies.items():
+        if values:
+            result[endpoint] = summarize(values, elapsed)
+    result["status_codes"] = statuses
+    result["connection_errors"] = errors
+    result["wrong_answers"] = wrong
+    return result
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r} (use {', '.join(ENDPOINTS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pwned-check API")
+    parser.add_argument("--backend", choices=("mmap", "postgres"), default="mmap")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="synthetic dataset size")
+    parser.add_argument("--db-name", default="pwned_bench", help="Postgres database for --backend postgres")
+    parser.add_argument("--url", help="benchmark an already running server instead")
+    parser.add_argument("--api-key", default=BENCH_KEY)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3.0, help="unmeasured seconds first")
+    parser.add_argument("--hit-ratio", type=float, default=0.5)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of hit popularity")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("check=0.8,password=0.15,healthz=0.05"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_api_results.json")
+    parser.add_argument("--server-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra environment for the server (e.g. COALESCE_WINDOW_MS=1)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-api-")
+    proc = None
+    env = dict(kv.split("=", 1) for kv in args.server_env)
+    try:
+        url = args.url
+        if url is None:
+            started = time.time()
+            if args.backend == "mmap":
+                print(f"🧱 Seeding mmap store with {args.rows:,} rows...")
+                env.update(LOOKUP_BACKEND="mmap",
+                           HASH_STORE_PATH=seed_store(args.rows, os.path.join(workdir, "bench.store")))
+            else:
+                print(f"🧱 Seeding database {args.db_name} with {args.rows:,} rows...")
+                env.update(LOOKUP_BACKEND="postgres", DB_NAME=args.db_name)
+                seed_postgres(args.rows, env)
+            print(f"✅ Seeded in {time.time()-started:.2f}s, starting server...")
+            proc, url = start_server(args, workdir, env)
+        host, _, port = url.split("://", 1)[1].rstrip("/").partition(":")
+        asyncio.run(wait_ready(host, int(port or 80), proc))
+
+        workload = Workload(args.rows, args.hit_ratio, args.zipf, args.mix, args.seed)
+        print(f"🚀 {args.concurrency} connections, {args.warmup:.0f}s warmup + {args.duration:.0f}s...")
+        result = asyncio.run(run_load(url, args.api_key, workload, args.concurrency,
+                                      args.warmup, args.duration))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items() if k != "api_key"},
+        "server_env": env if args.url is None else None,
+        "results": result,
+    }
+    for name, stats in result.items():
+        if isinstance(stats, dict) and "rps" in stats:
+            print(f"📊 {name:<9} {stats['requests']:>9,} req  {stats['rps']:>10,.1f} req/s  "
+                  f"p50 {stats['p50_ms']:.2f}  p95 {stats['p95_ms']:.2f}  p99 {stats['p99_ms']:.2f}  "
+                  f"p999 {stats['p999_ms']:.2f} ms")
+    print(f"   status codes {result['status_codes']}, connection errors {result['connection_errors']}, "
+          f"wrong answers {result['wrong_answers']}")
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"💾 Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
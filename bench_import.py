@@ -0,0 +1,370 @@
+# bench_import.py
+"""
+End-to-end benchmark of the import strategies on synthetic data.
+
+Usage:
+    python3 bench_import.py --rows 5000000
+    python3 bench_import.py --rows 2000000 --strategies merge --workers 2,4,8 --batch-size 250000,1000000
+    python3 bench_import.py --rows 2000000 --strategies staged,conv --compress zst --profile-dir prof
+
+It generates (and caches in --data-dir) a sorted 'SHA1:COUNT' file of
+--rows lines, with --dup-ratio repeated hashes and --invalid-ratio bad
+lines, plus a wordlist of the same length for conv.py, optionally
+compressed. Each strategy then runs end to end in its own child process,
+so peak RSS is per run:
+
+    load    load_to_postgres.py (COPY pwned_tmp, shadow build, swap)
+    merge   hibp_parallel_postgres.py --mode merge (+ VACUUM, filter)
+    staged  hibp_parallel_postgres.py --mode staged
+    conv    conv.py wordlist -> sorted SHA1:COUNT text
+
+Postgres strategies run against --db-name (default pwned_bench, which must
+exist; its import tables are dropped before every run). Comma-separated
+--workers/--batch-size/--copy-workers/--chunk-bytes values are swept, each
+strategy over the knobs it has. Every run records wall time, rows/s, per-stage
+busy seconds (read, parse, copy, merge, dedupe, index, vacuum, filter,
+swap, hash, reduce, write), peak RSS of the importer and of its largest child
+(parse pools, decoders; not the Postgres backends), and whether the final
+row count matches the data. --profile-dir sets IMPORT_PROFILE_DIR for each
+run, leaving one cProfile dump per stage. Results are printed and written
+as JSON (--output) with the git commit, like bench_api.py.
+"""
+from __future__ import annotations
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bench_api import git_commit
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STRATEGIES = ("load", "merge", "staged", "conv")
+DB_STRATEGIES = ("load", "merge", "staged")
+WRITE_BUFFER = 4 * 1024 * 1024
+MAX_COUNT = 10_000_000  # fits the compact layout's INTEGER
+COMPRESSORS = {"gz": ["gzip", "-kf"], "xz": ["xz", "-kf", "-T0"], "zst": ["zstd", "-qkf"]}
+BENCH_TABLES = ("hashes", "hashes_prev", "hashes_shadow", "hashes_swap_tmp", "hashes_staging",
+                "pwned_tmp", "import_progress", "import_manifest")
+
+# knob -> (module, attribute) per strategy; the child sets them before running
+KNOBS: Dict[str, Dict[str, Tuple[str, str]]] = {
+    "load": {"chunk_bytes": ("load_to_postgres", "COPY_CHUNK_BYTES"),
+             "copy_workers": ("load_to_postgres", "MERGE_WORKERS")},
+    "merge": {"workers": ("hibp_parallel_postgres", "NUM_WORKERS"),
+              "batch_size": ("hibp_parallel_postgres", "BATCH_SIZE")},
+    "staged": {"workers": ("hibp_parallel_postgres", "NUM_WORKERS"),
+               "copy_workers": ("hibp_parallel_postgres", "NUM_COPY_WORKERS"),
+               "chunk_bytes": ("hibp_parallel_postgres", "CHUNK_BYTES")},
+    "conv": {"workers": ("conv", "NUM_WORKERS"),
+             "chunk_bytes": ("conv", "CHUNK_BYTES")},
+}
+
+# =========================
+# SYNTHETIC DATA
+# =========================
+def generate_hashes(path: str, rows: int, dup_ratio: float, invalid_ratio: float, seed: int) -> Dict:
+    """
+    Sorted 'SHA1:COUNT' lines with CRLF endings, like the HIBP download.
+    Row i's hash is drawn from the i-th of `rows` equal slices of the key
+    space, so the file comes out sorted and spread over every prefix.
+    """
+    rng = random.Random(seed)
+    space = 1 << 160
+    unique = dups = invalid = 0
+    last = None
+    buf: List[str] = []
+    size = 0
+    with open(path, "w", newline="") as fh:
+        for i in range(rows):
+            roll = rng.random()
+            if roll < invalid_ratio:
+                line = f"not-a-hash-{i}\r\n"
+                invalid += 1
+            elif last is not None and roll < invalid_ratio + dup_ratio:
+                line = f"{last}:{min(int(rng.paretovariate(1.0)), MAX_COUNT)}\r\n"
+                dups += 1
+            else:
+                lo = i * space // rows
+                last = f"{lo + rng.randrange(max(1, (i + 1) * space // rows - lo)):040X}"
+                line = f"{last}:{min(int(rng.paretovariate(1.0)), MAX_COUNT)}\r\n"
+                unique += 1
+            buf.append(line)
+            size += len(line)
+            if size >= WRITE_BUFFER:
+                fh.write("".join(buf))
+                buf, size = [], 0
+        fh.write("".join(buf))
+    return {"rows": rows, "unique": unique, "duplicates": dups, "invalid": invalid}
+
+def generate_wordlist(path: str, rows: int, seed: int) -> Dict:
+    """rows passwords drawn from rows/2 words, skewed towards the first ones."""
+    rng = random.Random(seed)
+    vocab = max(1, rows // 2)
+    seen = bytearray(vocab)
+    buf: List[str] = []
+    with open(path, "w") as fh:
+        for _ in range(rows):
+            idx = int(vocab * rng.random() ** 2)
+            seen[idx] = 1
+            buf.append(f"benchpw{idx}\n")
+            if len(buf) >= 100_000:
+                fh.write("".join(buf))
+                buf = []
+        fh.write("".join(buf))
+    return {"rows": rows, "unique": sum(seen), "duplicates": rows - sum(seen), "invalid": 0}
+
+def compress(path: str, fmt: Optional[str]) -> str:
+    if not fmt:
+        return path
+    out = f"{path}.{fmt}"
+    if not os.path.exists(out) or os.path.getmtime(out) < os.path.getmtime(path):
+        print(f"🗜️ Compressing {path} ({fmt})...")
+        subprocess.run(COMPRESSORS[fmt] + [path], check=True)
+    return out
+
+def prepare_input(kind: str, args) -> Tuple[str, Dict]:
+    """Generate (or reuse) the input file for `kind` ('hashes' or 'wordlist')."""
+    os.makedirs(args.data_dir, exist_ok=True)
+    if kind == "hashes":
+        name = f"hashes-{args.rows}-d{args.dup_ratio}-i{args.invalid_ratio}-s{args.seed}.txt"
+    else:
+        name = f"wordlist-{args.rows}-s{args.seed}.txt"
+    path = os.path.join(args.data_dir, name)
+    meta_path = path + ".json"
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as fh:
+            meta = json.load(fh)
+        print(f"📦 Reusing {path}")
+    else:
+        print(f"🧱 Generating {args.rows:,} {kind} lines into {path}...")
+        started = time.time()
+        if kind == "hashes":
+            meta = generate_hashes(path, args.rows, args.dup_ratio, args.invalid_ratio, args.seed)
+        else:
+            meta = generate_wordlist(path, args.rows, args.seed)
+        with open(meta_path, "w") as fh:
+            json.dump(meta, fh)
+        print(f"✅ Generated in {time.time()-started:.2f}s ({meta['unique']:,} unique)")
+    return compress(path, args.compress), meta
+
+# =========================
+# CHILD: ONE RUN
+# =========================
+def reset_database():
+    from db_loader import get_conn
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {', '.join(BENCH_TABLES)} CASCADE;")
+        conn.commit()
+    finally:
+        conn.close()
+
+def table_rows() -> int:
+    from db_loader import get_conn
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM hashes;")
+            return int(cur.fetchone()[0])
+    finally:
+        conn.close()
+
+def configure(strategy: str, params: Dict[str, Optional[int]]) -> Dict[str, int]:
+    """Apply the knobs to the importer modules; returns every knob's effective value."""
+    import importlib
+    effective = {}
+    for knob, (module_name, attr) in KNOBS[strategy].items():
+        module = importlib.import_module(module_name)
+        if params.get(knob):
+            setattr(module, attr, params[knob])
+        effective[knob] = getattr(module, attr)
+    return effective
+
+def run_child(strategy: str, path: str, params: Dict[str, Optional[int]], workdir: str) -> Dict:
+    from importer_common import PROFILE_DIR, StageStats, merge_profiles
+    effective = configure(strategy, params)
+    if strategy in DB_STRATEGIES:
+        reset_database()
+    stats = StageStats()
+    started = time.perf_counter()
+    if strategy == "conv":
+        import conv
+        out = os.path.join(workdir, "conv_out.txt")
+        _, produced, _ = conv.convert(path, out, workers=conv.NUM_WORKERS, stats=stats)
+    elif strategy == "load":
+        import load_to_postgres
+        from db_loader import detect_layout, hashes_table_ddl
+        conn = load_to_postgres.get_conn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(hashes_table_ddl(detect_layout(cur)))
+            conn.commit()
+            load_to_postgres.stream_copy_file(conn, path, stats=stats)
+        finally:
+            conn.close()
+    else:
+        import hibp_parallel_postgres as hibp
+        if strategy == "merge":
+            hibp.import_merge(path, stats=stats)
+            hibp.finish_import(path, stats)
+        else:
+            hibp.import_staged(path, stats=stats)
+    elapsed = time.perf_counter() - started
+    if strategy in DB_STRATEGIES:
+        produced = table_rows()
+
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "params": effective,
+        "seconds": elapsed,
+        "output_rows": produced,
+        "stages": stats.snapshot(),
+        # ru_maxrss is KiB on Linux; for children it is the largest single child
+        "peak_rss_mb": self_usage.ru_maxrss / 1024,
+        "peak_child_rss_mb": child_usage.ru_maxrss / 1024,
+        "cpu_seconds": self_usage.ru_utime + self_usage.ru_stime
+                       + child_usage.ru_utime + child_usage.ru_stime,
+        "profiles": merge_profiles() if PROFILE_DIR else [],
+    }
+
+# =========================
+# PARENT: SWEEP
+# =========================
+def int_list(text: str) -> List[int]:
+    return [int(float(v)) for v in text.split(",") if v.strip()]
+
+def sweep(strategy: str, args) -> List[Dict[str, Optional[int]]]:
+    """Cartesian product of the swept values of the knobs this strategy has."""
+    knobs = list(KNOBS[strategy])
+    values = [getattr(args, knob) or [None] for knob in knobs]
+    return [dict(zip(knobs, combo)) for combo in itertools.product(*values)]
+
+def launch(strategy: str, path: str, params: Dict, run_id: str, workdir: str, args) -> Dict:
+    run_dir = os.path.join(workdir, run_id)
+    os.makedirs(run_dir)
+    result_path = os.path.join(run_dir, "result.json")
+    log_path = os.path.join(args.log_dir or workdir, f"{run_id}.log")
+    env = {**os.environ, "DB_NAME": args.db_name,
+           "BLOOM_FILTER_PATH": os.path.join(run_dir, "bloom.bin") if args.bloom else "",
+           "IMPORT_PROFILE_DIR": os.path.join(args.profile_dir, run_id) if args.profile_dir else ""}
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", strategy, "--input", path,
+           "--params", json.dumps(params), "--result", result_path, "--workdir", run_dir]
+    started = time.time()
+    with open(log_path, "w") as log:
+        proc = subprocess.run(cmd, cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    if proc.returncode != 0 or not os.path.exists(result_path):
+        with open(log_path) as fh:
+            tail = fh.read()[-2000:]
+        print(f"❌ {run_id} failed (exit {proc.returncode}), log {log_path}:\n{tail}")
+        return {"error": f"exit {proc.returncode}", "log_tail": tail,
+                "wall_seconds": time.time() - started}
+    with open(result_path) as fh:
+        return json.load(fh)
+
+def report_line(run: Dict) -> str:
+    if "error" in run:
+        return f"   {run['strategy']:<7} {run['run_params']} ❌ {run['error']}"
+    stages = "  ".join(f"{name} {s['seconds']:.2f}s" for name, s in run["stages"].items())
+    check = "" if run["rows_ok"] else f"  ⚠️ {run['output_rows']:,} rows, expected {run['expected_rows']:,}"
+    return (f"   {run['strategy']:<7} {run['params']}  {run['seconds']:.2f}s  "
+            f"{run['rows_per_s']:,.0f} rows/s  RSS {run['peak_rss_mb']:,.0f} MiB "
+            f"(child {run['peak_child_rss_mb']:,.0f})\n          {stages}{check}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the importers on synthetic data")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="input lines per file")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES),
+                        help=f"comma-separated subset of {','.join(STRATEGIES)}")
+    parser.add_argument("--dup-ratio", type=float, default=0.01, help="share of repeated hashes")
+    parser.add_argument("--invalid-ratio", type=float, default=0.0,
+                        help="share of bad lines (load aborts on them: COPY validates)")
+    parser.add_argument("--compress", choices=sorted(COMPRESSORS), help="compress the inputs")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int_list, help="parse/hash processes, e.g. 2,4,8")
+    parser.add_argument("--batch-size", type=int_list, help="merge mode lines per batch")
+    parser.add_argument("--copy-workers", type=int_list, help="COPY / per-partition workers")
+    parser.add_argument("--chunk-bytes", type=int_list, help="raw bytes per chunk")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration")
+    parser.add_argument("--db-name", default="pwned_bench", help="Postgres database (dropped tables!)")
+    parser.add_argument("--bloom", action="store_true", help="also rebuild a Bloom filter per run")
+    parser.add_argument("--profile-dir", help="write per-stage cProfile dumps under this directory")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bench-import"),
+                        help="where generated inputs are cached")
+    parser.add_argument("--log-dir", help="keep each run's importer output here")
+    parser.add_argument("--output", default="bench_import_results.json")
+    parser.add_argument("--child", choices=STRATEGIES, help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    parser.add_argument("--params", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        result = run_child(args.child, args.input, json.loads(args.params), args.workdir)
+        with open(args.result, "w") as fh:
+            json.dump(result, fh)
+        return
+
+    strategies = [s for s in args.strategies.split(",") if s]
+    unknown = set(strategies) - set(STRATEGIES)
+    if unknown:
+        parser.error(f"unknown strategies: {', '.join(sorted(unknown))}")
+    inputs = {}
+    if any(s in DB_STRATEGIES for s in strategies):
+        inputs["hashes"] = prepare_input("hashes", args)
+    if "conv" in strategies:
+        inputs["wordlist"] = prepare_input("wordlist", args)
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    workdir = tempfile.mkdtemp(prefix="bench-import-")
+    runs = []
+    try:
+        for strategy in strategies:
+            path, meta = inputs["wordlist" if strategy == "conv" else "hashes"]
+            for n, params in enumerate(sweep(strategy, args)):
+                for rep in range(args.repeat):
+                    run_id = f"{strategy}-{n}-{rep}"
+                    print(f"🚀 {run_id}: {strategy} {params} on {os.path.basename(path)}...")
+                    run = launch(strategy, path, params, run_id, workdir, args)
+                    run.update(strategy=strategy, run_params=params, input=path,
+                               expected_rows=meta["unique"])
+                    if "error" not in run:
+                        run["rows_per_s"] = meta["rows"] / run["seconds"] if run["seconds"] else 0.0
+                        run["rows_ok"] = run["output_rows"] == meta["unique"]
+                    print(report_line(run))
+                    runs.append(run)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "config": {k: v for k, v in vars(args).items()
+                   if k not in ("child", "input", "params", "result", "workdir")},
+        "inputs": {kind: {"path": path, **meta} for kind, (path, meta) in inputs.items()},
+        "env": {k: os.environ[k] for k in ("HASHES_LAYOUT", "HASHES_PARTITIONS") if k in os.environ},
+        "runs": runs,
+    }
+    print("📊 Summary:")
+    for run in runs:
+        print(report_line(run))
+    with open(args.output, "w") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"💾 Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# bloom_filter.py
+"""
+Bloom filter over SHA1 digests, used to answer definite misses without a
+database round trip.
+
+Usage:
+    python3 bloom_filter.py build-file  /path/to/pwnedpasswords.txt[.gz|...] data/pwned.bloom [--fpr 0.01]
+    python3 bloom_filter.py build-table data/pwned.bloom [--fpr 0.01]
+    python3 bloom_filter.py build-store data/pwned.store data/pwned.bloom [--fpr 0.01]
+    python3 bloom_filter.py info data/pwned.bloom
+
+File layout (little-endian):
+    header : magic b"PWNDBLM2", items u64, m_bits u64, k u32, reserved u32,
+             source u64, target_fpr f64, bits_set u64, built_at u64
+    bits   : ceil(m_bits / 8) bytes
+
+(PWNDBLM1 files, with a u32 source and no reserved field, are still read.)
+
+source says which data the filter covers: the dataset_version it was
+built for (from a Postgres table) or the built_at stamp (nanoseconds) of
+the mmap store it was built from (0 for an import file). The API only uses a filter whose
+source matches the data it serves, since a filter of other data would
+answer hashes new to it as misses.
+
+The keys are SHA1 digests, which are already uniformly distributed, so the
+k bit positions are derived from the digest itself by double hashing
+(h1 + i*h2) instead of hashing again.
+"""
+from __future__ import annotations
+import math
+import mmap
+import os
+import shutil
+import struct
+import time
+from typing import Dict, Iterable, Iterator
+
+MAGIC = b"PWNDBLM2"
+HEADER = struct.Struct("<8sQQIIQdQQ")
+V1_MAGIC = b"PWNDBLM1"
+V1_HEADER = struct.Struct("<8sQQIIdQQ")  # u32 source; too narrow for a store's ns stamp
+DEFAULT_FPR = float(os.getenv("BLOOM_FPR", "0.01"))
+
+class FilterFormatError(Exception):
+    pass
+
+def filter_params(items: int, fpr: float):
+    """(m_bits, k) for the requested false-positive rate."""
+    items = max(1, items)
+    m_bits = max(64, int(math.ceil(-items * math.log(fpr) / (math.log(2) ** 2))))
+    k = max(1, int(round(m_bits / items * math.log(2))))
+    return m_bits, k
+
+def _positions(digest: bytes, k: int, m_bits: int) -> Iterator[int]:
+    h1 = int.from_bytes(digest[0:8], "little")
+    h2 = int.from_bytes(digest[8:16], "little") | 1
+    for i in range(k):
+        yield (h1 + i * h2) % m_bits
+
+class BloomBuilder:
+    def __init__(self, items: int, fpr: float = DEFAULT_FPR):
+        self.fpr = fpr
+        self.m_bits, self.k = filter_params(items, fpr)
+        self.bits = bytearray((self.m_bits + 7) // 8)
+        self.items = 0
+
+    def add(self, digest: bytes):
+        bits = self.bits
+        for pos in _positions(digest, self.k, self.m_bits):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.items += 1
+
+    def save(self, path: str, source: int = 0):
+        step = 1 << 20
+        bits_set = sum(int.from_bytes(self.bits[i:i + step], "little").bit_count()
+                       for i in range(0, len(self.bits), step))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(HEADER.pack(MAGIC, self.items, self.m_bits, self.k, 0, source, self.fpr,
+                                 bits_set, int(time.time())))
+            fh.write(self.bits)
+        os.replace(tmp_path, path)  # readers keep their old mapping until they reload
+
+class BloomFilter:
+    """Read-only, mmap-backed filter. might_contain() False means definitely absent."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as fh:
+            self._mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._inode = os.fstat(fh.fileno()).st_ino
+        if len(self._mm) < V1_HEADER.size:
+            raise FilterFormatError(f"{path}: truncated header")
+        magic = self._mm[:8]
+        if magic == MAGIC and len(self._mm) >= HEADER.size:
+            (_, self.items, self.m_bits, self.k, _, self.source, self.target_fpr,
+             self.bits_set, self.built_at) = HEADER.unpack_from(self._mm, 0)
+            self._base = HEADER.size
+        elif magic == V1_MAGIC:
+            (_, self.items, self.m_bits, self.k, self.source, self.target_fpr,
+             self.bits_set, self.built_at) = V1_HEADER.unpack_from(self._mm, 0)
+            self._base = V1_HEADER.size
+        else:
+            raise FilterFormatError(f"{path}: bad magic {magic!r}")
+        if len(self._mm) != self._base + (self.m_bits + 7) // 8:
+            raise FilterFormatError(f"{path}: size does not match header")
+        self.checks = 0
+        self.skips = 0
+
+    def might_contain(self, digest: bytes) -> bool:
+        mm, base = self._mm, self._base
+        self.checks += 1
+        for pos in _positions(digest, self.k, self.m_bits):
+            if not mm[base + (pos >> 3)] & (1 << (pos & 7)):
+                self.skips += 1
+                return False
+        return True
+
+    def might_contain_hex(self, sha1_hex_upper: str) -> bool:
+        return self.might_contain(bytes.fromhex(sha1_hex_upper))
+
+    def is_stale(self) -> bool:
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def stats(self) -> Dict:
+        fill = self.bits_set / self.m_bits if self.m_bits else 0.0
+        return {
+            "path": self.path,
+            "items": self.items,
+            "bytes": len(self._mm),
+            "k": self.k,
+            "target_fpr": self.target_fpr,
+            "estimated_fpr": round(fill ** self.k, 6),
+            "built_at": self.built_at,
+            "source": self.source,
+            "checks": self.checks,
+            "skips": self.skips,
+            "skip_rate": round(self.skips / self.checks, 4) if self.checks else 0.0,
+        }
+
+def store_source(built_at: int) -> int:
+    """The header's source field for a store with this built_at stamp (the stamp itself)."""
+    return built_at
+
+# =========================
+# BUILDERS
+# =========================
+def build_from_digests(digests: Iterable[bytes], items: int, path: str, fpr: float = DEFAULT_FPR,
+                       source: int = 0) -> int:
+    started = time.time()
+    builder = BloomBuilder(items, fpr)
+    for digest in digests:
+        builder.add(digest)
+        if builder.items % 10_000_000 == 0:
+            print(f"   ... {builder.items:,} digests added to filter")
+    builder.save(path, source)
+    print(f"✅ Bloom filter {path}: {builder.items:,} items, {len(builder.bits)/1024/1024:.1f} MiB, "
+          f"k={builder.k}, target FPR {fpr} ({time.time()-started:.2f}s)")
+    return builder.items
+
+def _count_lines(path: str) -> int:
+    from importer_common import open_input  # import pipeline only; keeps API startup light
+    lines = 0
+    with open_input(path) as fh:
+        while True:
+            chunk = fh.read(16 * 1024 * 1024)
+            if not chunk:
+                return lines
+            lines += chunk.count(b"\n")
+
+def _file_digests(path: str) -> Iterator[bytes]:
+    from importer_common import open_input
+    with open_input(path) as fh:
+        for line in fh:
+            sha1, sep, count = line.strip().partition(b":")
+            if sep and len(sha1) == 40 and count.isdigit():
+                try:
+                    yield bytes.fromhex(sha1.decode("ascii"))
+                except ValueError:
+                    continue
+
+def build_from_file(input_path: str, path: str, fpr: float = DEFAULT_FPR) -> int:
+    """Build from a 'SHA1:COUNT' import file, optionally compressed (two passes: count, then add)."""
+    return build_from_digests(_file_digests(input_path), _count_lines(input_path), path, fpr)
+
+def build_from_store(store_path: str, path: str, fpr: float = DEFAULT_FPR) -> int:
+    from mmap_store import HashStore, RECORD_LEN, DIGEST_LEN
+    store = HashStore(store_path)
+    mm, base = store._mm, store._data_start
+    digests = (mm[base + i * RECORD_LEN:base + i * RECORD_LEN + DIGEST_LEN]
+               for i in range(store.record_count))
+    return build_from_digests(digests, store.record_count, path, fpr, store_source(store.built_at))
+
+def add_to_filter(path: str, digests: Iterable[bytes], source: int) -> int:
+    """
+    Set the bits of `digests` in a copy of the filter at `path`, restamp it
+    with `source` and rename it into place. Costs a file copy plus k bits per
+    digest instead of a full rebuild; the false-positive rate creeps up once
+    items outgrow the count the filter was sized for.
+    """
+    with open(path, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise FilterFormatError(f"{path}: not a {MAGIC.decode()} filter, rebuild it")
+    tmp_path = path + ".tmp"
+    shutil.copyfile(path, tmp_path)
+    with open(tmp_path, "r+b") as fh:
+        mm = mmap.mmap(fh.fileno(), 0)
+    try:
+        magic, items, m_bits, k, _, _, fpr, bits_set, _ = HEADER.unpack_from(mm, 0)
+        if len(mm) != HEADER.size + (m_bits + 7) // 8:
+            raise FilterFormatError(f"{path}: size does not match header")
+        base = HEADER.size
+        added = 0
+        for digest in digests:
+            for pos in _positions(digest, k, m_bits):
+                i, bit = base + (pos >> 3), 1 << (pos & 7)
+                if not mm[i] & bit:
+                    mm[i] |= bit
+                    bits_set += 1
+            added += 1
+        HEADER.pack_into(mm, 0, MAGIC, items + added, m_bits, k, 0, source, fpr, bits_set,
+                         int(time.time()))
+        mm.flush()
+    finally:
+        mm.close()
+    os.replace(tmp_path, path)  # readers keep their old mapping until they reload
+    capacity = int(m_bits * math.log(2) ** 2 / -math.log(fpr))
+    if items + added > capacity:
+        print(f"⚠️ Bloom filter {path} now holds {items + added:,} items, sized for {capacity:,}; "
+              f"its false-positive rate is above {fpr} until a full rebuild")
+    return added
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or inspect the hash membership filter")
+    sub = parser.add_subparsers(dest="cmd")
+    p_file = sub.add_parser("build-file")
+    p_file.add_argument("input")
+    p_file.add_argument("output")
+    p_table = sub.add_parser("build-table")
+    p_table.add_argument("output")
+    p_store = sub.add_parser("build-store")
+    p_store.add_argument("store")
+    p_store.add_argument("output")
+    for p in (p_file, p_table, p_store):
+        p.add_argument("--fpr", type=float, default=DEFAULT_FPR)
+    p_info = sub.add_parser("info")
+    p_info.add_argument("filter")
+    args = parser.parse_args()
+    if args.cmd == "build-file":
+        build_from_file(args.input, args.output, args.fpr)
+    elif args.cmd == "build-table":
+        from db_loader import get_conn, rebuild_bloom_filter
+        conn = get_conn()
+        try:
+            rebuild_bloom_filter(conn, args.output, args.fpr)
+        finally:
+            conn.close()
+    elif args.cmd == "build-store":
+        build_from_store(args.store, args.output, args.fpr)
+    elif args.cmd == "info":
+        print(BloomFilter(args.filter).stats())
+    else:
+        parser.print_help()
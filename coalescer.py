@@ -0,0 +1,109 @@
+# coalescer.py
+"""
+Request coalescing for single-hash lookups.
+
+- singleflight: concurrent lookups of the same hash share one future
+- micro-batching: distinct hashes arriving within COALESCE_WINDOW_MS (or
+  until COALESCE_MAX_BATCH keys are queued) are resolved with one set-based
+  lookup_many call, and each waiter gets its own result
+- the fetch gets the batch and the most urgent priority among its waiters,
+  so a backend batch can pass admission control once, by its size
+
+A window of 0 flushes on the next event-loop iteration, which merges
+everything that arrived in the same tick without adding latency. Batch
+sizes and flush waits are metrics.py histograms (pwned_coalescer_*).
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from metrics import COALESCE_BATCH_SIZE, COALESCE_WAIT
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "1") == "1"
+COALESCE_WINDOW_MS = float(os.getenv("COALESCE_WINDOW_MS", "0"))
+COALESCE_MAX_BATCH = int(os.getenv("COALESCE_MAX_BATCH", "256"))
+
+class LookupCoalescer:
+    def __init__(self, fetch: Callable[[List[str], int], Awaitable[Dict[str, int]]],
+                 window_ms: float = COALESCE_WINDOW_MS, max_batch: int = COALESCE_MAX_BATCH):
+        self._fetch = fetch
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._priority: Optional[int] = None
+        self._enqueued: Dict[str, float] = {}
+        self._timer: Optional[asyncio.Handle] = None
+        self.lookups = 0
+        self.shared = 0
+        self.batches = 0
+
+    async def lookup(self, sha1_hex_upper: str, priority: int = 1) -> int:
+        self.lookups += 1
+        fut = self._inflight.get(sha1_hex_upper)
+        if fut is not None:
+            self.shared += 1
+            return await asyncio.shield(fut)
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._inflight[sha1_hex_upper] = fut
+        self._pending.append(sha1_hex_upper)
+        if self._priority is None or priority < self._priority:
+            self._priority = priority
+        self._enqueued[sha1_hex_upper] = time.perf_counter()
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            if self.window > 0:
+                self._timer = loop.call_later(self.window, self._flush)
+            else:
+                self._timer = loop.call_soon(self._flush)
+        return await asyncio.shield(fut)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        priority, self._priority = self._priority, None
+        now = time.perf_counter()
+        for h in batch:
+            COALESCE_WAIT.observe(now - self._enqueued.pop(h, now))
+        self.batches += 1
+        COALESCE_BATCH_SIZE.observe(len(batch))
+        # a fresh context: the batch belongs to no single request (request_timing)
+        asyncio.get_running_loop().create_task(self._resolve(batch, priority),
+                                               context=contextvars.Context())
+
+    async def _resolve(self, batch: List[str], priority: int):
+        try:
+            found = await self._fetch(batch, priority)
+        except BaseException as e:
+            for h in batch:
+                fut = self._inflight.pop(h, None)
+                if fut is not None and not fut.done():
+                    fut.set_exception(e)
+                    fut.exception()  # mark retrieved: waiters may have gone away
+            if not isinstance(e, Exception):
+                raise
+            return
+        for h in batch:
+            fut = self._inflight.pop(h, None)
+            if fut is not None and not fut.done():
+                fut.set_result(found.get(h, 0))
+
+    def stats(self) -> Dict:
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "lookups": self.lookups,
+            "shared": self.shared,
+            "batches": self.batches,
+            "in_flight": len(self._inflight),
+        }
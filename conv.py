@@ -1,27 +1,186 @@
 #!/usr/bin/env python3
+"""
+Hash a plaintext wordlist into sorted, deduplicated SHA1:COUNT output.
+
+Usage:
+    python3 conv.py [data/rockyou.txt] [data/rockyou_pwned.txt] [--format text|store] [--filter F]
+
+- the wordlist is read in raw byte chunks and hashed in a process pool
+- each chunk's digests are counted and spilled to disk by hash prefix
+  (--partitions files per worker), so memory stays bounded by the chunk
+  size and one partition, not by the size of the list
+- partitions are then summed and sorted in parallel and written in order:
+  'SHA1:COUNT' text (any importer) or the mmap_store binary format
+  (LOOKUP_BACKEND=mmap); a store build also rebuilds the Bloom filter at
+  --filter (default BLOOM_FILTER_PATH) from it
+
+The wordlist may be .gz/.xz/.zst/.7z compressed. Counts are real
+occurrence counts. Lines are decoded as latin-1 by
+default (--encoding), stripped, and hashed as UTF-8, as before.
+"""
+import argparse
+import glob
 import hashlib
+import os
+import shutil
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
 
-infile = "data/rockyou.txt"             # input wordlist
-outfile = "data/rockyou_pwned.txt"      # output SHA1 hashes
+from importer_common import StageStats, iter_chunks, open_input, profiled
+from mmap_store import MAX_COUNT, RECORD, RECORD_LEN, write_store
 
-print("⏳ Converting rockyou.txt → SHA1 hashes (streaming mode)...")
+INFILE = "data/rockyou.txt"             # input wordlist
+OUTFILE = "data/rockyou_pwned.txt"      # output SHA1 hashes
+CHUNK_BYTES = 16 * 1024 * 1024
+DEFAULT_PARTITIONS = 256
+NUM_WORKERS = max(1, cpu_count() - 1)
 
-count = 0
-with open(infile, "r", encoding="latin-1", errors="ignore") as f_in, open(outfile, "w") as f_out:
-    for i, line in enumerate(f_in, 1):
+def _partition(digest: bytes, partitions: int) -> int:
+    return ((digest[0] << 8) | digest[1]) * partitions >> 16
+
+def _spill_path(spill_dir: str, partition: int, pid: int) -> str:
+    return os.path.join(spill_dir, f"part-{partition:05d}-{pid}.bin")
+
+def hash_chunk(data: bytes, encoding: str, partitions: int, spill_dir: str):
+    """
+    Count the digests of one chunk and append them, grouped by partition, to
+    this worker's spill files. Returns (lines, passwords hashed).
+    """
+    counts = {}
+    sha1 = hashlib.sha1
+    text = data.decode(encoding, errors="ignore")
+    for line in text.replace("\r", "\n").split("\n"):
         pw = line.strip()
         if not pw:
             continue
+        digest = sha1(pw.encode("utf-8", errors="ignore")).digest()
+        counts[digest] = counts.get(digest, 0) + 1
+
+    spills = {}
+    for digest, count in counts.items():
+        spills.setdefault(_partition(digest, partitions), []).append(RECORD.pack(digest, count))
+    pid = os.getpid()
+    for partition, records in spills.items():
+        # one file per worker and partition, closed each time: pool workers
+        # exit without flushing open files
+        with open(_spill_path(spill_dir, partition, pid), "ab") as fh:
+            fh.write(b"".join(records))
+    lines = data.count(b"\n") + (0 if data.endswith(b"\n") else 1)
+    return lines, sum(counts.values())
+
+def reduce_partition(spill_dir: str, partition: int, fmt: str):
+    """Sum one partition's spills and write it sorted. Returns (path, unique hashes)."""
+    counts = {}
+    for path in glob.glob(os.path.join(spill_dir, f"part-{partition:05d}-*.bin")):
+        with open(path, "rb") as fh:
+            data = fh.read()
+        os.remove(path)
+        for digest, count in RECORD.iter_unpack(data):
+            counts[digest] = counts.get(digest, 0) + count
+    out_path = os.path.join(spill_dir, f"sorted-{partition:05d}.{fmt}")
+    with open(out_path, "wb") as fh:
+        if fmt == "store":
+            fh.write(b"".join(RECORD.pack(d, min(counts[d], MAX_COUNT)) for d in sorted(counts)))
+        else:
+            fh.write("".join(f"{d.hex().upper()}:{counts[d]}\n" for d in sorted(counts)).encode())
+    return out_path, len(counts)
+
+def _store_records(paths):
+    for path in paths:
+        with open(path, "rb") as fh:
+            data = fh.read()
+        os.remove(path)
+        for i in range(0, len(data), RECORD_LEN):
+            yield data[i:i + RECORD_LEN]
+
+def convert(infile, outfile, fmt="text", encoding="latin-1", partitions=DEFAULT_PARTITIONS,
+            workers=NUM_WORKERS, tmp_dir=None, stats=None, filter_path=""):
+    stats = stats or StageStats()
+    started = time.time()
+    spill_dir = tempfile.mkdtemp(prefix="conv-", dir=tmp_dir or os.path.dirname(os.path.abspath(outfile)))
+    lines = hashed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            in_flight = deque()
+            next_report = 100_000
+
+            def drain_one():
+                nonlocal lines, hashed, next_report
+                fut, submitted = in_flight.popleft()
+                n_lines, n_hashed = fut.result()
+                stats.add("hash", rows=n_lines, seconds=time.perf_counter() - submitted)
+                lines += n_lines
+                hashed += n_hashed
+                if lines >= next_report:
+                    print(f"   ... processed {lines:,} lines")
+                    next_report = (lines // 100_000 + 1) * 100_000
+
+            # at most workers*2 chunks in memory at once
+            with open_input(infile) as fh:
+                chunks = iter_chunks(fh, CHUNK_BYTES)
+                while True:
+                    with stats.timed("read") as t:
+                        chunk = next(chunks, None)
+                        t.nbytes = len(chunk[1]) if chunk else 0
+                    if chunk is None:
+                        break
+                    in_flight.append((pool.submit(profiled, "hash", hash_chunk, chunk[1], encoding,
+                                                  partitions, spill_dir), time.perf_counter()))
+                    while len(in_flight) >= workers * 2:
+                        drain_one()
+            while in_flight:
+                drain_one()
+            print(f"🔢 Hashed {hashed:,} passwords from {lines:,} lines ({time.time()-started:.2f}s), "
+                  f"counting duplicates...")
 
-        # compute SHA1 in uppercase
-        sha1 = hashlib.sha1(pw.encode("utf-8", errors="ignore")).hexdigest().upper()
+            # timed, not profiled, here: the workers profile the reduce itself
+            submitted = time.perf_counter()
+            futures = [pool.submit(profiled, "reduce", reduce_partition, spill_dir, p, fmt)
+                       for p in range(partitions)]
+            paths, unique = [], 0
+            for fut in futures:
+                path, n = fut.result()
+                paths.append(path)
+                unique += n
+            stats.add("reduce", rows=unique, seconds=time.perf_counter() - submitted)
 
-        # write hash + fake count = 1
-        f_out.write(f"{sha1}:1\n")
-        count += 1
+        # partitions are prefix ranges, so writing them in order is a full sort
+        with stats.timed("write", rows=unique):
+            if fmt == "store":
+                write_store(_store_records(paths), outfile, filter_path=filter_path)
+            else:
+                tmp_path = outfile + ".tmp"
+                with open(tmp_path, "wb") as out:
+                    for path in paths:
+                        with open(path, "rb") as fh:
+                            shutil.copyfileobj(fh, out, 4 * 1024 * 1024)
+                        os.remove(path)
+                os.replace(tmp_path, outfile)
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return hashed, unique, time.time() - started
 
-        # progress log every 100k lines
-        if i % 100000 == 0:
-            print(f"   ... processed {i:,} lines")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash a wordlist into sorted SHA1:COUNT output")
+    parser.add_argument("infile", nargs="?", default=INFILE)
+    parser.add_argument("outfile", nargs="?", default=OUTFILE)
+    parser.add_argument("--format", choices=("text", "store"), default="text",
+                        help="SHA1:COUNT text, or the mmap_store binary format")
+    parser.add_argument("--encoding", default="latin-1", help="wordlist encoding (default latin-1)")
+    parser.add_argument("--partitions", type=int, default=DEFAULT_PARTITIONS,
+                        help="spill partitions; raise it for very large lists to cap memory")
+    parser.add_argument("--workers", type=int, default=NUM_WORKERS)
+    parser.add_argument("--tmp-dir", help="spill directory (default: next to the output)")
+    parser.add_argument("--filter", default=os.getenv("BLOOM_FILTER_PATH", ""),
+                        help="with --format store: Bloom filter to rebuild (default $BLOOM_FILTER_PATH)")
+    args = parser.parse_args()
 
-print(f"🎉 Done! Written {count:,} hashes to {outfile}")
+    print(f"⏳ Converting {args.infile} → SHA1 hashes ({args.workers} workers)...")
+    hashed, unique, elapsed = convert(args.infile, args.outfile, args.format, args.encoding,
+                                      max(1, min(args.partitions, 65536)), args.workers, args.tmp_dir,
+                                      filter_path=args.filter)
+    print(f"🎉 Done! Written {unique:,} unique hashes ({hashed:,} passwords) to {args.outfile} "
+          f"in {elapsed:.2f}s")
@@ -0,0 +1,251 @@
+# dataset_swap.py
+"""
+Blue/green installs of the 'hashes' table.
+
+Usage:
+    python3 dataset_swap.py --status
+    python3 dataset_swap.py --rollback
+    python3 dataset_swap.py --drop-prev
+
+Importers build the next dataset into SHADOW_TABLE (deduplicated, primary
+key built, VACUUM ANALYZEd, Bloom filter rebuilt from it) while the API
+keeps serving 'hashes'. install_shadow() then swaps it in with renames in
+one short transaction:
+
+    hashes        -> hashes_prev   (kept for --rollback)
+    hashes_shadow -> hashes
+
+and bumps dataset_version in the same transaction, so the API's version
+watcher refreshes its caches and pooled connections. Partitions and
+primary-key constraints are renamed along with their tables. The old
+hashes_prev is dropped by the next install (or --drop-prev); until then
+the database holds two copies of the dataset.
+"""
+from __future__ import annotations
+import argparse
+import os
+import time
+
+import psycopg2
+
+from db_loader import (
+    BLOOM_FILTER_PATH, HOT_SET_PATH, get_conn, hashes_table_ddl, mark_dataset_imported,
+    partition_name, read_dataset_version, rebuild_bloom_filter, rebuild_hot_set, table_partitions,
+)
+from importer_common import StageStats, run_per_partition
+
+SHADOW_TABLE = "hashes_shadow"
+PREV_TABLE = "hashes_prev"
+SWAP_TMP_TABLE = "hashes_swap_tmp"
+SWAP_LOCK_TIMEOUT = os.getenv("SWAP_LOCK_TIMEOUT", "5s")  # per attempt, while lookups drain
+SWAP_RETRIES = int(os.getenv("SWAP_RETRIES", "10"))
+LOCK_NOT_AVAILABLE = "55P03"
+
+# =========================
+# BUILDING THE SHADOW TABLE
+# =========================
+def create_shadow(cur, layout, partitions=0):
+    cur.execute(f"DROP TABLE IF EXISTS {SHADOW_TABLE};")
+    cur.execute(hashes_table_ddl(layout, SHADOW_TABLE, primary_key=False, partitions=partitions))
+
+def build_shadow(conn, select_for, partitions=0, stats=None, workers=4):
+    """
+    Fill the (empty) shadow table from select_for(prefix), a SELECT yielding
+    (sha1, count) possibly with duplicates, then build its primary key.
+    prefix is None for an unpartitioned shadow; otherwise each partition is
+    deduplicated and indexed on its own worker and the partition keys are
+    attached to the parent key.
+    """
+    stats = stats or StageStats()
+    if partitions:
+        targets = [(partition_name(SHADOW_TABLE, prefix), prefix)
+                   for _, prefix in table_partitions(conn.cursor(), SHADOW_TABLE)]
+    else:
+        targets = [(SHADOW_TABLE, None)]
+
+    def build(cur, target, prefix):
+        if partitions:
+            # parallelism comes from one partition per worker
+            cur.execute("SET maintenance_work_mem = '512MB';")
+            cur.execute("SET max_parallel_maintenance_workers = 0;")
+        else:
+            cur.execute("SET maintenance_work_mem = '2GB';")
+            cur.execute("SET max_parallel_maintenance_workers = 8;")
+            cur.execute("SET max_parallel_workers_per_gather = 8;")
+        cur.execute("SET work_mem = '256MB';")
+        with stats.timed("dedupe") as t:
+            cur.execute(f"""
+                INSERT INTO {target} (sha1, count)
+                SELECT sha1, MAX(count) FROM ({select_for(prefix)}) AS src GROUP BY sha1;
+            """)
+            t.rows = cur.rowcount
+        with stats.timed("index", rows=t.rows):
+            cur.execute(f"ALTER TABLE {target} ADD CONSTRAINT {target}_pkey PRIMARY KEY (sha1);")
+
+    print(f"🧱 Building {SHADOW_TABLE} ({len(targets)} part(s), index last)...")
+    run_per_partition(get_conn, targets, build, workers)
+    if partitions:
+        cur = conn.cursor()
+        cur.execute(f"ALTER TABLE ONLY {SHADOW_TABLE} ADD CONSTRAINT {SHADOW_TABLE}_pkey PRIMARY KEY (sha1);")
+        for target, _ in targets:
+            cur.execute(f"ALTER INDEX {SHADOW_TABLE}_pkey ATTACH PARTITION {target}_pkey;")
+        conn.commit()
+
+def rebuild_side_files(conn, table, stats=None) -> int:
+    """
+    Rebuild the Bloom filter and hot set files (when configured) from the
+    table about to serve. Returns the dataset_version the filter is stamped
+    for: the one the following swap bumps to.
+    """
+    stats = stats or StageStats()
+    with conn.cursor() as cur:
+        version = read_dataset_version(cur) + 1
+    conn.commit()
+    if BLOOM_FILTER_PATH:
+        print(f"🧮 Rebuilding Bloom filter {BLOOM_FILTER_PATH} from {table}...")
+        with stats.timed("filter"):
+            rebuild_bloom_filter(conn, table=table, version=version)
+    if HOT_SET_PATH:
+        print(f"🔥 Rebuilding hot set {HOT_SET_PATH} from {table}...")
+        with stats.timed("hot_set"):
+            rebuild_hot_set(conn, table=table)
+    return version
+
+def _check_filter_version(stamped, version):
+    if BLOOM_FILTER_PATH and stamped != version:
+        # another import bumped the version meanwhile: the API will not use this filter
+        print(f"⚠️ Bloom filter was stamped for dataset version {stamped}, but {version} was "
+              f"installed; rebuild it (bloom_filter.py build-table)")
+
+def publish_shadow(conn, label, workers=4, stats=None) -> int:
+    """VACUUM ANALYZE and filter the finished shadow table, then install it."""
+    stats = stats or StageStats()
+    print(f"🔎 Running VACUUM ANALYZE on {SHADOW_TABLE}...")
+    parts = table_partitions(conn.cursor(), SHADOW_TABLE) or [(SHADOW_TABLE, None)]
+    conn.commit()
+    with stats.timed("vacuum"):
+        run_per_partition(get_conn, parts, lambda c, name, _: c.execute(f"VACUUM ANALYZE {name};"),
+                          workers, autocommit=True)
+    # built before the swap: the new filter may briefly front the old table,
+    # which only costs a few extra lookups (the shadow holds every old row)
+    stamped = rebuild_side_files(conn, SHADOW_TABLE, stats)
+    with stats.timed("swap"):
+        version = install_shadow(conn, label)
+    _check_filter_version(stamped, version)
+    print(f"🔄 {SHADOW_TABLE} is now serving as hashes, dataset version {version} "
+          f"(previous dataset kept as {PREV_TABLE}).")
+    return version
+
+# =========================
+# SWAPPING
+# =========================
+def rename_table(cur, old, new):
+    """Rename a hashes-shaped table with its primary key and partitions."""
+    cur.execute(f"ALTER TABLE {old} RENAME TO {new};")
+    cur.execute("SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s;",
+                (new, f"{old}_pkey"))
+    if cur.fetchone():
+        cur.execute(f"ALTER TABLE {new} RENAME CONSTRAINT {old}_pkey TO {new}_pkey;")
+    for part, prefix in table_partitions(cur, new):
+        rename_table(cur, part, partition_name(new, prefix))
+
+def _table_exists(cur, table):
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    return cur.fetchone()[0]
+
+def swap_tables(conn, renames, label, before=()) -> int:
+    """
+    Run the `before` statements, the renames and the version bump in one
+    transaction. ACCESS EXCLUSIVE on hashes waits for running lookups;
+    lock_timeout keeps new lookups from queueing behind a long wait, and the
+    attempt is retried.
+    """
+    for attempt in range(1, SWAP_RETRIES + 1):
+        cur = conn.cursor()
+        try:
+            cur.execute("SET LOCAL lock_timeout = %s;", (SWAP_LOCK_TIMEOUT,))
+            cur.execute("LOCK TABLE hashes IN ACCESS EXCLUSIVE MODE;")
+            for sql in before:
+                cur.execute(sql)
+            for old, new in renames:
+                if old is None:
+                    cur.execute(f"DROP TABLE IF EXISTS {new};")
+                else:
+                    rename_table(cur, old, new)
+            cur.execute("COMMENT ON TABLE hashes IS %s;", (label,))
+            version = mark_dataset_imported(cur, label)
+            conn.commit()
+            return version
+        except psycopg2.OperationalError as e:
+            conn.rollback()
+            if getattr(e, "pgcode", None) != LOCK_NOT_AVAILABLE or attempt == SWAP_RETRIES:
+                raise
+            print(f"⏳ hashes is busy, retrying swap ({attempt}/{SWAP_RETRIES})...")
+            time.sleep(min(2 ** attempt * 0.1, 5))
+
+def install_shadow(conn, label) -> int:
+    """Serve the shadow table as hashes; the current one becomes hashes_prev."""
+    return swap_tables(conn, [(None, PREV_TABLE), ("hashes", PREV_TABLE), (SHADOW_TABLE, "hashes")], label)
+
+def rollback(conn) -> int:
+    with conn.cursor() as cur:
+        if not _table_exists(cur, PREV_TABLE):
+            raise SystemExit(f"❌ No {PREV_TABLE} table to roll back to.")
+        cur.execute("SELECT obj_description(to_regclass(%s), 'pg_class');", (PREV_TABLE,))
+        prev_label = cur.fetchone()[0] or PREV_TABLE
+    conn.commit()
+    # rebuilt before the swap, as for a publish: the API maps the files again on the
+    # version bump, and a filter of the rolled-back rows would read restored ones as misses
+    stamped = rebuild_side_files(conn, PREV_TABLE)
+    version = swap_tables(conn, [("hashes", SWAP_TMP_TABLE), (PREV_TABLE, "hashes"),
+                           (SWAP_TMP_TABLE, PREV_TABLE)], f"rollback: {prev_label}")
+    _check_filter_version(stamped, version)
+    print(f"⏪ Rolled back to '{prev_label}', dataset version {version}.")
+    return version
+
+# =========================
+# MAINTENANCE
+# =========================
+def status(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('dataset_version') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            cur.execute("SELECT version, label, updated_at FROM dataset_version WHERE id = 1;")
+            row = cur.fetchone()
+            if row:
+                print(f"📦 Dataset version {row[0]} ({row[1]}), installed {row[2]}")
+        for table in ("hashes", PREV_TABLE, SHADOW_TABLE):
+            if _table_exists(cur, table):
+                cur.execute("SELECT obj_description(to_regclass(%s), 'pg_class'), "
+                            "pg_size_pretty(pg_total_relation_size(to_regclass(%s)) + "
+                            "coalesce((SELECT sum(pg_total_relation_size(inhrelid)) FROM pg_inherits "
+                            "WHERE inhparent = to_regclass(%s)), 0)::bigint);", (table, table, table))
+                label, size = cur.fetchone()
+                print(f"   {table}: {label or '-'}, {size}")
+    conn.commit()
+
+def drop_prev(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {PREV_TABLE};")
+    conn.commit()
+    print(f"🧹 Dropped {PREV_TABLE} (rollback no longer possible).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect, roll back or clean up hashes table swaps")
+    parser.add_argument("--status", action="store_true")
+    parser.add_argument("--rollback", action="store_true")
+    parser.add_argument("--drop-prev", action="store_true")
+    args = parser.parse_args()
+    if not (args.status or args.rollback or args.drop_prev):
+        parser.print_help()
+    else:
+        conn = get_conn()
+        try:
+            if args.rollback:
+                rollback(conn)
+            if args.drop_prev:
+                drop_prev(conn)
+            if args.status:
+                status(conn)
+        finally:
+            conn.close()
@@ -1,9 +1,30 @@
 # db_loader.py
 from __future__ import annotations
+import asyncio
+import contextvars
+import json
 import os
+import sys
+from array import array
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+import admission
+from bloom_filter import DEFAULT_FPR, BloomFilter, build_from_digests, store_source
+from coalescer import COALESCE_ENABLED, LookupCoalescer
+from hot_set import HOT_SET_SIZE, HotSet, write_hot_set
+from lookup_cache import cache
+from metrics import DB_ACQUIRE, DB_QUERY, LOOKUPS, register_collector
+from mmap_store import HashStore, read_store_version
+from read_router import DB_READ_HOSTS, ReadRouter, connection_broken, parse_hosts
+import request_timing
+
 # Default DB credentials (change if you used something else)
 DB_NAME = os.getenv("DB_NAME", "pwned")
 DB_USER = os.getenv("DB_USER", "pwned_user")
@@ -11,34 +32,718 @@ DB_PASS = os.getenv("DB_PASS", "P@ssw0rd512")
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
-def get_conn():
+# Connection pool used by the API lookups
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "16"))
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT", "2.0"))  # seconds
+
+# Lookup engine: "postgres" (hashes table) or "mmap" (sorted file built by
+# `python3 mmap_store.py build`, shared read-only by all workers on a host)
+LOOKUP_BACKEND = os.getenv("LOOKUP_BACKEND", "postgres")
+HASH_STORE_PATH = os.getenv("HASH_STORE_PATH", "data/pwned.store")
+
+# Optional membership filter (bloom_filter.py); empty disables it. Importers
+# rebuild it after a merge when set.
+BLOOM_FILTER_PATH = os.getenv("BLOOM_FILTER_PATH", "")
+
+# Optional hot set (hot_set.py): the HOT_SET_SIZE highest-count hashes,
+# checked before the cache and the backend; empty disables it. Importers
+# rebuild it after an import when set.
+HOT_SET_PATH = os.getenv("HOT_SET_PATH", "")
+
+# Storage layout of the `hashes` table:
+#   text    - sha1 CHAR(40) PRIMARY KEY, count BIGINT   (original layout)
+#   compact - sha1 BYTEA (20-byte digest) PRIMARY KEY, count INTEGER
+#   auto    - detect from the existing table (text if it does not exist yet)
+HASHES_LAYOUT = os.getenv("HASHES_LAYOUT", "auto")
+LAYOUTS = ("text", "compact")
+
+# Optional RANGE partitioning of `hashes` on the leading hex digits of the
+# key: 16 (one digit) or 256 (two digits) partitions named hashes_p<hex>.
+# 0 keeps a single table. Only used when a table is created; importers
+# follow whatever the existing table has.
+HASHES_PARTITIONS = int(os.getenv("HASHES_PARTITIONS", "0"))
+PARTITION_DIGITS = {16: 1, 256: 2}
+if HASHES_PARTITIONS and HASHES_PARTITIONS not in PARTITION_DIGITS:
+    print(f"⚠️ HASHES_PARTITIONS={HASHES_PARTITIONS} not supported (use 16 or 256); not partitioning")
+    HASHES_PARTITIONS = 0
+
+LOOKUP_STATEMENT = "lookup_hash"
+RANGE_STATEMENT = "range_hashes"
+LOOKUP_MANY_STATEMENT = "lookup_many_hashes"
+LOOKUP_DIGESTS_STATEMENT = "lookup_digests"
+DIGEST_LEN = 20
+DIGEST_CHUNK = int(os.getenv("DIGEST_CHUNK", "10000"))  # digests per packed-buffer query
+MAX_PACKED_COUNT = 0xFFFFFFFF
+LOOKUP_MANY_CHUNK = int(os.getenv("LOOKUP_MANY_CHUNK", "1000"))  # keys per = ANY(...) query
+
+# Optional warm-up of the hashes primary key before /readyz reports ready:
+#   off   - nothing
+#   probe - PREWARM_PROBES lookups spread evenly over the key space; they pull
+#           the root and inner B-tree pages every lookup walks into the cache
+#   full  - pg_prewarm every primary-key index of hashes (needs the pg_prewarm
+#           extension and an index that fits in memory)
+PREWARM_INDEX = os.getenv("PREWARM_INDEX", "off")
+PREWARM_PROBES = int(os.getenv("PREWARM_PROBES", "4096"))
+RANGE_PREFIX_LEN = 5
+
+def connect_to(host: str, port: str, **kwargs):
     return psycopg2.connect(
         dbname=DB_NAME,
         user=DB_USER,
         password=DB_PASS,
-        host=DB_HOST,
-        port=DB_PORT
+        host=host,
+        port=port,
+        **kwargs
     )
 
+def get_conn():
+    """Connection to the primary (imports, schema changes)."""
+    return connect_to(DB_HOST, DB_PORT)
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the acquire timeout."""
+
+class ConnectionPool:
+    """
+    Thread-safe psycopg2 connection pool with min/max size and acquire timeouts.
+
+    Connections are opened lazily up to max_size, kept in autocommit mode and
+    prepared once (see prepare_lookup) so every request skips the TCP/auth
+    handshake and the parse/plan step of the lookup query.
+    """
+
+    def __init__(self, min_size: int, max_size: int, acquire_timeout: float,
+                 connect=get_conn, on_connect=None):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.acquire_timeout = acquire_timeout
+        self._connect = connect
+        self._on_connect = on_connect
+        self._cond = threading.Condition()
+        self._idle: list = []
+        self._size = 0       # open connections (idle + in use + being opened)
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._generation = 0  # bumped by recycle(); older connections are retired
+        self._conn_generation: Dict[int, int] = {}
+        # counters for sizing the pool
+        self._acquired = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _open(self):
+        with request_timing.phase("db_connect"):
+            conn = self._connect()
+        try:
+            conn.autocommit = True
+            if self._on_connect is not None:
+                self._on_connect(conn)
+        except Exception:
+            conn.close()
+            raise
+        with self._cond:
+            self._conn_generation[id(conn)] = self._generation
+        return conn
+
+    def warm(self) -> int:
+        """Open connections until min_size is reached. Returns the pool size."""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return self._size
+                self._size += 1
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                raise
+            with self._cond:
+                self._idle.append(conn)
+                self._cond.notify()
+
+    def getconn(self, timeout: Optional[float] = None):
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.perf_counter()
+        deadline = started + timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                if self._idle:
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # reserve a slot, open outside the lock
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(f"no database connection available within {timeout:.2f}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._open()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+
+        waited = time.perf_counter() - started
+        with self._cond:
+            self._acquired += 1
+            self._wait_total += waited
+            if waited > self._wait_max:
+                self._wait_max = waited
+        return conn
+
+    def putconn(self, conn, discard: bool = False):
+        with self._cond:
+            self._in_use -= 1
+            stale = self._conn_generation.get(id(conn)) != self._generation
+            if discard or stale or self._closed or conn.closed:
+                self._conn_generation.pop(id(conn), None)
+                self._size -= 1
+                self._discarded += 1
+            else:
+                self._idle.append(conn)
+                conn = None
+            self._cond.notify()
+        if conn is not None and not conn.closed:
+            conn.close()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except psycopg2.Error as e:
+            # broken socket / server restart: never hand this one out again
+            self.putconn(conn, discard=connection_broken(conn, e))
+            raise
+        except Exception:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def run(self, fn: Callable, timeout: Optional[float] = None):
+        """fn(conn) on a pooled connection; returns its result."""
+        with self.connection(timeout) as conn:
+            return fn(conn)
+
+    def recycle(self):
+        """
+        Retire every connection (idle ones now, busy ones when returned), so
+        new connections re-run on_connect, e.g. after the hashes table changed.
+        """
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            for conn in idle:
+                self._conn_generation.pop(id(conn), None)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            acquired = self._acquired
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "acquired": acquired,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "wait_time_total_s": round(self._wait_total, 6),
+                "wait_time_avg_ms": round(self._wait_total / acquired * 1000, 3) if acquired else 0.0,
+                "wait_time_max_ms": round(self._wait_max * 1000, 3),
+            }
+
+def hashes_table_ddl(layout: str, table: str = "hashes", primary_key: bool = True,
+                     partitions: int = HASHES_PARTITIONS) -> str:
+    """
+    CREATE TABLE statement for the given layout (a single primary-key index).
+    primary_key=False gives the bare heap for index-last bulk builds.
+    partitions > 0 also creates the <table>_p<hex> partitions.
+    """
+    pk = " PRIMARY KEY" if primary_key else " NOT NULL"
+    partition_by = " PARTITION BY RANGE (sha1)" if partitions else ""
+    if layout == "compact":
+        ddl = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            sha1 BYTEA{pk},
+            count INTEGER NOT NULL
+        ){partition_by};
+        """
+    else:
+        ddl = f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            sha1 CHAR(40){pk},
+            count BIGINT NOT NULL
+        ){partition_by};
+        """
+    if partitions:
+        # skipped when an existing table was created without partitions
+        ddl += (f"DO $$BEGIN IF EXISTS (SELECT 1 FROM pg_partitioned_table "
+                f"WHERE partrelid = to_regclass('{table}')) THEN\n"
+                f"{partitions_ddl(layout, table, partitions)}\nEND IF; END$$;")
+    return ddl
+
+def partition_prefixes(partitions: int) -> List[str]:
+    digits = PARTITION_DIGITS[partitions]
+    return [f"{i:0{digits}X}" for i in range(partitions)]
+
+def partition_name(table: str, prefix_upper: str) -> str:
+    return f"{table}_p{prefix_upper.lower()}"
+
+def _partition_bound(layout: str, prefix_upper: str) -> str:
+    if layout == "compact":
+        return "'\\x" + prefix_upper.ljust(2 * ((len(prefix_upper) + 1) // 2), "0") + "'"
+    return f"'{prefix_upper}'"
+
+def partitions_ddl(layout: str, table: str, partitions: int, unlogged: bool = False) -> str:
+    """
+    One RANGE partition per leading-hex prefix. The outer partitions are
+    open-ended (MINVALUE/MAXVALUE) so no key can ever fail routing.
+    """
+    prefixes = partition_prefixes(partitions)
+    kind = "UNLOGGED TABLE" if unlogged else "TABLE"
+    ddl = []
+    for i, prefix in enumerate(prefixes):
+        lo = "MINVALUE" if i == 0 else _partition_bound(layout, prefix)
+        hi = "MAXVALUE" if i == len(prefixes) - 1 else _partition_bound(layout, prefixes[i + 1])
+        ddl.append(f"CREATE {kind} IF NOT EXISTS {partition_name(table, prefix)} "
+                   f"PARTITION OF {table} FOR VALUES FROM ({lo}) TO ({hi});")
+    return "\n".join(ddl)
+
+def table_partitions(cur, table: str = "hashes") -> List[Tuple[str, str]]:
+    """(partition table, hex prefix) of a partitioned table; [] for a plain one."""
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname;
+    """, (table,))
+    return [(name, name.rsplit("_p", 1)[1].upper()) for (name,) in cur.fetchall()]
+
+def detect_layout(cur, table: str = "hashes") -> str:
+    """
+    Resolve HASHES_LAYOUT. With 'auto' the type of <table>.sha1 decides;
+    a missing table counts as 'text' so nothing changes unless opted in.
+    """
+    if HASHES_LAYOUT in LAYOUTS:
+        return HASHES_LAYOUT
+    return table_layout(cur, table)
+
+def table_layout(cur, table: str = "hashes") -> str:
+    """Layout of an existing table, ignoring HASHES_LAYOUT."""
+    cur.execute("""
+        SELECT format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(%s) AND a.attname = 'sha1' AND NOT a.attisdropped;
+    """, (table,))
+    row = cur.fetchone()
+    return "compact" if row and row[0] == "bytea" else "text"
+
+def key_sql_type(layout: str) -> str:
+    return "bytea" if layout == "compact" else "char(40)"
+
+def key_from_text_sql(layout: str, column: str = "sha1") -> str:
+    """SQL expression turning a hex CHAR(40) staging column into the table key."""
+    return f"decode({column}, 'hex')" if layout == "compact" else column
+
+_HEX_DIGITS = frozenset("0123456789ABCDEF")
+
+def is_sha1_hex(sha1_hex_upper: str) -> bool:
+    """40 upper-case hex digits: the only keys the lookup paths (and bytes.fromhex) accept."""
+    return len(sha1_hex_upper) == 40 and _HEX_DIGITS.issuperset(sha1_hex_upper)
+
+def key_param(layout: str, sha1_hex_upper: str):
+    return psycopg2.Binary(bytes.fromhex(sha1_hex_upper)) if layout == "compact" else sha1_hex_upper
+
+def key_to_hex(layout: str, value) -> str:
+    return bytes(value).hex().upper() if layout == "compact" else value
+
+_layout: Optional[str] = None
+
+def get_layout() -> str:
+    """Layout the API is serving (resolved when the first pooled connection opens)."""
+    return _layout or (HASHES_LAYOUT if HASHES_LAYOUT in LAYOUTS else "text")
+
+def prepare_lookup(conn):
+    """Server-side prepared statements for the hot queries (once per connection)."""
+    global _layout
+    with conn.cursor() as cur:
+        layout = _layout = detect_layout(cur)
+        ktype = key_sql_type(layout)
+        cur.execute(f"PREPARE {LOOKUP_STATEMENT} ({ktype}) AS SELECT count FROM hashes WHERE sha1 = $1;")
+        cur.execute(f"PREPARE {LOOKUP_MANY_STATEMENT} ({ktype}[]) AS "
+                    "SELECT sha1, count FROM hashes WHERE sha1 = ANY($1);")
+        # one bytea of concatenated raw digests in, (position, count) of the hits out
+        digest_at = "substring($1 FROM q.i * 20 + 1 FOR 20)"
+        key = digest_at if layout == "compact" else f"upper(encode({digest_at}, 'hex'))"
+        cur.execute(f"""
+            PREPARE {LOOKUP_DIGESTS_STATEMENT} (bytea, int) AS
+            SELECT q.i, h.count FROM generate_series(0, $2 - 1) AS q(i)
+            JOIN hashes h ON h.sha1 = {key};
+        """)
+        # half-open key range -> plain B-tree range scan on the primary key
+        cur.execute(f"""
+            PREPARE {RANGE_STATEMENT} ({ktype}, {ktype}) AS
+            SELECT sha1, count FROM hashes WHERE sha1 >= $1 AND sha1 < $2 ORDER BY sha1;
+        """)
+
+_pool: Optional[ConnectionPool] = None  # or a ReadRouter over DB_READ_HOSTS
+_pool_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _make_pool(connect, min_size: int) -> ConnectionPool:
+    return ConnectionPool(min_size, POOL_MAX_SIZE, POOL_ACQUIRE_TIMEOUT, connect=connect,
+                          on_connect=prepare_lookup)
+
+def get_pool() -> ConnectionPool:
+    global _pool, _executor
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                hosts = parse_hosts(DB_READ_HOSTS, DB_PORT)
+                _executor = ThreadPoolExecutor(max_workers=max(4, POOL_MAX_SIZE * 2 * max(1, len(hosts))),
+                                               thread_name_prefix="db-lookup")
+                if hosts:
+                    _pool = ReadRouter(hosts, (DB_HOST, DB_PORT), _make_pool, connect_to, POOL_MIN_SIZE)
+                else:
+                    _pool = _make_pool(get_conn, POOL_MIN_SIZE)
+    return _pool
+
+def _primary_pool() -> ConnectionPool:
+    """The primary's pool: the only one without DB_READ_HOSTS."""
+    pool = get_pool()
+    return pool.primary.pool if isinstance(pool, ReadRouter) else pool
+
+def close_pool():
+    global _pool, _executor
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+def pool_stats() -> Dict:
+    return _pool.stats() if _pool is not None else {}
+
+def _pooled(op: str, fn: Callable):
+    """
+    Read-only fn(conn) on a pooled connection, returning its result; time to
+    acquire it and time holding it go to /metrics per op. With read
+    replicas, fn runs once more on another endpoint after a connection error.
+    """
+    started = time.perf_counter()
+
+    def timed(conn):
+        nonlocal started
+        acquired = time.perf_counter()
+        DB_ACQUIRE.observe(acquired - started, op)
+        try:
+            return fn(conn)
+        finally:
+            done = time.perf_counter()
+            DB_QUERY.observe(done - acquired, op)
+            timings = request_timing.current()
+            if timings is not None:
+                timings.add("db_acquire", acquired - started)
+                timings.add("db_query", done - acquired)
+            started = done  # a retry's wait starts here
+
+    return get_pool().run(timed)
+
+_store: Optional[HashStore] = None
+_store_lock = threading.Lock()
+
+def get_store() -> HashStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = HashStore(HASH_STORE_PATH)
+    return _store
+
+def reload_store():
+    """
+    Reopen HASH_STORE_PATH if it was replaced by a new build. The old mapping
+    is left to the garbage collector so in-flight range streams can finish.
+    """
+    global _store
+    with _store_lock:
+        if _store is not None and _store.is_stale():
+            _store = HashStore(HASH_STORE_PATH)
+
+_filter: Optional[BloomFilter] = None
+
+def load_filter(version: Optional[int] = None) -> Optional[BloomFilter]:
+    """
+    Map BLOOM_FILTER_PATH (if configured and present). Called at startup and
+    on dataset changes. A filter built for another dataset_version (Postgres;
+    `version`, read from the primary when None) or another store file (mmap)
+    is left unused: it could answer hashes of the data served as misses.
+    """
+    global _filter
+    if BLOOM_FILTER_PATH and os.path.exists(BLOOM_FILTER_PATH):
+        if _filter is None or _filter.is_stale():
+            _filter = BloomFilter(BLOOM_FILTER_PATH)
+        if uses_postgres():
+            expected = get_dataset_version() if version is None else version
+            serving = f"dataset version {expected}"
+        else:
+            expected = store_source(get_store().built_at)
+            serving = f"{HASH_STORE_PATH} (built_at {get_store().built_at})"
+        if _filter.source != expected:
+            print(f"⚠️ Bloom filter {BLOOM_FILTER_PATH} (source {_filter.source}) was not built "
+                  f"for {serving}; lookups skip it until it is rebuilt")
+            _filter = None
+    return _filter
+
+def filter_stats() -> Dict:
+    return _filter.stats() if _filter is not None else {"enabled": False}
+
+def rebuild_bloom_filter(conn, path: str = BLOOM_FILTER_PATH, fpr: float = DEFAULT_FPR,
+                         table: str = "hashes", version: Optional[int] = None,
+                         commit: bool = True) -> int:
+    """
+    Rebuild the filter file from the hashes (or a shadow) table, server-side
+    cursor scan. It is stamped with `version`, the dataset_version it will
+    serve (default: the current one); the API ignores it under any other.
+    commit=False leaves the caller's transaction (and its writes) open.
+    """
+    with conn.cursor() as cur:
+        if version is None:
+            version = read_dataset_version(cur)
+        layout = table_layout(cur, table)
+        # a partitioned parent has no reltuples of its own: sum its partitions
+        cur.execute("""
+            SELECT coalesce(sum(greatest(reltuples, 0)), 0)::bigint FROM pg_class
+            WHERE oid = to_regclass(%s)
+               OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = to_regclass(%s));
+        """, (table, table))
+        items = int(cur.fetchone()[0])
+        if items <= 0:
+            cur.execute(f"SELECT count(*) FROM {table};")
+            items = int(cur.fetchone()[0])
+    cur = conn.cursor(name="bloom_scan")
+    cur.itersize = 100_000
+    try:
+        cur.execute(f"SELECT sha1 FROM {table};")
+        if layout == "compact":
+            digests = (bytes(row[0]) for row in cur)
+        else:
+            digests = (bytes.fromhex(row[0]) for row in cur)
+        # reltuples is an estimate; leave headroom so the FPR holds
+        return build_from_digests(digests, int(items * 1.05), path, fpr, version)
+    finally:
+        cur.close()
+        if commit:
+            conn.commit()
+
+_hot_set: Optional[HotSet] = None
+
+def load_hot_set() -> Optional[HotSet]:
+    """Map and pre-read HOT_SET_PATH (if configured and present). Called at startup."""
+    global _hot_set
+    if HOT_SET_PATH and os.path.exists(HOT_SET_PATH):
+        if _hot_set is None or _hot_set.is_stale():
+            _hot_set = HotSet(HOT_SET_PATH)
+    return _hot_set
+
+def hot_set_stats() -> Dict:
+    return _hot_set.stats() if _hot_set is not None else {"enabled": False}
+
+def rebuild_hot_set(conn, path: str = HOT_SET_PATH, size: int = HOT_SET_SIZE,
+                    table: str = "hashes", commit: bool = True) -> int:
+    """Rebuild the hot set file from the top `size` rows by count (a top-N sort in Postgres)."""
+    with conn.cursor() as cur:
+        layout = table_layout(cur, table)
+        cur.execute(f"SELECT sha1, count FROM {table} ORDER BY count DESC LIMIT %s;", (size,))
+        rows = cur.fetchall()
+    if commit:
+        conn.commit()
+    if layout == "compact":
+        records = ((bytes(sha1), min(int(count), MAX_PACKED_COUNT)) for sha1, count in rows)
+    else:
+        records = ((bytes.fromhex(sha1), min(int(count), MAX_PACKED_COUNT)) for sha1, count in rows)
+    return write_hot_set(records, path, size)
+
+def uses_postgres() -> bool:
+    return LOOKUP_BACKEND != "mmap"
+
+def warm_backend():
+    """Open DB_POOL_MIN_SIZE connections, or map the store file."""
+    if uses_postgres():
+        get_pool().warm()
+    else:
+        get_store()
+
+def prewarm_index(mode: str = PREWARM_INDEX) -> Dict:
+    """Warm the lookup index (see PREWARM_INDEX). Returns what was done."""
+    if mode == "off" or not uses_postgres():
+        return {"mode": "off"}
+    if mode == "probe":
+        keys = [f"{i * (1 << 160) // PREWARM_PROBES:040X}" for i in range(PREWARM_PROBES)]
+        _db_lookup_many(keys)
+        return {"mode": "probe", "probes": len(keys)}
+    if mode != "full":
+        raise ValueError(f"PREWARM_INDEX must be off, probe or full, not {mode!r}")
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm';")
+            if cur.fetchone() is None:
+                print("⚠️ PREWARM_INDEX=full needs CREATE EXTENSION pg_prewarm; skipping")
+                return {"mode": "full", "error": "pg_prewarm extension not installed"}
+            # partitioned parents have no storage of their own; their partitions' indexes do
+            cur.execute("""
+                SELECT i.indexrelid::regclass::text, pg_prewarm(i.indexrelid)
+                FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE i.indisprimary AND c.relkind = 'i'
+                  AND i.indrelid IN (SELECT 'hashes'::regclass
+                                     UNION ALL
+                                     SELECT inhrelid FROM pg_inherits
+                                     WHERE inhparent = 'hashes'::regclass);
+            """)
+            rows = cur.fetchall()
+    return {"mode": "full", "indexes": len(rows), "blocks": sum(int(r[1]) for r in rows)}
+
+def backend_stats() -> Dict:
+    if uses_postgres():
+        return {"engine": "postgres", "layout": get_layout(), "pool": pool_stats()}
+    return {"engine": "mmap", **(_store.info() if _store is not None else {})}
+
+async def _run_backend(fn, *args):
+    # Postgres calls block on the network, so they go to the DB thread pool.
+    # mmap lookups are a bisect over shared pages and run inline on the loop.
+    if not uses_postgres():
+        return fn(*args)
+    get_pool()
+    loop = asyncio.get_running_loop()
+    # carry the request's context (request_timing) onto the DB thread
+    return await loop.run_in_executor(_executor, contextvars.copy_context().run, fn, *args)
+
 def init_db():
     """
     Ensure the main table exists. Call at startup.
-    """
-    sql = """
-    CREATE TABLE IF NOT EXISTS hashes (
-        sha1 CHAR(40) PRIMARY KEY,
-        count BIGINT NOT NULL
-    );
-    CREATE INDEX IF NOT EXISTS idx_hashes_sha1 ON hashes(sha1);
+    The primary key is the only index; HASHES_LAYOUT=compact creates the
+    binary-digest layout for a fresh database.
     """
     conn = get_conn()
     try:
         with conn.cursor() as cur:
-            cur.execute(sql)
+            cur.execute(hashes_table_ddl(detect_layout(cur)))
+            cur.execute(DATASET_VERSION_DDL)
             conn.commit()
     finally:
         conn.close()
 
+# Single-row table bumped by the importers when an import finishes; the API
+# polls it to invalidate caches (and anything else derived from `hashes`).
+DATASET_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS dataset_version (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL,
+    label TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+def read_dataset_version(cur) -> int:
+    """dataset_version as recorded on this connection (0 before the first import)."""
+    cur.execute(DATASET_VERSION_DDL)
+    cur.execute("SELECT version FROM dataset_version WHERE id = 1;")
+    row = cur.fetchone()
+    return int(row[0]) if row else 0
+
+def mark_dataset_imported(cur, label: Optional[str] = None) -> int:
+    """
+    Bump the dataset version after an import finished. Caller commits.
+    Returns the new version.
+    """
+    cur.execute(DATASET_VERSION_DDL)
+    cur.execute("""
+        INSERT INTO dataset_version (id, version, label) VALUES (1, 1, %s)
+        ON CONFLICT (id) DO UPDATE
+          SET version = dataset_version.version + 1, label = EXCLUDED.label, updated_at = now()
+        RETURNING version;
+    """, (label,))
+    return int(cur.fetchone()[0])
+
+def get_dataset_version() -> int:
+    """Current dataset version (0 if no import has been recorded yet)."""
+    return get_dataset_info()["version"]
+
+def get_dataset_info() -> Dict:
+    """Version, label and update time of the dataset being served."""
+    if not uses_postgres():
+        return {"version": read_store_version(HASH_STORE_PATH), "label": HASH_STORE_PATH,
+                "updated_at": None}
+    # replicas may still be replaying an import; the primary's version is authoritative
+    with _primary_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('dataset_version') IS NOT NULL;")
+            if not cur.fetchone()[0]:
+                return {"version": 0, "label": None, "updated_at": None}
+            cur.execute("SELECT version, label, updated_at FROM dataset_version WHERE id = 1;")
+            row = cur.fetchone()
+            if not row:
+                return {"version": 0, "label": None, "updated_at": None}
+            return {"version": int(row[0]), "label": row[1],
+                    "updated_at": row[2].isoformat() if row[2] else None}
+
+def invalidate_caches(version: Optional[int] = None):
+    """
+    Drop everything derived from the previous dataset version: cached
+    lookups, and pooled connections whose prepared statements were planned
+    against the old table (and layout). With read replicas, the ones not yet
+    on `version` are skipped until they have replayed it.
+    """
+    global _layout
+    if cache is not None:
+        cache.clear()
+    if not uses_postgres():
+        reload_store()  # before the filter, which must match the store now served
+    load_filter(version)
+    load_hot_set()
+    if uses_postgres() and _pool is not None:
+        _layout = None
+        if version is not None and isinstance(_pool, ReadRouter):
+            _pool.require_version(version)
+        _pool.recycle()
+
+def cache_stats() -> Dict:
+    return cache.stats() if cache is not None else {"enabled": False}
+
 def load_hash_file(path) -> int:
     """
     Legacy placeholder: no in-memory loading. Return 0.
@@ -46,15 +751,343 @@ def load_hash_file(path) -> int:
     """
     return 0
 
-def lookup(sha1_hex_upper: str) -> int:
-    """
-    Query Postgres for a SHA1 hash count. Returns integer count or 0.
-    """
-    conn = get_conn()
-    try:
+def _backend_lookup(sha1_hex_upper: str) -> int:
+    if _filter is not None and not _filter.might_contain_hex(sha1_hex_upper):
+        return 0  # definite miss
+    if not uses_postgres():
+        return get_store().lookup_hex(sha1_hex_upper)
+    return _db_lookup(sha1_hex_upper)
+
+def _backend_lookup_many(sha1s: Sequence[str]) -> Dict[str, int]:
+    if _filter is not None:
+        sha1s = [h for h in sha1s if _filter.might_contain_hex(h)]
+        if not sha1s:
+            return {}
+    if not uses_postgres():
+        return get_store().lookup_many_hex(sha1s)
+    return _db_lookup_many(sha1s)
+
+def _db_lookup(sha1_hex_upper: str) -> int:
+    def query(conn) -> int:
         with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT count FROM hashes WHERE sha1 = %s;", (sha1_hex_upper,))
+            cur.execute(f"EXECUTE {LOOKUP_STATEMENT} (%s);", (key_param(get_layout(), sha1_hex_upper),))
             row = cur.fetchone()
             return int(row["count"]) if row else 0
-    finally:
-        conn.close()
+    return _pooled("lookup", query)
+
+_PLAN_FIELDS = ("Node Type", "Relation Name", "Index Name", "Actual Total Time", "Actual Rows",
+                "Actual Loops", "Shared Hit Blocks", "Shared Read Blocks")
+
+def explain_lookup(sha1_hex_upper: str) -> Dict:
+    """
+    EXPLAIN (ANALYZE, BUFFERS) of the prepared single-hash lookup, summarized
+    per plan node for the slow-request log (request_timing.py).
+    """
+    if not uses_postgres():
+        return {"engine": "mmap"}
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) EXECUTE {LOOKUP_STATEMENT} (%s);",
+                        (key_param(get_layout(), sha1_hex_upper),))
+            plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    top = plan[0]
+    nodes, stack = [], [top["Plan"]]
+    while stack:
+        node = stack.pop()
+        nodes.append({k: node[k] for k in _PLAN_FIELDS if k in node})
+        stack.extend(reversed(node.get("Plans", [])))
+    return {"planning_ms": top.get("Planning Time"), "execution_ms": top.get("Execution Time"),
+            "nodes": nodes}
+
+def lookup(sha1_hex_upper: str) -> int:
+    """
+    Look up a SHA1 hash count. Returns integer count or 0.
+    Answers from the lookup cache when possible, otherwise asks the
+    configured engine (LOOKUP_BACKEND): Postgres through a pooled connection
+    and the prepared lookup statement, or the mmap store.
+    Anything but 40 upper-case hex digits is not a stored hash: 0.
+    """
+    if not is_sha1_hex(sha1_hex_upper):
+        return 0
+    if _hot_set is not None:
+        count = _hot_set.get_hex(sha1_hex_upper)
+        if count:
+            LOOKUPS.inc("hot_set", "found")
+            return count
+    if cache is not None:
+        cached = cache.get(sha1_hex_upper)
+        if cached is not None:
+            LOOKUPS.inc("cache", "found" if cached else "not_found")
+            return cached
+    count = _backend_lookup(sha1_hex_upper)
+    LOOKUPS.inc("backend", "found" if count else "not_found")
+    if cache is not None:
+        cache.put(sha1_hex_upper, count)
+    return count
+
+_coalescer: Optional[LookupCoalescer] = None
+
+async def _coalesced_fetch(sha1s: List[str], priority: int) -> Dict[str, int]:
+    # one admission per backend batch, charged by its size (not per waiter)
+    async with _admitted(priority, admission.cost_for(len(sha1s))):
+        return await _run_backend(_backend_lookup_many, sha1s)
+
+def _get_coalescer() -> Optional[LookupCoalescer]:
+    # only worth it when each backend call is a network round trip
+    global _coalescer
+    if not COALESCE_ENABLED or not uses_postgres():
+        return None
+    if _coalescer is None:
+        _coalescer = LookupCoalescer(_coalesced_fetch)
+    return _coalescer
+
+def admission_stats() -> Dict:
+    return admission.limiter.stats() if admission.limiter is not None else {"enabled": False}
+
+def coalescer_stats() -> Dict:
+    return _coalescer.stats() if _coalescer is not None else {"enabled": False}
+
+def _metrics_samples():
+    """Pool, cache and coalescer counters for /metrics, read at scrape time."""
+    samples = []
+    if _pool is not None:
+        pool = _pool.stats()
+        for field in ("size", "in_use", "idle", "waiting"):
+            samples.append((f"pwned_db_pool_{field}", "gauge", f"Connection pool {field}", (), (),
+                            pool[field]))
+        for field in ("acquired", "timeouts", "discarded"):
+            samples.append((f"pwned_db_pool_{field}_total", "counter", f"Connection pool {field}",
+                            (), (), pool[field]))
+        for ep in pool.get("endpoints", ()):
+            name = (ep["endpoint"],)
+            samples += [
+                ("pwned_db_endpoint_up", "gauge", "Read endpoint eligible for lookups (1) or not (0)",
+                 ("endpoint",), name, 1 if ep["state"] == "ok" else 0),
+                ("pwned_db_endpoint_outstanding", "gauge", "Connections handed out per read endpoint",
+                 ("endpoint",), name, ep["outstanding"]),
+                ("pwned_db_endpoint_lag_seconds", "gauge", "Replay lag at the last health check",
+                 ("endpoint",), name, ep["lag_s"] or 0),
+                ("pwned_db_endpoint_routed_total", "counter", "Connections routed per read endpoint",
+                 ("endpoint",), name, ep["routed"]),
+                ("pwned_db_endpoint_ejections_total", "counter", "Read endpoint ejections",
+                 ("endpoint",), name, ep["ejections"]),
+            ]
+    if _hot_set is not None:
+        samples.append(("pwned_hot_set_entries", "gauge", "Hashes in the hot set", (), (),
+                        _hot_set.store.record_count))
+        for field in ("checks", "hits"):
+            samples.append((f"pwned_hot_set_{field}_total", "counter", f"Hot set {field}", (), (),
+                            getattr(_hot_set, field)))
+    if cache is not None:
+        stats = cache.stats()
+        samples.append(("pwned_cache_entries", "gauge", "Lookup cache entries", (), (), stats["entries"]))
+        for field in ("hits", "negative_hits", "misses", "evictions"):
+            samples.append((f"pwned_cache_{field}_total", "counter", f"Lookup cache {field}", (), (),
+                            stats[field]))
+    if _coalescer is not None:
+        for field in ("lookups", "shared", "batches"):
+            samples.append((f"pwned_coalescer_{field}_total", "counter", f"Coalescer {field}", (), (),
+                            getattr(_coalescer, field)))
+    return samples
+
+register_collector(_metrics_samples)
+
+def _admitted(priority: int = 1, cost: int = 1):
+    """Admission slot for a Postgres call (see admission.py); mmap lookups need none."""
+    limiter = admission.limiter if uses_postgres() else None
+    return limiter.slot(priority, cost) if limiter is not None else nullcontext()
+
+async def lookup_async(sha1_hex_upper: str, priority: int = 1) -> int:
+    """
+    Non-blocking lookup for the async handlers. Cache hits are answered on the
+    event loop; Postgres lookups go through the coalescer (identical keys
+    share one query, concurrent distinct keys are batched) and run on the DB
+    thread pool so the loop keeps serving while the database answers.
+    Postgres lookups pass admission control (admission.py; once per coalesced
+    batch) and may raise Overloaded; lower `priority` values are admitted first.
+    """
+    if not is_sha1_hex(sha1_hex_upper):
+        return 0
+    timings = request_timing.current()
+    if timings is not None:
+        timings.key = sha1_hex_upper
+    if _hot_set is not None:
+        count = _hot_set.get_hex(sha1_hex_upper)
+        if count:
+            LOOKUPS.inc("hot_set", "found")
+            if timings is not None:
+                timings.source = "hot_set"
+            return count
+    if cache is not None:
+        cached = cache.get(sha1_hex_upper)
+        if cached is not None:
+            LOOKUPS.inc("cache", "found" if cached else "not_found")
+            if timings is not None:
+                timings.source = "cache"
+            return cached
+    if _filter is not None and not _filter.might_contain_hex(sha1_hex_upper):
+        LOOKUPS.inc("filter", "not_found")
+        if timings is not None:
+            timings.source = "filter"
+        return 0  # definite miss, answered without leaving the loop
+    coalescer = _get_coalescer()
+    if coalescer is not None:
+        with request_timing.phase("lookup"):
+            # coalesced batches pass admission and run outside any one request:
+            # lookup is the whole wait
+            count = await coalescer.lookup(sha1_hex_upper, priority)
+    else:
+        async with _admitted(priority):
+            with request_timing.phase("lookup"):
+                count = await _run_backend(_backend_lookup, sha1_hex_upper)
+    if timings is not None:
+        timings.source = "backend"
+    LOOKUPS.inc("backend", "found" if count else "not_found")
+    if cache is not None:
+        cache.put(sha1_hex_upper, count)
+    return count
+
+def lookup_many(sha1s: Sequence[str]) -> Dict[str, int]:
+    """
+    Set-based lookup for many upper-case SHA1 hex strings.
+    Hot-set and cached keys are answered directly; the rest run as one `sha1 = ANY(...)`
+    index probe per LOOKUP_MANY_CHUNK keys on a single pooled connection.
+    Returns {sha1: count} for found hashes only (malformed keys are never found).
+    """
+    found: Dict[str, int] = {}
+    sha1s = [h for h in sha1s if is_sha1_hex(h)]
+    if _hot_set is not None:
+        pending = []
+        for h in sha1s:
+            count = _hot_set.get_hex(h)
+            if count:
+                found[h] = count
+            else:
+                pending.append(h)
+        sha1s = pending
+    if cache is not None:
+        pending = []
+        for h in sha1s:
+            cached = cache.get(h)
+            if cached is None:
+                pending.append(h)
+            elif cached:
+                found[h] = cached
+        sha1s = pending
+    if not sha1s:
+        return found
+    db_found = _backend_lookup_many(sha1s)
+    if cache is not None:
+        for h in sha1s:
+            cache.put(h, db_found.get(h, 0))
+    found.update(db_found)
+    return found
+
+def _db_lookup_many(sha1s: Sequence[str]) -> Dict[str, int]:
+    def query(conn) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        layout = get_layout()
+        with conn.cursor() as cur:
+            for i in range(0, len(sha1s), LOOKUP_MANY_CHUNK):
+                chunk: List = [key_param(layout, h) for h in sha1s[i:i + LOOKUP_MANY_CHUNK]]
+                cur.execute(f"EXECUTE {LOOKUP_MANY_STATEMENT} (%s);", (chunk,))
+                for sha1, count in cur:
+                    found[key_to_hex(layout, sha1)] = int(count)
+        return found
+    return _pooled("lookup_many", query)
+
+async def lookup_many_async(sha1s: Sequence[str], priority: int = 1) -> Dict[str, int]:
+    """lookup_many off the loop; Postgres calls pass admission by cost and may raise Overloaded."""
+    async with _admitted(priority, admission.cost_for(len(sha1s))):
+        return await _run_backend(lookup_many, sha1s)
+
+def lookup_digests(buf) -> array:
+    """
+    Counts for a buffer of concatenated raw 20-byte SHA1 digests, as an
+    array('I') in input order (0 = not found). The buffer is only ever
+    sliced through memoryviews: Postgres receives the packed bytes
+    DIGEST_CHUNK digests at a time and splits them server-side, so no hex
+    strings or per-hash parameters are built.
+    """
+    mv = memoryview(buf)
+    n = len(mv) // DIGEST_LEN
+    counts = array("I", bytes(4 * n))
+    if _filter is not None:
+        candidates = [i for i in range(n)
+                      if _filter.might_contain(mv[i * DIGEST_LEN:(i + 1) * DIGEST_LEN])]
+    else:
+        candidates = None
+    if not uses_postgres():
+        store = get_store()
+        for i in (range(n) if candidates is None else candidates):
+            counts[i] = min(store.lookup(mv[i * DIGEST_LEN:(i + 1) * DIGEST_LEN]), MAX_PACKED_COUNT)
+        return counts
+
+    def query(conn):
+        with conn.cursor() as cur:
+            if candidates is None:
+                for start in range(0, n, DIGEST_CHUNK):
+                    end = min(n, start + DIGEST_CHUNK)
+                    chunk = mv[start * DIGEST_LEN:end * DIGEST_LEN]
+                    cur.execute(f"EXECUTE {LOOKUP_DIGESTS_STATEMENT} (%s, %s);",
+                                (psycopg2.Binary(chunk), end - start))
+                    for i, count in cur:
+                        counts[start + i] = min(count, MAX_PACKED_COUNT)
+            else:
+                for start in range(0, len(candidates), DIGEST_CHUNK):
+                    idx = candidates[start:start + DIGEST_CHUNK]
+                    packed = b"".join(mv[i * DIGEST_LEN:(i + 1) * DIGEST_LEN] for i in idx)
+                    cur.execute(f"EXECUTE {LOOKUP_DIGESTS_STATEMENT} (%s, %s);",
+                                (psycopg2.Binary(packed), len(idx)))
+                    for j, count in cur:
+                        counts[idx[j]] = min(count, MAX_PACKED_COUNT)
+    _pooled("digests", query)  # a retry rewrites the same counts
+    return counts
+
+async def lookup_digests_async(buf, priority: int = 1) -> array:
+    async with _admitted(priority, admission.cost_for(len(buf) // DIGEST_LEN)):
+        return await _run_backend(lookup_digests, buf)
+
+def pack_counts(counts: array) -> bytes:
+    """Little-endian u32 wire encoding of lookup_digests() results."""
+    if sys.byteorder != "little":
+        counts = array("I", counts)
+        counts.byteswap()
+    return counts.tobytes()
+
+def prefix_bounds(layout: str, prefix_upper: str) -> Tuple:
+    """[lo, hi) key parameters covering every hash that starts with the prefix."""
+    if layout == "compact":
+        lo = bytes.fromhex(prefix_upper.ljust(40, "0"))
+        nxt = int(prefix_upper, 16) + 1
+        if nxt >> (4 * len(prefix_upper)):
+            hi = b"\xff" * 21  # past the last 20-byte digest
+        else:
+            hi = bytes.fromhex(f"{nxt:0{len(prefix_upper)}X}".ljust(40, "0"))
+        return psycopg2.Binary(lo), psycopg2.Binary(hi)
+    # every key in the range starts with the prefix; 'G' sorts after any hex digit
+    return prefix_upper.ljust(40, "0"), prefix_upper + "G"
+
+def range_query(prefix_upper: str) -> Iterator[Tuple[str, int]]:
+    """
+    Run the k-anonymity range query for a 5-char hex prefix.
+    Returns an iterator of (suffix, count). With Postgres the rows (a few
+    hundred per prefix) are fetched and the pooled connection returned
+    before the iterator is handed out, so a slow or vanished client never
+    holds a connection.
+    """
+    if not uses_postgres():
+        return ((h[RANGE_PREFIX_LEN:], c) for h, c in get_store().iter_prefix(prefix_upper))
+    def query(conn):
+        layout = get_layout()  # resolved once a pooled connection has opened
+        with conn.cursor() as cur:
+            cur.execute(f"EXECUTE {RANGE_STATEMENT} (%s, %s);", prefix_bounds(layout, prefix_upper))
+            return layout, cur.fetchall()
+    layout, rows = _pooled("range", query)
+    return ((key_to_hex(layout, sha1)[RANGE_PREFIX_LEN:], int(count)) for sha1, count in rows)
+
+async def range_query_async(prefix_upper: str, priority: int = 1) -> Iterator[Tuple[str, int]]:
+    async with _admitted(priority, admission.ADMISSION_RANGE_COST):
+        return await _run_backend(range_query, prefix_upper)
@@ -0,0 +1,301 @@
+# delta_import.py
+"""
+Apply a new HIBP release as a delta against the current 'hashes' table.
+
+Usage:
+    python3 delta_import.py /path/to/pwnedpasswords.txt[.gz|.xz|.zst|.7z] [--prune] [--dry-run]
+
+The input must be sorted by hash (the published files are). It is cut into
+buckets by the first BUCKET_HEX hex digits, and each bucket's normalized
+rows are hashed. import_manifest keeps those bucket digests from the last
+delta import, so:
+ - buckets whose digest is unchanged are skipped without touching Postgres
+ - changed buckets are COPYed into a temp table and upserted with
+   ON CONFLICT ... WHERE count IS DISTINCT FROM, so only new rows and rows
+   whose count changed are written (no dead tuples for unchanged rows)
+ - --prune also deletes rows of changed buckets that left the release
+
+Without a manifest that matches the current dataset_version (first run, or
+another importer ran since), every bucket counts as changed: the whole file
+is compared against the table, but writes still only cover real changes.
+Afterwards only ANALYZE runs; autovacuum cleans up in proportion to the
+rows that actually changed. The Bloom filter gets just the inserted
+digests, written before the changes commit.
+"""
+from __future__ import annotations
+import argparse
+import hashlib
+import os
+import sys
+import time
+from io import BytesIO
+from typing import Dict, Iterator, List, Tuple
+
+from db_loader import (
+    BLOOM_FILTER_PATH, detect_layout, get_conn,
+    HOT_SET_PATH, hashes_table_ddl, key_from_text_sql, key_sql_type, mark_dataset_imported,
+    prefix_bounds, read_dataset_version, rebuild_bloom_filter, rebuild_hot_set,
+)
+from bloom_filter import BloomFilter, FilterFormatError, add_to_filter
+from importer_common import CHUNK_BYTES, iter_chunks, open_input, parse_chunk
+
+BUCKET_HEX = 3  # 4096 buckets, ~250k rows each for the full corpus
+COPY_BUFFER_BYTES = 32 * 1024 * 1024
+
+IMPORT_MANIFEST_DDL = """
+CREATE TABLE IF NOT EXISTS import_manifest (
+    bucket TEXT PRIMARY KEY,
+    digest BYTEA NOT NULL,
+    rows BIGINT NOT NULL,
+    dataset_version BIGINT NOT NULL
+);
+"""
+
+class UnsortedInputError(Exception):
+    pass
+
+def iter_buckets(fh) -> Iterator[Tuple[str, bytes, int, List[bytes]]]:
+    """
+    Yield (prefix, digest, rows, parts) per bucket of a sorted input file.
+    parts are the bucket's rows as COPY text payload (upper-case hex, tab).
+    """
+    current, hasher, rows, parts = None, None, 0, []
+    for _, data in iter_chunks(fh, CHUNK_BYTES):
+        payload, _, _ = parse_chunk(data)
+        pos = 0
+        while pos < len(payload):
+            prefix = payload[pos:pos + BUCKET_HEX]
+            # sorted input: the bucket ends after the last line with this prefix
+            last = payload.rfind(b"\n" + prefix, pos)
+            end = payload.index(b"\n", last + 1 if last >= 0 else pos) + 1
+            if prefix != current:
+                if current is not None:
+                    if prefix < current:
+                        raise UnsortedInputError(
+                            f"bucket {prefix.decode()} after {current.decode()}: input is not sorted")
+                    yield current.decode(), hasher.digest(), rows, parts
+                current, hasher, rows, parts = prefix, hashlib.blake2b(digest_size=16), 0, []
+            piece = payload[pos:end]
+            hasher.update(piece)
+            rows += piece.count(b"\n")
+            parts.append(piece)
+            pos = end
+    if current is not None:
+        yield current.decode(), hasher.digest(), rows, parts
+
+def load_manifest(cur, version: int) -> Dict[str, bytes]:
+    """Bucket digests of the previous delta import, if they describe `version`."""
+    cur.execute(IMPORT_MANIFEST_DDL)
+    cur.execute("SELECT bucket, digest, dataset_version FROM import_manifest;")
+    rows = cur.fetchall()
+    if any(v != version for _, _, v in rows):
+        print(f"⚠️ Manifest does not match dataset version {version}; comparing every bucket.")
+        return {}
+    return {bucket: bytes(digest) for bucket, digest, _ in rows}
+
+def save_manifest(cur, manifest: Dict[str, Tuple[bytes, int]], version: int):
+    cur.execute("DELETE FROM import_manifest;")
+    lines = "".join(f"{bucket}\t\\\\x{digest.hex()}\t{rows}\t{version}\n"
+                    for bucket, (digest, rows) in sorted(manifest.items()))
+    cur.copy_expert("COPY import_manifest (bucket, digest, rows, dataset_version) FROM STDIN",
+                    BytesIO(lines.encode()))
+
+def create_delta_tables(cur, layout: str):
+    cur.execute("DROP TABLE IF EXISTS delta_raw, delta_rows, delta_buckets, delta_inserted;")
+    cur.execute("CREATE TEMP TABLE delta_raw (sha1 CHAR(40), count BIGINT);")
+    cur.execute(f"CREATE TEMP TABLE delta_buckets (lo {key_sql_type(layout)}, hi {key_sql_type(layout)});")
+    cur.execute(f"CREATE TEMP TABLE delta_inserted (sha1 {key_sql_type(layout)});")
+
+def stage_changed_buckets(cur, layout: str, path: str, old: Dict[str, bytes]):
+    """
+    Scan the input, COPY the rows of changed buckets into delta_raw.
+    Returns (new manifest, changed bucket prefixes, rows scanned).
+    """
+    manifest: Dict[str, Tuple[bytes, int]] = {}
+    changed: List[str] = []
+    buffer: List[bytes] = []
+    buffered = scanned = 0
+
+    def flush():
+        nonlocal buffer, buffered
+        if buffer:
+            cur.copy_expert("COPY delta_raw (sha1, count) FROM STDIN", BytesIO(b"".join(buffer)))
+            buffer, buffered = [], 0
+
+    with open_input(path) as fh:
+        for prefix, digest, rows, parts in iter_buckets(fh):
+            manifest[prefix] = (digest, rows)
+            scanned += rows
+            if old.get(prefix) != digest:
+                changed.append(prefix)
+                buffer.extend(parts)
+                buffered += sum(len(p) for p in parts)
+                if buffered >= COPY_BUFFER_BYTES:
+                    flush()
+            if len(manifest) % 256 == 0:
+                print(f"Progress: {len(manifest):,} buckets, {scanned:,} rows scanned, "
+                      f"{len(changed):,} buckets changed ({fh.progress()})")
+    flush()
+    # buckets that disappeared from the release entirely
+    changed.extend(sorted(set(old) - set(manifest)))
+
+    cur.executemany("INSERT INTO delta_buckets (lo, hi) VALUES (%s, %s);",
+                    [prefix_bounds(layout, prefix) for prefix in changed])
+    cur.execute(f"""
+        CREATE TEMP TABLE delta_rows AS
+        SELECT {key_from_text_sql(layout)} AS sha1, MAX(count) AS count
+        FROM delta_raw GROUP BY sha1;
+    """)
+    cur.execute("DROP TABLE delta_raw;")
+    cur.execute("ALTER TABLE delta_rows ADD PRIMARY KEY (sha1);")
+    cur.execute("ANALYZE delta_rows;")
+    return manifest, changed, scanned
+
+def count_changes(cur) -> Tuple[int, int]:
+    """(would insert, would update) without writing anything."""
+    cur.execute("""
+        SELECT count(*) FILTER (WHERE h.sha1 IS NULL),
+               count(*) FILTER (WHERE h.count IS DISTINCT FROM d.count AND h.sha1 IS NOT NULL)
+        FROM delta_rows d LEFT JOIN hashes h ON h.sha1 = d.sha1;
+    """)
+    inserted, updated = cur.fetchone()
+    return int(inserted), int(updated)
+
+def apply_changes(cur) -> Tuple[int, int]:
+    """
+    Upsert only new rows and rows whose count changed; the keys of new rows
+    go to delta_inserted for the filter. Returns (inserted, updated).
+    """
+    cur.execute("""
+        WITH up AS (
+            INSERT INTO hashes (sha1, count)
+            SELECT sha1, count FROM delta_rows ORDER BY sha1
+            ON CONFLICT (sha1) DO UPDATE SET count = EXCLUDED.count
+              WHERE hashes.count IS DISTINCT FROM EXCLUDED.count
+            RETURNING sha1, (xmax = 0) AS inserted
+        ), ins AS (
+            INSERT INTO delta_inserted (sha1) SELECT sha1 FROM up WHERE inserted
+        )
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM up;
+    """)
+    inserted, updated = cur.fetchone()
+    return int(inserted), int(updated)
+
+def prune_missing(cur, dry_run: bool = False) -> int:
+    """Rows inside changed buckets that the new release no longer contains."""
+    missing = """
+        h.sha1 >= b.lo AND h.sha1 < b.hi
+        AND NOT EXISTS (SELECT 1 FROM delta_rows d WHERE d.sha1 = h.sha1)
+    """
+    if dry_run:
+        cur.execute(f"SELECT count(*) FROM hashes h, delta_buckets b WHERE {missing};")
+        return int(cur.fetchone()[0])
+    cur.execute(f"DELETE FROM hashes h USING delta_buckets b WHERE {missing};")
+    return cur.rowcount
+
+def inserted_digests(conn, layout: str) -> Iterator[bytes]:
+    """Digests of the rows apply_changes inserted, read inside its transaction."""
+    cur = conn.cursor(name="delta_inserted_scan")
+    cur.itersize = 100_000
+    try:
+        cur.execute("SELECT sha1 FROM delta_inserted;")
+        for (sha1,) in cur:
+            yield bytes(sha1) if layout == "compact" else bytes.fromhex(sha1)
+    finally:
+        cur.close()
+
+def update_filter(conn, layout: str, version: int):
+    """
+    Bring BLOOM_FILTER_PATH up to `version` before the changes commit: add
+    the inserted digests to a filter of the current version, or rebuild it
+    (inside the transaction) if there is none to extend.
+    """
+    try:
+        current = BloomFilter(BLOOM_FILTER_PATH).source if os.path.exists(BLOOM_FILTER_PATH) else None
+    except FilterFormatError:
+        current = None
+    if current == version - 1:
+        try:
+            added = add_to_filter(BLOOM_FILTER_PATH, inserted_digests(conn, layout), version)
+            print(f"🧮 Added {added:,} digests to Bloom filter {BLOOM_FILTER_PATH}")
+            return
+        except FilterFormatError as e:
+            print(f"⚠️ {e}")  # an older file format
+    print(f"🧮 Rebuilding Bloom filter {BLOOM_FILTER_PATH} (no filter of version {version - 1} to extend)...")
+    rebuild_bloom_filter(conn, version=version, commit=False)
+
+def delta_import(path: str, prune: bool = False, dry_run: bool = False):
+    started = time.time()
+    conn = get_conn()
+    try:
+        cur = conn.cursor()
+        layout = detect_layout(cur)
+        cur.execute(hashes_table_ddl(layout))
+        version = read_dataset_version(cur)
+        old = load_manifest(cur, version)
+        conn.commit()
+        print(f"🔎 Scanning {path} ({len(old):,} buckets in manifest, layout {layout})...")
+
+        create_delta_tables(cur, layout)
+        manifest, changed, scanned = stage_changed_buckets(cur, layout, path, old)
+        cur.execute("SELECT count(*) FROM delta_rows;")
+        candidates = int(cur.fetchone()[0])
+        print(f"📦 {len(changed):,}/{len(manifest):,} buckets changed, "
+              f"{candidates:,} of {scanned:,} rows to compare ({time.time()-started:.2f}s)")
+
+        if dry_run:
+            inserted, updated = count_changes(cur)
+            deleted = prune_missing(cur, dry_run=True) if prune else 0
+            conn.rollback()
+        else:
+            inserted, updated = apply_changes(cur)
+            deleted = prune_missing(cur) if prune else 0
+
+        unchanged = scanned - inserted - updated
+        verb = "Would apply" if dry_run else "Applied"
+        print(f"✅ {verb}: {inserted:,} inserted, {updated:,} updated, {deleted:,} deleted, "
+              f"{unchanged:,} unchanged ({time.time()-started:.2f}s)")
+        if dry_run:
+            return
+
+        # Side files are brought up to the new version while the changes are
+        # still uncommitted, so no reader sees the new rows behind a filter
+        # that lacks them; the version bump commits together with the rows.
+        changes = inserted + updated + deleted
+        if inserted and BLOOM_FILTER_PATH:
+            update_filter(conn, layout, version + 1)  # the version bumped below
+        if changes and HOT_SET_PATH:
+            # updated counts can move hashes into or out of the top N
+            print(f"🔥 Rebuilding hot set {HOT_SET_PATH}...")
+            rebuild_hot_set(conn, commit=False)
+
+        cur = conn.cursor()
+        if changes:
+            version = mark_dataset_imported(cur, os.path.basename(path))
+        save_manifest(cur, manifest, version)
+        conn.commit()
+        if changes:
+            print("🔎 Running ANALYZE...")
+            cur.execute("ANALYZE hashes;")
+            conn.commit()
+        print(f"✅ Done. Dataset version is now {version}"
+              + (" (API caches will refresh)." if changes else " (nothing changed)."))
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply a new sorted SHA1:COUNT release as a delta")
+    parser.add_argument("file")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete rows that are no longer in the release")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="report what would change without writing")
+    args = parser.parse_args()
+    if not os.path.exists(args.file):
+        print("File not found:", args.file)
+        sys.exit(1)
+    try:
+        delta_import(args.file, args.prune, args.dry_run)
+    except UnsortedInputError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
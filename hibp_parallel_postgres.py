@@ -7,15 +7,60 @@ Features:
 - PostgreSQL tuning for bulk import
 - Temp tables merged safely into final table
 - Prompts for custom PostgreSQL data path
+
+Modes (--mode):
+- staged : (default) bounded-memory, index-last pipeline: raw byte
+           chunks are parsed and validated in a process pool, COPYed in
+           parallel into an unindexed UNLOGGED staging table, then
+           deduplicated together
+           with the current rows into a shadow table whose primary key is
+           built once; the shadow is swapped in atomically, so the API
+           never sees a half-imported dataset (see dataset_swap.py).
+           rows/s is reported per stage
+- merge  : worker threads COPY 1M-line batches into per-batch temp tables
+           and upsert each one into the live, indexed hashes table. The API
+           serves the import as it goes (and a failed run half of it) and
+           there is no hashes_prev to roll back to, so it is opt-in, for
+           small top-ups; delta_import.py is the better tool for those
+
+With a partitioned hashes table (HASHES_PARTITIONS=16|256 when the table
+is first created), staging is partitioned the same way so COPY routes rows
+to partitions, and dedupe, primary-key builds and VACUUM run one
+partition per worker.
+
+The input may be .gz/.xz/.zst/.7z: it is decompressed by a separate
+decoder process (or thread) that streams into parsing, and progress is
+reported against the compressed file size.
+
+--resume continues an interrupted import of the same file: committed
+chunks (staged) or batches (merge) are recorded in import_progress in the
+same transaction as their data, and are skipped on the next run.
 """
 
+import argparse
 import os
 import time
 import psycopg2
-from queue import Queue
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from itertools import islice
+from queue import Full, Queue
 from threading import Thread
 from multiprocessing import Value, cpu_count
 
+from dataset_swap import build_shadow, create_shadow, publish_shadow
+from db_loader import (
+    BLOOM_FILTER_PATH, HASHES_PARTITIONS, HOT_SET_PATH, detect_layout, hashes_table_ddl,
+    key_from_text_sql, key_sql_type, mark_dataset_imported, partition_name, partitions_ddl,
+    read_dataset_version, rebuild_bloom_filter, rebuild_hot_set, table_partitions,
+)
+from importer_common import (
+    CHUNK_BYTES, StageStats, clear_progress, import_id_for, iter_chunks, load_progress,
+    open_input, parse_chunk, profiled, record_progress, run_per_partition,
+    staging_matches_progress,
+)
+
 # =========================
 # CONFIGURATION
 # =========================
@@ -29,6 +74,9 @@ POSTGRES_DATA_PATH = "/home/samer/api/data"  # Custom PostgreSQL data path
 HIBP_FILE = "/home/samer/api/data/pwned.txt"  # Local HIBP txt file
 NUM_WORKERS = max(1, cpu_count() - 1)
 BATCH_SIZE = 1_000_000  # Number of lines per batch
+NUM_COPY_WORKERS = int(os.getenv("NUM_COPY_WORKERS", str(min(8, NUM_WORKERS))))
+STAGING_TABLE = "hashes_staging"
+QUEUE_PUT_TIMEOUT = 1.0  # seconds between checks for a failed worker while the queue is full
 
 # =========================
 # POSTGRES SETUP
@@ -65,132 +113,405 @@ def tune_postgres(conn):
 # DATABASE FUNCTIONS
 # =========================
 def create_final_table(cur):
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS hashes (
-            sha1 CHAR(40) PRIMARY KEY,
-            count BIGINT NOT NULL
-        );
-    """)
+    cur.execute(hashes_table_ddl(detect_layout(cur)))
 
 def merge_temp_to_hashes(cur, temp_table):
+    key = key_from_text_sql(detect_layout(cur))
     cur.execute(f"""
         INSERT INTO hashes (sha1, count)
-        SELECT sha1, MAX(count) AS count FROM {temp_table} GROUP BY sha1
+        SELECT {key}, MAX(count) AS count FROM {temp_table} GROUP BY sha1
         ON CONFLICT (sha1) DO UPDATE
         SET count = GREATEST(hashes.count, EXCLUDED.count);
     """)
     cur.connection.commit()
 
 def vacuum_hashes(cur):
-    cur.execute("VACUUM ANALYZE hashes;")
+    partitions = table_partitions(cur)
+    if partitions:
+        # one partition per worker; autovacuum never analyzes the parent itself,
+        # but lookups and range scans only use the per-partition statistics
+        cur.connection.commit()
+        run_per_partition(get_conn, partitions,
+                          lambda c, name, _: c.execute(f"VACUUM ANALYZE {name};"),
+                          NUM_COPY_WORKERS, autocommit=True)
+        return
+    # VACUUM refuses to run inside a transaction block
     cur.connection.commit()
+    cur.connection.autocommit = True
+    try:
+        cur.execute("VACUUM ANALYZE hashes;")
+    finally:
+        cur.connection.autocommit = False
 
 # =========================
 # BATCH PROCESSING
 # =========================
-def process_batch(batch_lines, batch_id, total_counter):
+def process_batch(batch_lines, batch_id, total_counter, import_id=None, stats=None):
+    stats = stats or StageStats()
     # Filter invalid lines just in case
-    batch_lines = [line for line in batch_lines if ':' in line and line.split(':')[1].isdigit()]
+    with stats.timed("parse") as t:
+        batch_lines = [line for line in batch_lines if ':' in line and line.split(':')[1].isdigit()]
+        t.rows = len(batch_lines)
 
     temp_table = f"pwned_tmp_{batch_id}"
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(f"DROP TABLE IF EXISTS {temp_table};")
-    cur.execute(f"CREATE UNLOGGED TABLE {temp_table} (sha1 CHAR(40), count BIGINT);")
-    conn.commit()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {temp_table};")
+        cur.execute(f"CREATE UNLOGGED TABLE {temp_table} (sha1 CHAR(40), count BIGINT);")
+        conn.commit()
 
-    from io import StringIO
-    buffer = StringIO("\n".join(batch_lines))
-    cur.copy_expert(
-        f"COPY {temp_table} (sha1, count) FROM STDIN WITH (FORMAT text, DELIMITER ':' )",
-        buffer
-    )
+        from io import StringIO
+        buffer = StringIO("\n".join(batch_lines))
+        with stats.timed("copy", rows=len(batch_lines)):
+            cur.copy_expert(
+                f"COPY {temp_table} (sha1, count) FROM STDIN WITH (FORMAT text, DELIMITER ':' )",
+                buffer
+            )
 
-    # Update global progress
-    with total_counter.get_lock():
-        total_counter.value += len(batch_lines)
-        print(f"[Batch {batch_id}] Loaded {len(batch_lines):,} lines. Total inserted: {total_counter.value:,}")
+        # Update global progress
+        with total_counter.get_lock():
+            total_counter.value += len(batch_lines)
+            print(f"[Batch {batch_id}] Loaded {len(batch_lines):,} lines. Total inserted: {total_counter.value:,}")
 
-    # Merge into final table
-    merge_temp_to_hashes(cur, temp_table)
-    cur.execute(f"DROP TABLE IF EXISTS {temp_table};")
-    conn.commit()
-    conn.close()
+        # Merge into final table (progress row commits together with the merge)
+        if import_id:
+            record_progress(cur, import_id, batch_id, batch_id + 1, len(batch_lines))
+        with stats.timed("merge", rows=len(batch_lines)):
+            merge_temp_to_hashes(cur, temp_table)
+        cur.execute(f"DROP TABLE IF EXISTS {temp_table};")
+        conn.commit()
+    except Exception:
+        # the (committed) unlogged table would outlive the connection
+        try:
+            conn.rollback()
+            with conn.cursor() as cleanup:
+                cleanup.execute(f"DROP TABLE IF EXISTS {temp_table};")
+            conn.commit()
+        except psycopg2.Error:
+            pass  # connection gone; the next run's DROP TABLE IF EXISTS covers it
+        raise
+    finally:
+        conn.close()
     print(f"[Batch {batch_id}] ✅ Merged and temp table dropped.")
 
-def batch_worker(queue, total_counter):
+def batch_worker(queue, total_counter, import_id=None, stats=None, errors=None):
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            batch_id, batch_lines = item
+            process_batch(batch_lines, batch_id, total_counter, import_id, stats)
+    except Exception as e:
+        print(f"❌ Merge worker stopped: {e}")
+        if errors is not None:
+            errors.append(e)
+
+# =========================
+# WORKER QUEUES
+# =========================
+def put_checked(queue, item, errors, threads):
+    """
+    queue.put for the producer: re-raises the first worker error instead of
+    queueing more work, and never blocks forever on a queue no worker drains.
+    """
     while True:
-        item = queue.get()
-        if item is None:
-            break
-        batch_id, batch_lines = item
-        process_batch(batch_lines, batch_id, total_counter)
-        queue.task_done()
+        if errors:
+            raise errors[0]
+        try:
+            queue.put(item, timeout=QUEUE_PUT_TIMEOUT)
+            return
+        except Full:
+            if not any(t.is_alive() for t in threads):
+                raise RuntimeError("all import workers stopped")
+
+def stop_workers(queue, threads):
+    """One stop sentinel per worker still running, then join them all."""
+    for _ in threads:
+        while any(t.is_alive() for t in threads):
+            try:
+                queue.put(None, timeout=QUEUE_PUT_TIMEOUT)
+                break
+            except Full:
+                continue
+    for t in threads:
+        t.join()
 
 # =========================
-# MAIN FUNCTION
+# STAGED (INDEX-LAST) PIPELINE
 # =========================
-def main():
-    if not os.path.exists(HIBP_FILE):
-        print(f"HIBP file not found: {HIBP_FILE}")
+def staging_partitions(cur):
+    """
+    Partition count for this import: follow an existing partitioned hashes
+    table, or HASHES_PARTITIONS when hashes is empty and gets rebuilt.
+    """
+    existing = table_partitions(cur)
+    if existing:
+        return len(existing)
+    cur.execute("SELECT EXISTS (SELECT 1 FROM hashes LIMIT 1);")
+    return 0 if cur.fetchone()[0] else HASHES_PARTITIONS
+
+def create_staging_table(cur, layout, partitions=0):
+    cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+    if not partitions:
+        cur.execute(f"CREATE UNLOGGED TABLE {STAGING_TABLE} (sha1 {key_sql_type(layout)}, count BIGINT);")
+        return
+    # a partitioned parent cannot be UNLOGGED, its partitions can
+    cur.execute(f"CREATE TABLE {STAGING_TABLE} (sha1 {key_sql_type(layout)}, count BIGINT) "
+                f"PARTITION BY RANGE (sha1);")
+    cur.execute(partitions_ddl(layout, STAGING_TABLE, partitions, unlogged=True))
+
+def copy_worker(queue, stats, import_id, errors):
+    """
+    Own connection per worker; COPYs parsed payloads into the unindexed
+    staging table. Each chunk and its progress row commit together, so a
+    failed chunk is simply missing from import_progress and --resume redoes
+    it. The first error goes to `errors` for the producer to re-raise.
+    """
+    try:
+        conn = get_conn()
+    except Exception as e:
+        print(f"❌ COPY worker could not connect: {e}")
+        errors.append(e)
         return
+    cur = conn.cursor()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            start, end, payload, rows = item
+            with stats.timed("copy", rows=rows) as t:
+                cur.copy_expert(f"COPY {STAGING_TABLE} (sha1, count) FROM STDIN", BytesIO(payload))
+                record_progress(cur, import_id, start, end, rows)
+                conn.commit()
+                t.nbytes = len(payload)
+    except Exception as e:
+        print(f"❌ COPY worker stopped: {e}")
+        errors.append(e)
+    finally:
+        conn.close()
+
+def build_final_table(conn, layout, stats, partitions=0):
+    """
+    Deduplicate staging plus the rows hashes already serves into the shadow
+    table, index it once, and publish it with a blue/green swap.
+    """
+    cur = conn.cursor()
+    hashes_partitioned = bool(table_partitions(cur))
+    cur.execute("SELECT EXISTS (SELECT 1 FROM hashes LIMIT 1);")
+    hashes_has_rows = cur.fetchone()[0]
+    create_shadow(cur, layout, partitions)
+    conn.commit()
+
+    def select_for(prefix):
+        staging = partition_name(STAGING_TABLE, prefix) if prefix else STAGING_TABLE
+        sql = f"SELECT sha1, count FROM {staging}"
+        if hashes_has_rows:
+            # live rows are only read; the API keeps serving them meanwhile
+            live = partition_name("hashes", prefix) if prefix and hashes_partitioned else "hashes"
+            sql += f" UNION ALL SELECT sha1, count FROM {live}"
+        return sql
+
+    build_shadow(conn, select_for, partitions, stats, NUM_COPY_WORKERS)
+
+def import_staged(path, resume=False, stats=None):
+    stats = stats or StageStats()
+    conn = get_conn()
+    cur = conn.cursor()
+    create_final_table(cur)
+    layout = detect_layout(cur)
+    partitions = staging_partitions(cur)
+    import_id = import_id_for(path, "staged", CHUNK_BYTES)
+    progress = load_progress(cur, import_id) if resume else {}
+    if progress and not staging_matches_progress(cur, STAGING_TABLE, progress):
+        print("⚠️ Staging table does not match recorded progress (crash recovery truncates "
+              "UNLOGGED tables); starting over.")
+        progress = {}
+    if progress:
+        done_bytes = max(end for end, _ in progress.values())
+        print(f"⏩ Resuming: {len(progress):,} chunks already staged (up to byte {done_bytes:,})")
+    else:
+        clear_progress(cur, import_id)
+        create_staging_table(cur, layout, partitions)
+    conn.commit()
+
+    print(f"🚀 Staged import of {path} ({NUM_WORKERS} parse processes, {NUM_COPY_WORKERS} COPY workers)...")
+    copy_queue = Queue(maxsize=NUM_COPY_WORKERS * 2)
+    errors = []
+    threads = [Thread(target=copy_worker, args=(copy_queue, stats, import_id, errors))
+               for _ in range(NUM_COPY_WORKERS)]
+    for t in threads:
+        t.start()
+
+    # at most NUM_WORKERS*2 chunks being parsed + NUM_COPY_WORKERS*3 queued/copying,
+    # so memory is bounded by ~CHUNK_BYTES * that, whatever the file size
+    max_parsing = NUM_WORKERS * 2
+    in_flight = deque()
+    total_rows = sum(rows for _, rows in progress.values())
+    rejected = 0
+
+    def drain_one():
+        nonlocal total_rows, rejected
+        fut, start, end, submitted = in_flight.popleft()
+        payload, rows, bad = fut.result()
+        stats.add("parse", rows=rows, seconds=time.perf_counter() - submitted)
+        total_rows += rows
+        rejected += bad
+        if payload:
+            put_checked(copy_queue, (start, end, payload, rows), errors, threads)
 
-    configure_postgres_data_path()
+    try:
+        with ProcessPoolExecutor(max_workers=NUM_WORKERS) as pool, open_input(path) as fh:
+            skip = {start: end for start, (end, _) in progress.items()}
+            chunks = iter_chunks(fh, CHUNK_BYTES, skip=skip)
+            while True:
+                with stats.timed("read") as t:
+                    chunk = next(chunks, None)
+                    t.nbytes = len(chunk[1]) if chunk else 0
+                if chunk is None:
+                    break
+                offset, data = chunk
+                in_flight.append((pool.submit(profiled, "parse", parse_chunk, data, layout),
+                                  offset, offset + len(data), time.perf_counter()))
+                while len(in_flight) >= max_parsing:
+                    drain_one()
+                print(f"[Main] {fh.progress()}: {offset + len(data):,} bytes read, "
+                      f"{total_rows:,} rows parsed")
+            while in_flight:
+                drain_one()
+    finally:
+        stop_workers(copy_queue, threads)
+    if errors:
+        # nothing is built or published from an incomplete staging table;
+        # committed chunks and their progress rows stay for --resume
+        print("❌ Staging incomplete; rerun with --resume to continue from the committed chunks.")
+        raise errors[0]
+    stats.add("read", rows=total_rows + rejected)
+    print(f"✅ Staging loaded: {total_rows:,} rows ({rejected:,} invalid lines skipped)")
 
+    build_final_table(conn, layout, stats, partitions)
+    cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+    clear_progress(cur, import_id)
+    conn.commit()
+    publish_shadow(conn, os.path.basename(path), NUM_COPY_WORKERS, stats)
+    conn.close()
+    stats.report()
+    return total_rows
+
+# =========================
+# MAIN FUNCTION
+# =========================
+def import_merge(path, resume=False, stats=None):
+    stats = stats or StageStats()
     # Connect and tune
     conn = get_conn()
     tune_postgres(conn)
     cur = conn.cursor()
     create_final_table(cur)
+    # merge batches are idempotent (GREATEST upsert); progress only saves rework
+    import_id = import_id_for(path, "merge", BATCH_SIZE)
+    done_batches = set(load_progress(cur, import_id)) if resume else set()
+    if not resume:
+        clear_progress(cur, import_id)
     conn.commit()
     conn.close()
+    if done_batches:
+        print(f"⏩ Resuming: {len(done_batches):,} batches already merged, skipping them")
 
     print("🚀 Starting import from HIBP txt file...")
     queue = Queue(maxsize=NUM_WORKERS*2)
     total_counter = Value('i', 0)
     threads = []
+    errors = []
 
     # Start worker threads
     for _ in range(NUM_WORKERS):
-        t = Thread(target=batch_worker, args=(queue, total_counter))
+        t = Thread(target=batch_worker, args=(queue, total_counter, import_id, stats, errors))
         t.start()
         threads.append(t)
 
-    # Read file and queue batches
-    batch_lines = []
+    # Read file and queue batches (the last one may be short)
     batch_id = 0
-    start_time = time.time()
-    with open(HIBP_FILE, "r", encoding="utf-8", errors="ignore") as f:
-        for line in f:
-            batch_lines.append(line.strip())
-            if len(batch_lines) >= BATCH_SIZE:
+    try:
+        with open_input(path) as f:
+            while True:
+                with stats.timed("read") as t:
+                    batch_lines = [line.decode("utf-8", errors="ignore").strip()
+                                   for line in islice(f, BATCH_SIZE)]
+                    t.rows = len(batch_lines)
+                if not batch_lines:
+                    break
                 batch_id += 1
-                queue.put((batch_id, batch_lines))
-                print(f"[Main] Queued batch {batch_id} with {len(batch_lines):,} lines...")
-                batch_lines = []
-
-        # Last batch
-        if batch_lines:
-            batch_id += 1
-            queue.put((batch_id, batch_lines))
-            print(f"[Main] Queued final batch {batch_id} with {len(batch_lines):,} lines...")
-
-    # Stop workers
-    queue.join()
-    for _ in threads:
-        queue.put(None)
-    for t in threads:
-        t.join()
+                if batch_id in done_batches:
+                    continue
+                put_checked(queue, (batch_id, batch_lines), errors, threads)
+                print(f"[Main] Queued batch {batch_id} with {len(batch_lines):,} lines "
+                      f"({f.progress()})...")
+    finally:
+        stop_workers(queue, threads)
+    if errors:
+        print("❌ Merge incomplete; rerun with --resume to skip the merged batches.")
+        raise errors[0]
+
+    conn = get_conn()
+    with conn.cursor() as cur:
+        clear_progress(cur, import_id)
+    conn.commit()
+    conn.close()
+    return total_counter.value
 
+def finish_import(path, stats=None):
+    stats = stats or StageStats()
     # Vacuum
     conn = get_conn()
     cur = conn.cursor()
     print("🔎 Running VACUUM ANALYZE on final hashes table...")
-    vacuum_hashes(cur)
+    with stats.timed("vacuum"):
+        vacuum_hashes(cur)
+    if BLOOM_FILTER_PATH:
+        print(f"🧮 Rebuilding Bloom filter {BLOOM_FILTER_PATH}...")
+        with stats.timed("filter"):
+            rebuild_bloom_filter(conn, version=read_dataset_version(cur) + 1)  # bumped below
+    if HOT_SET_PATH:
+        print(f"🔥 Rebuilding hot set {HOT_SET_PATH}...")
+        with stats.timed("hot_set"):
+            rebuild_hot_set(conn)
+
+    version = mark_dataset_imported(cur, os.path.basename(path))
+    conn.commit()
     conn.close()
+    print(f"🔄 Dataset version is now {version} (API caches will refresh).")
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel HIBP SHA1:COUNT import into PostgreSQL")
+    parser.add_argument("--file", default=HIBP_FILE, help=f"input file (default {HIBP_FILE})")
+    parser.add_argument("--mode", choices=("staged", "merge"), default="staged",
+                        help="staged builds a shadow table and swaps it in; merge writes to live hashes")
+    parser.add_argument("--no-prompt", action="store_true",
+                        help="skip the interactive PostgreSQL data-path step")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted import of the same file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print(f"HIBP file not found: {args.file}")
+        return
+
+    if not args.no_prompt:
+        configure_postgres_data_path()
+
+    start_time = time.time()
+    if args.mode == "staged":
+        total = import_staged(args.file, args.resume)  # publishes via a table swap
+    else:
+        total = import_merge(args.file, args.resume)
+        finish_import(args.file)
 
     print(f"✅ All done in {time.time() - start_time:.2f}s!")
-    print(f"📊 Total lines processed: {total_counter.value:,}")
+    print(f"📊 Total lines processed: {total:,}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,132 @@
+# hot_set.py
+"""
+Hot set: the HOT_SET_SIZE hashes with the highest counts, answered from memory.
+
+Usage:
+    python3 hot_set.py build-table /path/to/hot.store [--size N]   (from the hashes table)
+    python3 hot_set.py build-file pwnedpasswords.txt[.gz|.xz|.zst|.7z] /path/to/hot.store [--size N]
+    python3 hot_set.py build-store /path/to/pwned.store /path/to/hot.store [--size N]
+    python3 hot_set.py info /path/to/hot.store
+
+Breach popularity is heavily skewed and the most-breached passwords are
+also the ones most often checked, so a small top-N covers a large share
+of lookups. The file is an mmap_store file (digest-sorted digests + u32
+counts behind a prefix index): a lookup bisects a few records.
+
+With HOT_SET_PATH set, importers rebuild it after an import and the API
+maps it and reads it through before /readyz (and again after a dataset
+change), so unlike the lookup cache it is warm for the first request
+after a deploy. Lookups check it before the cache and the database;
+checks/hits give its coverage of live traffic for tuning HOT_SET_SIZE.
+"""
+from __future__ import annotations
+import heapq
+import os
+import time
+from typing import Dict, Iterable, Iterator, Tuple
+
+from mmap_store import RECORD, HashStore, parse_hash_lines, write_store
+
+HOT_SET_SIZE = int(os.getenv("HOT_SET_SIZE", "1000000"))
+PAGE = 4096
+
+class HotSet:
+    """Read-only top-N view; get() returns 0 for hashes outside the hot set."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.store = HashStore(path)
+        started = time.perf_counter()
+        mm = self.store._mm
+        for off in range(0, len(mm), PAGE):  # fault every page in now, not on the first lookups
+            mm[off]
+        self.load_s = time.perf_counter() - started
+        self.checks = 0
+        self.hits = 0
+
+    def get(self, digest: bytes) -> int:
+        self.checks += 1
+        count = self.store.lookup(digest)
+        if count:
+            self.hits += 1
+        return count
+
+    def get_hex(self, sha1_hex_upper: str) -> int:
+        return self.get(bytes.fromhex(sha1_hex_upper))
+
+    def is_stale(self) -> bool:
+        return self.store.is_stale()
+
+    def stats(self) -> Dict:
+        return {
+            **self.store.info(),
+            "load_s": round(self.load_s, 3),
+            "checks": self.checks,
+            "hits": self.hits,
+            "coverage": round(self.hits / self.checks, 4) if self.checks else 0.0,
+        }
+
+# =========================
+# BUILDERS
+# =========================
+def write_hot_set(records: Iterable[Tuple[bytes, int]], path: str, size: int = HOT_SET_SIZE) -> int:
+    """Keep the `size` highest-count (digest, count) pairs and write them digest-sorted."""
+    started = time.time()
+    top = heapq.nlargest(size, records, key=lambda r: r[1])
+    counts = [c for _, c in top]
+    # ~4 records per prefix bucket; the store's 16-bit index would outweigh a small set
+    prefix_bits = max(4, min(16, len(top).bit_length() - 2))
+    written = write_store((RECORD.pack(d, c) for d, c in sorted(top)), path, prefix_bits)
+    floor = min(counts) if counts else 0
+    print(f"🔥 Hot set {path}: {written:,} hashes, count >= {floor:,} ({time.time()-started:.2f}s)")
+    return written
+
+def _file_records(path: str) -> Iterator[Tuple[bytes, int]]:
+    from importer_common import open_input
+    with open_input(path) as fh:
+        for rec in parse_hash_lines(fh):
+            yield RECORD.unpack(rec)
+
+def build_from_file(input_path: str, path: str, size: int = HOT_SET_SIZE) -> int:
+    """From a 'SHA1:COUNT' import file, optionally compressed (one pass)."""
+    return write_hot_set(_file_records(input_path), path, size)
+
+def build_from_store(store_path: str, path: str, size: int = HOT_SET_SIZE) -> int:
+    from mmap_store import RECORD_LEN
+    store = HashStore(store_path)
+    mm, base = store._mm, store._data_start
+    records = (RECORD.unpack_from(mm, base + i * RECORD_LEN) for i in range(store.record_count))
+    return write_hot_set(records, path, size)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or inspect the hot set of most-breached hashes")
+    sub = parser.add_subparsers(dest="cmd")
+    p_table = sub.add_parser("build-table")
+    p_table.add_argument("output")
+    p_file = sub.add_parser("build-file")
+    p_file.add_argument("input")
+    p_file.add_argument("output")
+    p_store = sub.add_parser("build-store")
+    p_store.add_argument("store")
+    p_store.add_argument("output")
+    for p in (p_table, p_file, p_store):
+        p.add_argument("--size", type=int, default=HOT_SET_SIZE, help="hashes to keep")
+    p_info = sub.add_parser("info")
+    p_info.add_argument("hot_set")
+    args = parser.parse_args()
+    if args.cmd == "build-table":
+        from db_loader import get_conn, rebuild_hot_set
+        conn = get_conn()
+        try:
+            rebuild_hot_set(conn, args.output, args.size)
+        finally:
+            conn.close()
+    elif args.cmd == "build-file":
+        build_from_file(args.input, args.output, args.size)
+    elif args.cmd == "build-store":
+        build_from_store(args.store, args.output, args.size)
+    elif args.cmd == "info":
+        print(HotSet(args.hot_set).stats())
+    else:
+        parser.print_help()
@@ -0,0 +1,462 @@
+# importer_common.py
+"""
+Shared pieces of the bulk import pipeline (hibp_parallel_postgres.py,
+load_to_postgres.py): line-aligned raw chunking, COPY payload parsing,
+per-stage throughput accounting, resumable-import bookkeeping,
+per-partition parallel work, and compressed input.
+
+Setting IMPORT_PROFILE_DIR turns every StageStats.timed() block (and every
+profiled() call in a worker process) into a cProfile run; the dumps are
+merged into one <stage>.prof per stage by merge_profiles(), for
+`python3 -m pstats` or snakeviz.
+"""
+from __future__ import annotations
+import cProfile
+import glob
+import gzip
+import itertools
+import lzma
+import os
+import pstats
+import re
+import shutil
+import subprocess
+import threading
+import time
+from queue import Empty, Queue
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
+
+CHUNK_BYTES = 32 * 1024 * 1024  # raw bytes per parse/COPY unit
+PROFILE_DIR = os.getenv("IMPORT_PROFILE_DIR", "")
+
+_LINE_RE = re.compile(rb"^([0-9A-Fa-f]{40}):([0-9]+)\r?$", re.MULTILINE)
+
+def _skip_to(fh: BinaryIO, current: int, offset: int):
+    if fh.seekable():
+        fh.seek(offset)
+        return
+    # decompressed streams cannot seek: read past the committed bytes instead
+    remaining = offset - current
+    while remaining > 0:
+        data = fh.read(min(remaining, 16 * 1024 * 1024))
+        if not data:
+            return
+        remaining -= len(data)
+
+def iter_chunks(fh: BinaryIO, chunk_bytes: int = CHUNK_BYTES, start_offset: int = 0,
+                skip: Optional[Dict[int, int]] = None) -> Iterator[Tuple[int, bytes]]:
+    """
+    Yield (offset, data) raw byte chunks of about chunk_bytes, always ending
+    on a line boundary. Chunk boundaries depend only on the file contents and
+    chunk_bytes, so the same offsets come back on every run. `skip` maps
+    start -> end offsets of chunks already committed; those are seeked over
+    (or read and discarded, for compressed input) without being parsed.
+    """
+    offset = start_offset
+    if start_offset:
+        _skip_to(fh, 0, start_offset)
+    while True:
+        if skip and offset in skip:
+            _skip_to(fh, offset, skip[offset])
+            offset = skip[offset]
+            continue
+        data = fh.read(chunk_bytes)
+        if not data:
+            return
+        if not data.endswith(b"\n"):
+            data += fh.readline()
+        yield offset, data
+        offset += len(data)
+
+def parse_chunk(data: bytes, layout: str = "text") -> Tuple[bytes, int, int]:
+    """
+    Validate 'SHA1:COUNT' lines and render them as a COPY text payload
+    (tab separated, upper-case hex; '\\\\x<hex>' bytea literals for the compact
+    layout). Returns (payload, rows, rejected_lines). Runs in worker processes.
+    """
+    rows = []
+    if layout == "compact":
+        for m in _LINE_RE.finditer(data):
+            rows.append(b"\\\\x" + m.group(1).upper() + b"\t" + m.group(2))
+    else:
+        for m in _LINE_RE.finditer(data):
+            rows.append(m.group(1).upper() + b"\t" + m.group(2))
+    lines = data.count(b"\n") + (0 if data.endswith(b"\n") or not data else 1)
+    payload = b"\n".join(rows) + b"\n" if rows else b""
+    return payload, len(rows), lines - len(rows)
+
+# =========================
+# COMPRESSED INPUT
+# =========================
+# suffix -> external decoders to try in order; they run as a separate
+# process that pipelines into parsing. gzip/xz fall back to the stdlib and
+# zstd to the optional `zstandard` package, decompressing on a thread.
+DECODERS = {
+    ".gz": [["pigz", "-dc"], ["gzip", "-dc"]],
+    ".xz": [["xz", "-dc", "-T0"]],
+    ".zst": [["zstd", "-dc", "-q"]],
+    ".7z": [["7z", "x", "-so", "-bd"], ["7za", "x", "-so", "-bd"], ["7zz", "x", "-so", "-bd"]],
+}
+PIPE_BUFFER = 4 * 1024 * 1024
+
+def compression_of(path: str) -> Optional[str]:
+    suffix = os.path.splitext(path)[1].lower()
+    return suffix if suffix in DECODERS else None
+
+class InputStream:
+    """
+    Binary, line-iterable reader over a plain or compressed input file.
+    position()/progress() count bytes of the file on disk, so percentages
+    and ETAs are right for compressed input as well.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.compression = compression_of(path)
+        self.total = os.path.getsize(path)
+        self.started = time.time()
+        self._raw = None
+        self._proc = None
+        self._thread = None
+        self._error: Optional[BaseException] = None
+        if self.compression is None:
+            self._raw = open(path, "rb", buffering=PIPE_BUFFER)
+            self._fh = self._raw
+        elif self._start_decoder():
+            self._fh = self._proc.stdout
+        else:
+            self._start_thread()
+
+    def _start_decoder(self) -> bool:
+        for cmd in DECODERS[self.compression]:
+            if shutil.which(cmd[0]) is None:
+                continue
+            if self.compression == ".7z":
+                # 7z needs a seekable archive path, not stdin
+                self._proc = subprocess.Popen(cmd + [self.path], stdout=subprocess.PIPE,
+                                              stderr=subprocess.DEVNULL, bufsize=PIPE_BUFFER)
+            else:
+                # the child shares this file description, so its offset is our progress
+                self._raw = open(self.path, "rb", buffering=0)
+                self._proc = subprocess.Popen(cmd, stdin=self._raw, stdout=subprocess.PIPE,
+                                              bufsize=PIPE_BUFFER)
+            return True
+        if self.compression == ".7z":
+            raise RuntimeError(f"{self.path}: no 7z decoder found (install p7zip)")
+        return False
+
+    def _open_module_decoder(self):
+        if self.compression == ".gz":
+            return gzip.GzipFile(fileobj=self._raw)
+        if self.compression == ".xz":
+            return lzma.LZMAFile(self._raw)
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError(f"{self.path}: needs the zstd binary or the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(self._raw)
+
+    def _start_thread(self):
+        self._raw = open(self.path, "rb", buffering=PIPE_BUFFER)
+        decoder = self._open_module_decoder()
+        read_fd, write_fd = os.pipe()
+        self._fh = os.fdopen(read_fd, "rb", buffering=PIPE_BUFFER)
+
+        def pump():
+            try:
+                with decoder:
+                    while True:
+                        block = decoder.read(PIPE_BUFFER)
+                        if not block:
+                            break
+                        view = memoryview(block)
+                        while view:
+                            view = view[os.write(write_fd, view):]
+            except BrokenPipeError:
+                pass  # reader closed early
+            except BaseException as e:
+                self._error = e
+            finally:
+                os.close(write_fd)
+
+        self._thread = threading.Thread(target=pump, daemon=True)
+        self._thread.start()
+
+    # -- file-like API used by iter_chunks and the line readers --
+    def read(self, n: int = -1) -> bytes:
+        data = self._fh.read(n)
+        if not data:
+            self._check_eof()
+        return data
+
+    def readline(self) -> bytes:
+        return self._fh.readline()
+
+    def __iter__(self):
+        for line in self._fh:
+            yield line
+        self._check_eof()
+
+    def seekable(self) -> bool:
+        return self.compression is None
+
+    def seek(self, offset: int):
+        self._fh.seek(offset)
+
+    def _check_eof(self):
+        """A truncated or corrupt archive must fail the import, not end it early."""
+        if self._thread is not None:
+            self._thread.join()
+            if self._error is not None:
+                raise RuntimeError(f"{self.path}: decompression failed: {self._error}")
+        if self._proc is not None and self._proc.wait() != 0:
+            raise RuntimeError(f"{self.path}: decoder exited with status {self._proc.returncode}")
+
+    # -- progress on bytes of the file on disk --
+    def position(self) -> int:
+        if self._proc is not None and self._raw is None:
+            try:  # 7z opened the archive itself: use its read counter
+                with open(f"/proc/{self._proc.pid}/io") as fh:
+                    for line in fh:
+                        if line.startswith("rchar:"):
+                            return min(self.total, int(line.split()[1]))
+            except OSError:
+                return 0
+        if self._raw is None or self._raw.closed:
+            return self.total
+        if self._proc is not None:
+            return os.lseek(self._raw.fileno(), 0, os.SEEK_CUR)
+        return self._raw.tell()
+
+    def progress(self) -> str:
+        done = self.position()
+        pct = done / self.total * 100 if self.total else 100.0
+        elapsed = time.time() - self.started
+        eta = f", ETA {elapsed / done * (self.total - done):.0f}s" if 0 < done < self.total else ""
+        return f"{pct:5.1f}% of {self.total/1024/1024:,.0f} MiB input{eta}"
+
+    def close(self):
+        if self._proc is not None:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.stdout.close()
+            self._proc.wait()
+        elif self._fh is not self._raw:
+            self._fh.close()  # unblocks the pump thread
+        if self._raw is not None:
+            self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def open_input(path: str) -> InputStream:
+    """Open a SHA1:COUNT (or wordlist) file; .gz/.xz/.zst/.7z are decompressed on the fly."""
+    return InputStream(path)
+
+# =========================
+# RESUMABLE IMPORT STATE
+# =========================
+# One row per committed chunk, written in the same transaction as the chunk's
+# COPY, so a chunk is either fully staged and recorded or neither: retrying
+# it after a crash is always safe.
+IMPORT_PROGRESS_DDL = """
+CREATE TABLE IF NOT EXISTS import_progress (
+    import_id TEXT NOT NULL,
+    start_offset BIGINT NOT NULL,
+    end_offset BIGINT NOT NULL,
+    rows BIGINT NOT NULL,
+    committed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (import_id, start_offset)
+);
+"""
+
+def import_id_for(path: str, mode: str, chunk_bytes: int) -> str:
+    """Identifies one import of one file version with one chunking."""
+    st = os.stat(path)
+    return f"{os.path.basename(path)}:{st.st_size}:{int(st.st_mtime)}:{mode}:{chunk_bytes}"
+
+def load_progress(cur, import_id: str) -> Dict[int, Tuple[int, int]]:
+    """start_offset -> (end_offset, rows) for every committed chunk."""
+    cur.execute(IMPORT_PROGRESS_DDL)
+    cur.execute("SELECT start_offset, end_offset, rows FROM import_progress WHERE import_id = %s;",
+                (import_id,))
+    return {start: (end, rows) for start, end, rows in cur.fetchall()}
+
+def record_progress(cur, import_id: str, start: int, end: int, rows: int):
+    """Call inside the chunk's transaction, before commit."""
+    cur.execute("""
+        INSERT INTO import_progress (import_id, start_offset, end_offset, rows)
+        VALUES (%s, %s, %s, %s) ON CONFLICT (import_id, start_offset) DO NOTHING;
+    """, (import_id, start, end, rows))
+
+def clear_progress(cur, import_id: str):
+    cur.execute(IMPORT_PROGRESS_DDL)
+    cur.execute("DELETE FROM import_progress WHERE import_id = %s;", (import_id,))
+
+def staging_matches_progress(cur, table: str, progress: Dict[int, Tuple[int, int]]) -> bool:
+    """
+    UNLOGGED staging tables are truncated by crash recovery, so recorded
+    progress is only trusted if the staged row count still adds up.
+    """
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+    if not cur.fetchone()[0]:
+        return not progress
+    cur.execute(f"SELECT count(*) FROM {table};")
+    return cur.fetchone()[0] == sum(rows for _, rows in progress.values())
+
+# =========================
+# PER-PARTITION WORK
+# =========================
+def run_per_partition(connect: Callable, partitions: List[Tuple[str, str]],
+                      work: Callable, workers: int, autocommit: bool = False) -> List:
+    """
+    Run work(cur, partition, prefix) for every (partition, prefix) on up to
+    `workers` threads, each with its own connection (committed after every
+    partition unless autocommit, which VACUUM needs). Returns the results in
+    partition order; the first error is re-raised once all threads stopped.
+    """
+    todo: Queue = Queue()
+    for i, item in enumerate(partitions):
+        todo.put((i, item))
+    results: List = [None] * len(partitions)
+    errors: List[BaseException] = []
+
+    def worker():
+        try:
+            conn = connect()
+        except BaseException as e:
+            errors.append(e)
+            return
+        conn.autocommit = autocommit
+        try:
+            with conn.cursor() as cur:
+                while not errors:
+                    try:
+                        i, (name, prefix) = todo.get_nowait()
+                    except Empty:
+                        return
+                    results[i] = work(cur, name, prefix)
+                    if not autocommit:
+                        conn.commit()
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(partitions))))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+class StageStats:
+    """Thread-safe per-stage counters: rows, bytes and busy seconds."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self.started = time.time()
+
+    def add(self, stage: str, rows: int = 0, nbytes: int = 0, seconds: float = 0.0):
+        with self._lock:
+            s = self._stages.setdefault(stage, {"rows": 0, "bytes": 0, "seconds": 0.0})
+            s["rows"] += rows
+            s["bytes"] += nbytes
+            s["seconds"] += seconds
+
+    def timed(self, stage: str, rows: int = 0):
+        return _Timed(self, stage, rows)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {k: dict(v) for k, v in self._stages.items()}
+
+    def report(self):
+        wall = time.time() - self.started
+        print(f"📊 Stage throughput (wall {wall:.2f}s):")
+        for stage, s in self.snapshot().items():
+            rate = s["rows"] / s["seconds"] if s["seconds"] else 0.0
+            mb = f", {s['bytes']/1024/1024:,.0f} MiB" if s["bytes"] else ""
+            print(f"   {stage:<12} {int(s['rows']):>14,} rows{mb} in {s['seconds']:.2f}s busy "
+                  f"→ {rate:,.0f} rows/s")
+        if PROFILE_DIR:
+            for path in merge_profiles():
+                print(f"   profile: {path}")
+
+class _Timed:
+    """Times a block into a stage; `rows`/`nbytes` may be set inside it."""
+
+    def __init__(self, stats: StageStats, stage: str, rows: int):
+        self.stats, self.stage, self.rows, self.nbytes = stats, stage, rows, 0
+
+    def __enter__(self):
+        self.profile = _start_profile()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add(self.stage, rows=self.rows, nbytes=self.nbytes,
+                       seconds=time.perf_counter() - self.t0)
+        if self.profile is not None:
+            _stop_profile(self.profile, self.stage)
+        return False
+
+# =========================
+# STAGE PROFILES
+# =========================
+_profiling = threading.local()
+_profile_seq = itertools.count()
+
+def _start_profile() -> Optional[cProfile.Profile]:
+    """A running profiler for this thread, unless profiling is off or one already runs here."""
+    if not PROFILE_DIR or getattr(_profiling, "active", False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:  # some other profiler owns this thread
+        return None
+    _profiling.active = True
+    return profile
+
+def _stop_profile(profile: cProfile.Profile, stage: str):
+    profile.disable()
+    _profiling.active = False
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    # one part file per block; merge_profiles() folds them into <stage>.prof
+    profile.dump_stats(os.path.join(
+        PROFILE_DIR, f"{stage}.{os.getpid()}-{threading.get_ident()}-{next(_profile_seq)}.part"))
+
+def profiled(stage: str, fn: Callable, *args):
+    """fn(*args), profiled as `stage` if IMPORT_PROFILE_DIR is set; picklable for process pools."""
+    profile = _start_profile()
+    try:
+        return fn(*args)
+    finally:
+        if profile is not None:
+            _stop_profile(profile, stage)
+
+def merge_profiles(profile_dir: str = "") -> List[str]:
+    """Fold the part files in profile_dir into one <stage>.prof each. Returns their paths."""
+    profile_dir = profile_dir or PROFILE_DIR
+    parts: Dict[str, List[str]] = {}
+    for path in glob.glob(os.path.join(profile_dir, "*.part")):
+        parts.setdefault(os.path.basename(path).split(".", 1)[0], []).append(path)
+    merged = []
+    for stage, paths in sorted(parts.items()):
+        out = os.path.join(profile_dir, f"{stage}.prof")
+        if os.path.exists(out):
+            paths.append(out)
+        pstats.Stats(*paths).dump_stats(out)
+        for path in paths:
+            if path != out:
+                os.remove(path)
+        merged.append(out)
+    return merged
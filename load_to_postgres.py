@@ -3,19 +3,43 @@
 Stream-import a large 'SHA1:COUNT' file into Postgres.
 
 Usage:
-    python3 load_to_postgres.py /path/to/pwnedpasswords.txt
+    python3 load_to_postgres.py /path/to/pwnedpasswords.txt[.gz|.xz|.zst|.7z] [--resume]
 
 This script:
  - creates a temporary unlogged table pwned_tmp
  - COPY FROM STDIN the input file (delimiter ':')
- - INSERT ... SELECT into final 'hashes' table with ON CONFLICT using GREATEST
- - drops the temp table and VACUUM ANALYZE
+ - builds hashes_shadow from pwned_tmp plus the current rows (MAX count,
+   primary key built last) while the API keeps serving 'hashes'
+ - drops the temp table, VACUUM ANALYZEs the shadow and swaps it in
+   (the previous table stays as hashes_prev, see dataset_swap.py)
+
+If 'hashes' is partitioned, pwned_tmp is partitioned the same way and the
+shadow build and VACUUM run one partition per worker (MERGE_WORKERS).
+
+Each 10MB chunk is committed together with its import_progress row, so
+--resume after a crash skips what pwned_tmp already holds (the GREATEST
+merge is idempotent, so a repeated merge is harmless too).
 """
+import argparse
 import sys
 import os
 import time
+from io import StringIO
 import psycopg2
 
+from dataset_swap import build_shadow, create_shadow, publish_shadow
+from db_loader import (
+    detect_layout, hashes_table_ddl, key_from_text_sql, partition_name, partitions_ddl,
+    table_partitions,
+)
+from importer_common import (
+    StageStats, clear_progress, import_id_for, iter_chunks, load_progress, open_input,
+    record_progress, staging_matches_progress,
+)
+
+COPY_CHUNK_BYTES = 10 * 1024 * 1024
+MERGE_WORKERS = int(os.getenv("MERGE_WORKERS", str(min(8, os.cpu_count() or 1))))
+
 DB_NAME = os.getenv("DB_NAME", "pwned")
 DB_USER = os.getenv("DB_USER", "pwned_user")
 DB_PASS = os.getenv("DB_PASS", "P@ssw0rd512")
@@ -33,43 +57,76 @@ def get_conn():
 
 def create_tmp_table(cur):
     cur.execute("DROP TABLE IF EXISTS pwned_tmp;")
-    cur.execute("CREATE UNLOGGED TABLE pwned_tmp (sha1 CHAR(40), count BIGINT);")
-
-def merge_tmp_to_hashes(cur):
-    cur.execute("""
-        INSERT INTO hashes (sha1, count)
-        SELECT sha1, MAX(count) AS count FROM pwned_tmp GROUP BY sha1
-        ON CONFLICT (sha1) DO UPDATE
-          SET count = GREATEST(hashes.count, EXCLUDED.count);
-    """)
-    cur.connection.commit()
-
-def vacuum_analyze(cur):
-    cur.execute("VACUUM ANALYZE hashes;")
-    cur.connection.commit()
-
-def stream_copy_file(conn, file_path):
+    partitions = len(table_partitions(cur))
+    if not partitions:
+        cur.execute("CREATE UNLOGGED TABLE pwned_tmp (sha1 CHAR(40), count BIGINT);")
+        return
+    # same prefixes as hashes, so each partition merges independently
+    cur.execute("CREATE TABLE pwned_tmp (sha1 CHAR(40), count BIGINT) PARTITION BY RANGE (sha1);")
+    cur.execute(partitions_ddl("text", "pwned_tmp", partitions, unlogged=True))
+
+def build_shadow_from_tmp(conn, stats=None):
+    """
+    pwned_tmp plus the rows hashes already serves, deduplicated with the
+    same MAX(count) rule the old in-place GREATEST upsert used.
+    """
     cur = conn.cursor()
-    create_tmp_table(cur)
+    # pwned_tmp always holds hex text; the compact layout stores decode(sha1, 'hex')
+    layout = detect_layout(cur)
+    key = key_from_text_sql(layout)
+    partitions = len(table_partitions(cur))
+    create_shadow(cur, layout, partitions)
+    conn.commit()
+
+    def select_for(prefix):
+        tmp = partition_name("pwned_tmp", prefix) if prefix else "pwned_tmp"
+        live = partition_name("hashes", prefix) if prefix else "hashes"
+        return f"SELECT {key} AS sha1, count FROM {tmp} UNION ALL SELECT sha1, count FROM {live}"
+
+    build_shadow(conn, select_for, partitions, stats, MERGE_WORKERS)
+
+def stream_copy_file(conn, file_path, resume=False, stats=None):
+    stats = stats or StageStats()
+    cur = conn.cursor()
+    import_id = import_id_for(file_path, "load", COPY_CHUNK_BYTES)
+    progress = load_progress(cur, import_id) if resume else {}
+    if progress and not staging_matches_progress(cur, "pwned_tmp", progress):
+        print("⚠️ pwned_tmp does not match recorded progress; starting over.")
+        progress = {}
+    if progress:
+        print(f"⏩ Resuming: {len(progress):,} chunks already in pwned_tmp")
+    else:
+        clear_progress(cur, import_id)
+        create_tmp_table(cur)
     conn.commit()
 
     sql = "COPY pwned_tmp (sha1, count) FROM STDIN WITH (FORMAT text, DELIMITER ':' )"
     print(f"📥 Starting COPY from {file_path} into pwned_tmp (this may take a while)...")
 
     started = time.time()
-    lines_processed = 0
-with open(file_path, "r", encoding="utf-8", errors="ignore") as fh:
-    started_read = time.time()
-    lines_processed = 0
-
-    while True:
-        chunk = fh.read(1024 * 1024 * 10)  # Read in 10MB chunks
-        if not chunk:
-            break
-        cur.copy_expert(sql, chunk)
-        lines_processed += chunk.count("\n")
-        elapsed = time.time() - started_read
-        print(f"Progress: {lines_processed:,} lines processed... (Elapsed Time: {elapsed:.2f}s)")
+    lines_processed = sum(rows for _, rows in progress.values())
+    skip = {start: end for start, (end, _) in progress.items()}
+    with open_input(file_path) as fh:
+        started_read = time.time()
+
+        # chunks always end on a line boundary, so no line spans two COPYs
+        chunks = iter_chunks(fh, COPY_CHUNK_BYTES, skip=skip)
+        while True:
+            with stats.timed("read") as t:
+                chunk = next(chunks, None)
+                t.nbytes = len(chunk[1]) if chunk else 0
+            if chunk is None:
+                break
+            offset, data = chunk
+            with stats.timed("copy") as t:
+                cur.copy_expert(sql, StringIO(data.decode("utf-8", errors="ignore")))
+                t.rows, t.nbytes = cur.rowcount, len(data)
+                record_progress(cur, import_id, offset, offset + len(data), cur.rowcount)
+                conn.commit()
+            lines_processed += data.count(b"\n")
+            elapsed = time.time() - started_read
+            print(f"Progress: {lines_processed:,} lines processed, {fh.progress()}... "
+                  f"(Elapsed Time: {elapsed:.2f}s)")
 
     print(f"📥 Total lines processed: {lines_processed:,}")
 
@@ -79,25 +136,27 @@ with open(file_path, "r", encoding="utf-8", errors="ignore") as fh:
     tmp_count = cur.fetchone()[0]
     print(f"Temporary rows loaded: {tmp_count:,}")
 
-    print("🔁 Merging into final table (hashes)...")
+    print("🔁 Merging with current rows into the shadow table...")
     started = time.time()
-    merge_tmp_to_hashes(cur)
-    print(f"Progress: Merge operation running (Elapsed: {time.time()-started:.2f}s)...")
+    build_shadow_from_tmp(conn, stats)
     print(f"✅ Merge complete in {time.time()-started:.2f}s")
 
     print("🧹 Dropping temporary table...")
+    cur = conn.cursor()
     cur.execute("DROP TABLE IF EXISTS pwned_tmp;")
+    clear_progress(cur, import_id)
     conn.commit()
 
-    print("🔎 Running VACUUM ANALYZE...")
-    vacuum_analyze(cur)
-    print("✅ Done.")
+    version = publish_shadow(conn, os.path.basename(file_path), MERGE_WORKERS, stats)
+    print(f"✅ Done. Dataset version is now {version} (API caches will refresh).")
 
 def main():
-    if len(sys.argv) < 2:
-        print("Usage: python3 load_to_postgres.py /path/to/pwnedpasswords.txt")
-        sys.exit(1)
-    file_path = sys.argv[1]
+    parser = argparse.ArgumentParser(description="Stream-import a SHA1:COUNT file into Postgres")
+    parser.add_argument("file")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted import of the same file")
+    args = parser.parse_args()
+    file_path = args.file
     if not os.path.exists(file_path):
         print("File not found:", file_path)
         sys.exit(1)
@@ -106,15 +165,10 @@ def main():
     try:
         # ensure final table exists
         with conn.cursor() as cur:
-            cur.execute("""
-            CREATE TABLE IF NOT EXISTS hashes (
-                sha1 CHAR(40) PRIMARY KEY,
-                count BIGINT NOT NULL
-            );
-            """)
+            cur.execute(hashes_table_ddl(detect_layout(cur)))
             conn.commit()
 
-        stream_copy_file(conn, file_path)
+        stream_copy_file(conn, file_path, args.resume)
     finally:
         conn.close()
 
@@ -0,0 +1,111 @@
+# lookup_cache.py
+from __future__ import annotations
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "200000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # 0 = no byte bound
+CACHE_TTL = float(os.getenv("CACHE_TTL", "600"))                 # seconds, found hashes
+CACHE_NEGATIVE_TTL = float(os.getenv("CACHE_NEGATIVE_TTL", "120"))  # seconds, misses
+
+# rough per-entry cost: OrderedDict node + tuple + int + float on CPython
+_ENTRY_OVERHEAD = 200
+
+class LookupCache:
+    """
+    Bounded LRU cache of sha1 -> count with separate TTLs for hits and misses.
+
+    Misses are stored as count 0 and expire after negative_ttl. get() returns
+    None when the key is not cached (or expired), so a cached miss (0) can be
+    told apart from "ask the database".
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 ttl: float = CACHE_TTL, negative_ttl: float = CACHE_NEGATIVE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # sha1 -> (count, expires_at)
+        self._bytes = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _entry_size(key: str) -> int:
+        return sys.getsizeof(key) + _ENTRY_OVERHEAD
+
+    def get(self, key: str) -> Optional[int]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            count, expires_at = entry
+            if expires_at <= now:
+                del self._data[key]
+                self._bytes -= self._entry_size(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return count
+
+    def put(self, key: str, count: int):
+        ttl = self.ttl if count else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            else:
+                self._bytes += self._entry_size(key)
+            self._data[key] = (count, expires_at)
+            while self._data and (len(self._data) > self.max_entries
+                                  or (self.max_bytes and self._bytes > self.max_bytes)):
+                old_key, _ = self._data.popitem(last=False)
+                self._bytes -= self._entry_size(old_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_s": self.ttl,
+                "negative_ttl_s": self.negative_ttl,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+cache: Optional[LookupCache] = LookupCache() if CACHE_ENABLED else None
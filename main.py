@@ -1,37 +1,368 @@
 # main.py
 from __future__ import annotations
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import asyncio
 import hashlib
+import json
+import os
+import random
+import string
 import time
+from contextlib import asynccontextmanager
 
-from auth import load_api_keys, verify_api_key
-from db_loader import init_db, load_hash_file, lookup
+import metrics
+import request_timing
+from ratelimit import limiter
+from admission import Overloaded
+from auth import authenticate_api_key, enforce_rate_limit, key_priority, load_api_keys, verify_api_key
+from db_loader import (
+    LOOKUP_MANY_CHUNK, RANGE_PREFIX_LEN, PoolTimeout, admission_stats, backend_stats, cache_stats,
+    close_pool,
+    coalescer_stats, DIGEST_LEN, lookup_digests_async, pack_counts,
+    explain_lookup, filter_stats, get_dataset_info, hot_set_stats, init_db, invalidate_caches,
+    load_filter, load_hash_file, load_hot_set,
+    lookup_async,
+    lookup_many_async, prewarm_index, range_query_async, uses_postgres, warm_backend,
+)
 
-app = FastAPI(title="Pwned Check (Bank API)")
+HEX_DIGITS = set(string.hexdigits.upper())
+# Add-Padding: pad /range responses to a random size in this row range (HIBP-style)
+RANGE_PADDING_MIN = 800
+RANGE_PADDING_MAX = 1000
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))  # hashes per POST /check/batch
+MAX_BINARY_BATCH = int(os.getenv("MAX_BINARY_BATCH", "1000000"))  # digests per POST /check/binary
+OCTET_STREAM = "application/octet-stream"
+DATASET_POLL_INTERVAL = float(os.getenv("DATASET_POLL_INTERVAL", "30"))  # seconds
+# CREATE TABLE IF NOT EXISTS at startup still takes locks on a live table; run it
+# once per database (INIT_DB_ON_STARTUP=1 on one instance, or
+# `python3 -c "import db_loader; db_loader.init_db()"`) instead of on every deploy
+INIT_DB_ON_STARTUP = os.getenv("INIT_DB_ON_STARTUP", "0") == "1"
+WARM_UP_RETRY_INTERVAL = float(os.getenv("WARM_UP_RETRY_INTERVAL", "2"))  # seconds
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await on_startup()
+    try:
+        yield
+    finally:
+        await on_shutdown()
+
+app = FastAPI(title="Pwned Check (Bank API)", lifespan=lifespan)
+
+_dataset = {"version": 0, "label": None, "updated_at": None}
+# /readyz: filled in by _warm_up(), phase durations in seconds
+_readiness = {"ready": False, "phase": None, "error": None, "phases_s": {}, "time_to_ready_s": None}
+
+async def _watch_dataset_version():
+    """Invalidate caches when an importer bumps dataset_version (or swaps tables)."""
+    global _dataset
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(DATASET_POLL_INTERVAL)
+        try:
+            info = await loop.run_in_executor(None, get_dataset_info)
+        except Exception as e:
+            print(f"⚠️ dataset version check failed: {e}")
+            continue
+        if info["version"] != _dataset["version"]:
+            print(f"🔄 Dataset version {_dataset['version']} -> {info['version']} "
+                  f"({info['label']}), invalidating caches")
+            invalidate_caches(info["version"])
+            _dataset = info
+
+@app.middleware("http")
+async def dataset_version_header(request: Request, call_next):
+    # one middleware for the header, request metrics and timing: each layer costs a task hop
+    started = time.perf_counter()
+    token = request_timing.start() if request_timing.settings()["enabled"] else None
+    status = 500
+    response = None
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Dataset-Version"] = str(_dataset["version"])
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        # the route template, not the raw path, keeps label cardinality bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        metrics.HTTP_REQUESTS.inc(path, request.method, str(status))
+        metrics.HTTP_DURATION.observe(elapsed, path)
+        if token is not None:
+            _finish_timing(token, response, elapsed, path, request.method, status)
+
+def _finish_timing(token, response, elapsed: float, route: str, method: str, status: int):
+    """Server-Timing header; slow requests are logged (with EXPLAIN) off the event loop."""
+    timings = request_timing.current()
+    request_timing.reset(token)
+    if response is not None:
+        response.headers["Server-Timing"] = timings.header(elapsed)
+    if request_timing.is_slow(elapsed):
+        entry = request_timing.slow_entry(timings, elapsed, route, method, status)
+        explain = explain_lookup if request_timing.want_explain(timings) else None
+        asyncio.get_running_loop().run_in_executor(None, request_timing.write_slow, entry, explain,
+                                                   timings.key)
+
+def _warm_up_phases():
+    """(name, fn, required): required phases are retried until they succeed."""
+    phases = []
+    if INIT_DB_ON_STARTUP and uses_postgres():
+        phases.append(("init_db", init_db, True))
+    phases += [
+        ("pool", warm_backend, True),        # DB_POOL_MIN_SIZE connections / map the store file
+        ("dataset", get_dataset_info, True),  # the version being served
+        ("filter", load_filter, False),       # BLOOM_FILTER_PATH: definite misses skip the backend
+        ("hot_set", load_hot_set, False),     # HOT_SET_PATH: top hashes answered from memory
+        ("prewarm", prewarm_index, False),    # PREWARM_INDEX
+    ]
+    return phases
+
+async def _warm_up(started: float):
+    """Everything that touches the database, off the event loop; /readyz flips when done."""
+    global _dataset
+    loop = asyncio.get_running_loop()
+    for name, fn, required in _warm_up_phases():
+        _readiness["phase"] = name
+        while True:
+            t0 = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(None, fn)
+            except Exception as e:
+                _readiness["error"] = f"{name}: {e}"
+                if not required:
+                    print(f"⚠️ warm-up {name} failed, continuing without it: {e}")
+                    break
+                print(f"⚠️ warm-up {name} failed, retrying in {WARM_UP_RETRY_INTERVAL:g}s: {e}")
+                await asyncio.sleep(WARM_UP_RETRY_INTERVAL)
+                continue
+            _readiness["phases_s"][name] = round(time.perf_counter() - t0, 3)
+            if name == "dataset":
+                _dataset = result
+            elif name == "filter" and result:
+                print(f"🧮 Bloom filter loaded: {filter_stats()}")
+            elif name == "hot_set" and result:
+                print(f"🔥 Hot set loaded: {hot_set_stats()}")
+            elif name == "prewarm" and result.get("mode") != "off" and "error" not in result:
+                print(f"🔥 Index prewarmed: {result}")
+            break
+    _readiness.update(ready=True, phase=None, error=None,
+                      time_to_ready_s=round(time.perf_counter() - started, 3))
+    app.state.dataset_watcher = asyncio.create_task(_watch_dataset_version())
+    phases = ", ".join(f"{k} {v:.2f}s" for k, v in _readiness["phases_s"].items())
+    print(f"✅ Ready in {_readiness['time_to_ready_s']:.2f}s ({phases})")
+
+def _readiness_samples():
+    samples = [("pwned_ready", "gauge", "Warm-up finished (/readyz)", (), (), int(_readiness["ready"]))]
+    for name, seconds in _readiness["phases_s"].items():
+        samples.append(("pwned_warm_up_phase_seconds", "gauge", "Duration of each warm-up phase",
+                        ("phase",), (name,), seconds))
+    return samples
+
+metrics.register_collector(_readiness_samples)
 
-@app.on_event("startup")
 async def on_startup():
-    t0 = time.time()
+    # no database work here: the port opens (and /healthz answers) at once,
+    # /readyz reports ready once _warm_up() has finished
+    started = time.perf_counter()
+    metrics.remove_stale_snapshots()
     load_api_keys()
-    init_db()            # ensure table exists (no in-memory load)
     load_hash_file(None) # kept for compatibility; returns 0
-    print(f"🔐 Startup complete (took {time.time()-t0:.2f}s)")
+    _readiness["phases_s"]["startup"] = round(time.perf_counter() - started, 3)
+    app.state.warm_up = asyncio.create_task(_warm_up(started))
+    app.state.metrics_flusher = asyncio.create_task(metrics.flush_periodically())
+    print(f"🔐 Startup complete (took {time.perf_counter()-started:.2f}s), warming up")
+
+async def on_shutdown():
+    app.state.warm_up.cancel()
+    if hasattr(app.state, "dataset_watcher"):
+        app.state.dataset_watcher.cancel()
+    app.state.metrics_flusher.cancel()
+    metrics.write_snapshot()  # exited workers still count towards the totals
+    close_pool()
 
 @app.get("/healthz")
 async def healthz():
     return {"ok": True, "message": "alive"}
 
+@app.get("/readyz")
+async def readyz():
+    """200 once the pool is warm, the dataset version is known and filters are loaded; 503 before."""
+    return JSONResponse(_readiness, status_code=200 if _readiness["ready"] else 503)
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text format, summed over every worker of this server."""
+    loop = asyncio.get_running_loop()
+    body = await loop.run_in_executor(None, metrics.exposition)
+    return Response(content=body, media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats")
+async def stats():
+    return {"dataset_version": _dataset["version"], "dataset": _dataset,
+            "backend": backend_stats(), "cache": cache_stats(),
+            "filter": filter_stats(), "hot_set": hot_set_stats(), "coalescer": coalescer_stats(),
+            "admission": admission_stats(),
+            "rate_limit": limiter.stats()}
+
+def _overloaded(e: Overloaded) -> HTTPException:
+    # shed before touching the database: cheap, and tells clients when to come back
+    return HTTPException(status_code=503, detail="Server overloaded, retry later",
+                         headers={"Retry-After": str(e.retry_after)})
+
+async def _lookup(sha1: str, api_key: str) -> int:
+    try:
+        return await lookup_async(sha1, key_priority(api_key))
+    except Overloaded as e:
+        raise _overloaded(e)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, retry later")
+
+def _parse_batch_body(body: bytes, content_type: str) -> list:
+    """Accept a JSON list, {"hashes": [...]} or newline-delimited text."""
+    if "json" in content_type:
+        try:
+            data = json.loads(body or b"[]")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="invalid JSON body")
+        if isinstance(data, dict):
+            data = data.get("hashes", [])
+        if not isinstance(data, list) or not all(isinstance(h, str) for h in data):
+            raise HTTPException(status_code=400, detail="expected a list of sha1 strings")
+        items = data
+    else:
+        items = body.decode("ascii", errors="replace").splitlines()
+    hashes = [h.strip().upper() for h in items if h.strip()]
+    if len(hashes) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"at most {MAX_BATCH_SIZE} hashes per request")
+    for h in hashes:
+        if len(h) != 40 or not set(h) <= HEX_DIGITS:
+            raise HTTPException(status_code=400, detail=f"invalid sha1: {h[:48]}")
+    return hashes
+
+async def _batch_body(hashes: list, priority: int):
+    """NDJSON results in input order, one set-based query (and admission) per chunk."""
+    for i in range(0, len(hashes), LOOKUP_MANY_CHUNK):
+        chunk = hashes[i:i + LOOKUP_MANY_CHUNK]
+        try:
+            found = await lookup_many_async(chunk, priority)
+        except Overloaded as e:
+            # headers are already sent; tell the client where the stream stopped
+            yield json.dumps({"error": "Server overloaded, retry later", "offset": i,
+                              "retry_after": e.retry_after}) + "\n"
+            return
+        except PoolTimeout:
+            yield json.dumps({"error": "Database busy, retry later", "offset": i}) + "\n"
+            return
+        yield "".join(
+            json.dumps({"sha1": h, "found": h in found, "count": found.get(h, 0)}) + "\n"
+            for h in chunk
+        )
+
+# registered before /check/{sha1} so the literal path is matched first
+@app.post("/check/batch")
+async def check_batch(request: Request, api_key: str = Depends(authenticate_api_key)):
+    hashes = _parse_batch_body(await request.body(), request.headers.get("content-type", ""))
+    enforce_rate_limit(api_key, cost=max(1, len(hashes)))
+    return StreamingResponse(_batch_body(hashes, key_priority(api_key)),
+                             media_type="application/x-ndjson")
+
+def _accepts_octet_stream(accept: str) -> bool:
+    """The q-value of the most specific matching media range decides; q=0 means not acceptable."""
+    if not accept:
+        return True
+    best = None  # (specificity, q)
+    for part in accept.split(","):
+        media, *params = (p.strip() for p in part.split(";"))
+        specificity = {OCTET_STREAM: 2, "application/*": 1, "*/*": 0}.get(media.lower())
+        if specificity is None:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if best is None or specificity > best[0]:
+            best = (specificity, q)
+    return best is not None and best[1] > 0
+
+async def _read_capped(request: Request, limit: int) -> bytes:
+    """The request body, or 413 as soon as it is longer than `limit` bytes."""
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > limit:
+        raise HTTPException(status_code=413, detail=f"at most {MAX_BINARY_BATCH} digests per request")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail=f"at most {MAX_BINARY_BATCH} digests per request")
+    return bytes(body)
+
+@app.post("/check/binary")
+async def check_binary(request: Request, api_key: str = Depends(authenticate_api_key)):
+    """
+    Body: concatenated raw 20-byte SHA1 digests (application/octet-stream).
+    Response: one little-endian u32 count per digest, same order.
+    """
+    if request.headers.get("content-type", "").split(";")[0].strip() != OCTET_STREAM:
+        raise HTTPException(status_code=415, detail=f"Content-Type must be {OCTET_STREAM}")
+    if not _accepts_octet_stream(request.headers.get("accept", "")):
+        raise HTTPException(status_code=406, detail=f"response is {OCTET_STREAM}")
+    body = await _read_capped(request, MAX_BINARY_BATCH * DIGEST_LEN)
+    if len(body) % DIGEST_LEN:
+        raise HTTPException(status_code=400, detail=f"body length must be a multiple of {DIGEST_LEN}")
+    n = len(body) // DIGEST_LEN
+    enforce_rate_limit(api_key, cost=max(1, n))
+    try:
+        counts = await lookup_digests_async(body, key_priority(api_key))
+    except Overloaded as e:
+        raise _overloaded(e)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, retry later")
+    return Response(content=pack_counts(counts), media_type=OCTET_STREAM)
+
 @app.get("/check/{sha1}")
-async def check_sha1(sha1: str, _auth: bool = Depends(verify_api_key)):
+async def check_sha1(sha1: str, api_key: str = Depends(verify_api_key)):
     h = sha1.strip().upper()
-    if len(h) != 40:
+    if len(h) != 40 or not set(h) <= HEX_DIGITS:
         raise HTTPException(status_code=400, detail="sha1 must be 40 hex chars")
-    count = lookup(h)
-    return JSONResponse({"found": count > 0, "count": count})
+    count = await _lookup(h, api_key)
+    with request_timing.phase("serialize"):
+        return JSONResponse({"found": count > 0, "count": count})
 
 @app.get("/check_password/{password}")
-async def check_password(password: str, _auth: bool = Depends(verify_api_key)):
+async def check_password(password: str, api_key: str = Depends(verify_api_key)):
     sha1 = hashlib.sha1(password.encode("utf-8")).hexdigest().upper()
-    count = lookup(sha1)
-    return JSONResponse({"password": password, "sha1": sha1, "found": count > 0, "count": count})
+    count = await _lookup(sha1, api_key)
+    with request_timing.phase("serialize"):
+        return JSONResponse({"password": password, "sha1": sha1, "found": count > 0, "count": count})
+
+def _range_body(rows, pad: bool):
+    """Yield 'SUFFIX:COUNT' lines as they come off the cursor, then padding rows."""
+    sent = 0
+    for suffix, count in rows:
+        yield f"{suffix}:{count}\r\n"
+        sent += 1
+    if pad:
+        target = random.randint(RANGE_PADDING_MIN, RANGE_PADDING_MAX)
+        suffix_len = 40 - RANGE_PREFIX_LEN
+        for _ in range(max(0, target - sent)):
+            yield f"{random.getrandbits(suffix_len * 4):0{suffix_len}X}:0\r\n"
+
+@app.get("/range/{prefix}")
+async def range_prefix(prefix: str, add_padding: bool = Header(False),
+                       api_key: str = Depends(verify_api_key)):
+    p = prefix.strip().upper()
+    if len(p) != RANGE_PREFIX_LEN or not set(p) <= HEX_DIGITS:
+        raise HTTPException(status_code=400, detail=f"prefix must be {RANGE_PREFIX_LEN} hex chars")
+    try:
+        rows = await range_query_async(p, key_priority(api_key))
+    except Overloaded as e:
+        raise _overloaded(e)
+    except PoolTimeout:
+        raise HTTPException(status_code=503, detail="Database busy, retry later")
+    return StreamingResponse(_range_body(rows, add_padding), media_type="text/plain")
@@ -18,17 +18,22 @@ def list_keys():
     keys = load_keys()
     print("🔑 Existing API Keys:")
     for k, v in keys.items():
-        print(f"  • {k}  →  {v.get('limit', 60)} req/min")
+        burst = f", burst {v['burst']}" if "burst" in v else ""
+        print(f"  • {k}  →  {v.get('limit', 60)} req/min{burst}")
 
-def add_key(label: str | None = None, limit: int = 60):
+def add_key(label: str | None = None, limit: int = 60, burst: int | None = None):
     keys = load_keys()
     token = secrets.token_urlsafe(24)
     label = label or token[:8]
-    keys[token] = {"limit": limit, "label": label}
+    keys[token] = {"limit": limit, "name": label}  # auth.key_label reads "name"
+    if burst is not None:
+        keys[token]["burst"] = burst
     save_keys(keys)
     print("✅ New key created:")
     print(token)
     print(f"limit: {limit}")
+    if burst is not None:
+        print(f"burst: {burst}")
 
 def remove_key(key: str):
     keys = load_keys()
@@ -44,14 +49,17 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Manage API keys (keys.json)")
     parser.add_argument("--list", action="store_true")
     parser.add_argument("--add", action="store_true")
-    parser.add_argument("--label", type=str, default=None)
+    parser.add_argument("--name", "--label", dest="label", type=str, default=None,
+                        help="label for the key in /metrics")
     parser.add_argument("--limit", type=int, default=60)
+    parser.add_argument("--burst", type=int, default=None,
+                        help="requests allowed back-to-back (defaults to --limit)")
     parser.add_argument("--remove", type=str, default=None)
     args = parser.parse_args()
     if args.list:
         list_keys()
     elif args.add:
-        add_key(args.label, args.limit)
+        add_key(args.label, args.limit, args.burst)
     elif args.remove:
         remove_key(args.remove)
     else:
@@ -0,0 +1,321 @@
+# metrics.py
+"""
+Prometheus metrics for the API, aggregated across uvicorn workers.
+
+Hot-path updates never take a lock: every thread (the event loop and each
+DB executor thread) increments its own shard of each metric, and shards
+are only summed when a snapshot is taken.
+
+Every worker writes its snapshot to METRICS_DIR/<pid>.json each
+METRICS_FLUSH_INTERVAL seconds (and on shutdown). /metrics merges the
+snapshots of the current server run, replacing its own file with live
+values:
+ - counters and histograms are summed over all workers, including ones
+   that have exited, so totals never go backwards when a worker restarts
+ - gauges (process stats, pool sizes) are reported per live worker, with
+   a pid label
+
+A worker's snapshot can be up to METRICS_FLUSH_INTERVAL seconds old. Files
+left by earlier server runs are removed when a worker starts (those of a
+server still running are kept). An empty
+METRICS_DIR keeps everything in-process (single worker).
+"""
+from __future__ import annotations
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+_default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(_default_dir, "pwned_metrics"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))  # seconds
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# (name, type, help, label names, label values, value), from collectors
+Sample = Tuple[str, str, str, Sequence[str], Sequence[str], float]
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards: List[Dict] = []
+        self._shards_lock = threading.Lock()
+        _registry.append(self)
+
+    def _shard(self) -> Dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:  # once per thread
+                self._shards.append(shard)
+            return shard
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def collect(self) -> Dict[Tuple, float]:
+        totals: Dict[Tuple, float] = {}
+        for shard in list(self._shards):
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+class Histogram(_Metric):
+    """Cumulative on read: each shard row is per-bucket counts followed by the sum."""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = list(buckets)
+
+    def observe(self, value: float, *labels: str):
+        shard = self._shard()
+        row = shard.get(labels)
+        if row is None:
+            row = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def collect(self) -> Dict[Tuple, List[float]]:
+        totals: Dict[Tuple, List[float]] = {}
+        for shard in list(self._shards):
+            for labels, row in list(shard.items()):
+                total = totals.setdefault(labels, [0] * len(row))
+                for i, v in enumerate(list(row)):
+                    total[i] += v
+        return totals
+
+_registry: List[_Metric] = []
+_collectors: List[Callable[[], List[Sample]]] = []
+
+def register_collector(fn: Callable[[], List[Sample]]):
+    """fn() is called at snapshot time for values owned elsewhere (pool, cache)."""
+    _collectors.append(fn)
+
+# =========================
+# INSTRUMENTS
+# =========================
+HTTP_REQUESTS = Counter("pwned_http_requests_total", "HTTP requests by route template and status",
+                        ("route", "method", "status"))
+HTTP_DURATION = Histogram("pwned_http_request_duration_seconds",
+                          "Time until the response started, by route template", ("route",))
+DB_ACQUIRE = Histogram("pwned_db_acquire_seconds", "Waiting for a pooled connection", ("op",))
+DB_QUERY = Histogram("pwned_db_query_seconds", "Running lookup queries on a pooled connection",
+                     ("op",))
+LOOKUPS = Counter("pwned_lookups_total", "Single-hash lookups by where they were answered",
+                  ("source", "result"))
+COALESCE_BATCH_SIZE = Histogram("pwned_coalescer_batch_size", "Keys per coalesced backend lookup",
+                                buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024))
+COALESCE_WAIT = Histogram("pwned_coalescer_wait_seconds", "Time a key waited for its batch to flush",
+                          buckets=(0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.002, 0.005, 0.01,
+                                   0.025, 0.05))
+AUTH_REQUESTS = Counter("pwned_auth_requests_total",
+                        "API key checks: ok, invalid (401), rate_limited (429) or too_large (413)", ("key", "result"))
+
+# =========================
+# SNAPSHOTS
+# =========================
+_started = time.time()
+
+def _process_samples() -> List[Sample]:
+    times = os.times()
+    samples: List[Sample] = [
+        ("process_cpu_seconds_total", "counter", "User and system CPU time", (), (),
+         times.user + times.system),
+        ("process_start_time_seconds", "gauge", "Process start time (unix seconds)", (), (), _started),
+    ]
+    try:
+        with open("/proc/self/statm") as fh:
+            rss = int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        samples.append(("process_resident_memory_bytes", "gauge", "Resident memory", (), (), rss))
+        samples.append(("process_open_fds", "gauge", "Open file descriptors", (), (),
+                        len(os.listdir("/proc/self/fd"))))
+    except (OSError, ValueError):
+        pass
+    return samples
+
+def _start_ticks(pid: int) -> str:
+    try:
+        with open(f"/proc/{pid}/stat") as fh:
+            return fh.read().rsplit(")", 1)[1].split()[19]
+    except (OSError, IndexError):
+        return "0"
+
+def _run_id() -> str:
+    """Same for every worker of one server: the supervisor's pid and start time."""
+    parent = multiprocessing.parent_process()
+    pid = parent.pid if parent is not None else os.getpid()
+    return f"{pid}-{_start_ticks(pid)}"
+
+def _run_alive(run: str) -> bool:
+    """The server run's supervisor is still the same process (not exited, pid not reused)."""
+    pid, _, ticks = str(run).partition("-")
+    try:
+        return _alive(int(pid)) and _start_ticks(int(pid)) == ticks
+    except ValueError:
+        return False
+
+_run = _run_id()
+
+def snapshot() -> Dict:
+    """This process's metrics in the METRICS_DIR file format."""
+    out: Dict[str, Dict] = {}
+    for metric in _registry:
+        entry = {"type": metric.type, "help": metric.help, "labels": list(metric.labels),
+                 "samples": [[list(k), v] for k, v in metric.collect().items()]}
+        if isinstance(metric, Histogram):
+            entry["buckets"] = metric.buckets
+        out[metric.name] = entry
+    for collector in [_process_samples] + _collectors:
+        try:
+            samples = collector()
+        except Exception as e:
+            print(f"⚠️ metrics collector failed: {e}")
+            continue
+        for name, kind, help, label_names, label_values, value in samples:
+            entry = out.setdefault(name, {"type": kind, "help": help, "labels": list(label_names),
+                                          "samples": []})
+            entry["samples"].append([list(label_values), value])
+    return {"pid": os.getpid(), "run": _run, "written": time.time(), "metrics": out}
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"{pid}.json")
+
+def write_snapshot():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path(os.getpid())
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(snapshot(), fh, separators=(",", ":"))
+    os.replace(tmp, path)
+
+def remove_stale_snapshots():
+    """
+    Delete snapshots written by a previous server run. Called at worker
+    startup. Another server sharing METRICS_DIR keeps its files: only those
+    whose worker and supervisor have both exited are removed.
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for snap in _read_snapshots():
+        if snap.get("run") != _run and not _alive(snap["pid"]) and not _run_alive(snap.get("run")):
+            try:
+                os.remove(_snapshot_path(snap["pid"]))
+            except OSError:
+                pass
+
+def _read_snapshots() -> List[Dict]:
+    snaps = []
+    for name in os.listdir(METRICS_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, name)) as fh:
+                snaps.append(json.load(fh))
+        except (OSError, ValueError):
+            continue  # being replaced
+    return snaps
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+async def flush_periodically():
+    while True:
+        try:
+            write_snapshot()
+        except OSError as e:
+            print(f"⚠️ metrics snapshot failed: {e}")
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+
+# =========================
+# EXPOSITION
+# =========================
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+def aggregate(snaps: List[Dict]) -> Dict[str, Dict]:
+    """Sum counters and histograms over all snapshots; keep gauges of live workers."""
+    merged: Dict[str, Dict] = {}
+    for snap in snaps:
+        live = _alive(snap["pid"])
+        for name, entry in snap["metrics"].items():
+            kind = entry["type"]
+            if kind == "gauge" and not live:
+                continue
+            target = merged.setdefault(name, {**entry, "samples": {}})
+            for labels, value in entry["samples"]:
+                if kind == "gauge":
+                    key = tuple(labels) + (str(snap["pid"]),)
+                    target["samples"][key] = value
+                elif kind == "histogram":
+                    row = target["samples"].setdefault(tuple(labels), [0] * len(value))
+                    for i, v in enumerate(value):
+                        row[i] += v
+                else:
+                    key = tuple(labels)
+                    target["samples"][key] = target["samples"].get(key, 0) + value
+    return merged
+
+def render(merged: Dict[str, Dict]) -> str:
+    lines = []
+    for name in sorted(merged):
+        entry = merged[name]
+        names = entry["labels"] + (["pid"] if entry["type"] == "gauge" else [])
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        for labels, value in sorted(entry["samples"].items()):
+            if entry["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, labels)} {_number(value)}")
+                continue
+            running = 0
+            for bound, count in zip(entry["buckets"] + [float("inf")], value[:-1]):
+                running += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f"{name}_bucket{_labels(names, labels, le)} {running}")
+            lines.append(f"{name}_sum{_labels(names, labels)} {_number(value[-1])}")
+            lines.append(f"{name}_count{_labels(names, labels)} {running}")
+    return "\n".join(lines) + "\n"
+
+def exposition() -> str:
+    """Prometheus text for the whole server run (all workers sharing METRICS_DIR)."""
+    own = snapshot()
+    snaps = [own]
+    if METRICS_DIR and os.path.isdir(METRICS_DIR):
+        snaps += [s for s in _read_snapshots() if s.get("run") == _run and s.get("pid") != own["pid"]]
+    return render(aggregate(snaps))
@@ -0,0 +1,110 @@
+# migrate_hashes.py
+"""
+Migrate the existing 'hashes' table to the compact layout in place.
+
+Usage:
+    python3 migrate_hashes.py --status
+    python3 migrate_hashes.py --migrate [--drop-old]
+    python3 migrate_hashes.py --drop-old
+
+Text layout:    sha1 CHAR(40) PRIMARY KEY, count BIGINT (+ redundant idx_hashes_sha1)
+Compact layout: sha1 BYTEA (20-byte digest) PRIMARY KEY, count INTEGER
+
+This script:
+ - copies hashes into hashes_compact (no index yet) with decode(sha1, 'hex'),
+   partitioned like hashes when hashes is partitioned
+ - builds the primary key once, with parallel maintenance workers
+ - ANALYZEs, then swaps the tables (and their partitions) by rename in one
+   short transaction, retried under lock_timeout like dataset_swap.py
+   (old table kept as hashes_text_old until --drop-old)
+ - bumps dataset_version so running API workers refresh
+
+Stop the importers while it runs; rows written to 'hashes' after the copy
+started are not carried over.
+"""
+from __future__ import annotations
+import argparse
+import time
+
+from dataset_swap import swap_tables
+from db_loader import get_conn, hashes_table_ddl, table_layout, table_partitions
+
+OLD_TABLE = "hashes_text_old"
+NEW_TABLE = "hashes_compact"
+
+def table_size(cur, table: str) -> str:
+    cur.execute("SELECT pg_size_pretty(pg_total_relation_size(to_regclass(%s)));", (table,))
+    return cur.fetchone()[0] or "-"
+
+def status(conn):
+    with conn.cursor() as cur:
+        print(f"📦 hashes layout: {table_layout(cur)}")
+        for table in ("hashes", NEW_TABLE, OLD_TABLE):
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+            if cur.fetchone()[0]:
+                print(f"   {table}: {table_size(cur, table)} (heap + indexes)")
+        cur.execute("SELECT to_regclass('idx_hashes_sha1') IS NOT NULL;")
+        if cur.fetchone()[0]:
+            print("   ⚠️ redundant index idx_hashes_sha1 present (dropped by --migrate)")
+
+def migrate(conn):
+    with conn.cursor() as cur:
+        if table_layout(cur) == "compact":
+            print("✅ hashes already uses the compact layout.")
+            return
+        cur.execute("SET maintenance_work_mem = '2GB';")
+        cur.execute("SET max_parallel_maintenance_workers = 4;")
+
+        partitions = len(table_partitions(cur))
+        print(f"📥 Copying hashes into {NEW_TABLE} ({partitions or 'no'} partitions; "
+              f"this may take a while)...")
+        started = time.time()
+        cur.execute(f"DROP TABLE IF EXISTS {NEW_TABLE};")
+        cur.execute(hashes_table_ddl("compact", NEW_TABLE, primary_key=False, partitions=partitions))
+        cur.execute(f"INSERT INTO {NEW_TABLE} (sha1, count) SELECT decode(sha1, 'hex'), count FROM hashes;")
+        rows = cur.rowcount
+        conn.commit()
+        print(f"✅ Copied {rows:,} rows in {time.time()-started:.2f}s")
+
+        print("🔧 Building primary key...")
+        started = time.time()
+        cur.execute(f"ALTER TABLE {NEW_TABLE} ADD CONSTRAINT {NEW_TABLE}_pkey PRIMARY KEY (sha1);")
+        conn.commit()
+        print(f"✅ Primary key built in {time.time()-started:.2f}s")
+
+        print("🔎 Running ANALYZE...")
+        cur.execute(f"ANALYZE {NEW_TABLE};")
+        conn.commit()
+
+        print("🔁 Swapping tables...")
+        # partitions are renamed too: hashes_pXX must be free for the new table's
+        version = swap_tables(conn, [(None, OLD_TABLE), ("hashes", OLD_TABLE), (NEW_TABLE, "hashes")],
+                              "migrate:compact", before=["DROP INDEX IF EXISTS idx_hashes_sha1;"])
+        print(f"✅ hashes now uses the compact layout (dataset version {version}).")
+        print(f"   old table kept as {OLD_TABLE}: {table_size(cur, OLD_TABLE)}")
+
+def drop_old(conn):
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {OLD_TABLE};")
+        conn.commit()
+    print(f"🧹 Dropped {OLD_TABLE}.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate 'hashes' to the compact BYTEA layout")
+    parser.add_argument("--status", action="store_true")
+    parser.add_argument("--migrate", action="store_true")
+    parser.add_argument("--drop-old", action="store_true")
+    args = parser.parse_args()
+    if not (args.status or args.migrate or args.drop_old):
+        parser.print_help()
+    else:
+        conn = get_conn()
+        try:
+            if args.status:
+                status(conn)
+            if args.migrate:
+                migrate(conn)
+            if args.drop_old:
+                drop_old(conn)
+        finally:
+            conn.close()
@@ -0,0 +1,308 @@
+# mmap_store.py
+"""
+Sorted fixed-width binary hash store, served through mmap.
+
+Usage:
+    python3 mmap_store.py build /path/to/pwnedpasswords.txt[.gz|.xz|.zst|.7z] /path/to/pwned.store [--filter F]
+    python3 mmap_store.py lookup /path/to/pwned.store <SHA1>
+    python3 mmap_store.py info /path/to/pwned.store
+
+File layout (little-endian):
+    header   : magic b"PWNDSTR1", record_count u64, prefix_bits u32, reserved u32,
+               built_at u64 (unix nanoseconds: also the store's identity)
+    offsets  : (2**prefix_bits + 1) x u64 - index of the first record for each
+               leading-bits prefix, so a lookup only bisects inside one bucket
+    records  : record_count x (20-byte SHA1 digest + u32 count), sorted by digest
+
+The file is opened read-only with mmap, so every uvicorn worker on a host
+shares the same page-cache copy instead of holding its own (unlike the old
+in-memory HASHES dict).
+
+A build also rebuilds the Bloom filter at --filter (default
+BLOOM_FILTER_PATH) from the new store; the API ignores a filter built
+from a different store (see bloom_filter.py).
+"""
+from __future__ import annotations
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+MAGIC = b"PWNDSTR1"
+HEADER = struct.Struct("<8sQIIQ")
+DIGEST_LEN = 20
+RECORD = struct.Struct("<20sI")
+RECORD_LEN = RECORD.size  # 24
+PREFIX_BITS = 16
+MAX_COUNT = 0xFFFFFFFF
+
+# external sort: records held in memory per run (24 bytes each + list overhead)
+BUILD_RUN_RECORDS = int(os.getenv("STORE_BUILD_RUN_RECORDS", "5000000"))
+
+class StoreFormatError(Exception):
+    pass
+
+class HashStore:
+    """Read-only view over a store file; lookups are a bucket bisect over the mmap."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fh = open(path, "rb")
+        try:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._fh.close()
+            raise StoreFormatError(f"{path}: empty file")
+        if len(self._mm) < HEADER.size:
+            self.close()
+            raise StoreFormatError(f"{path}: truncated header")
+        magic, self.record_count, self.prefix_bits, _, self.built_at = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise StoreFormatError(f"{path}: bad magic {magic!r}")
+        n_offsets = (1 << self.prefix_bits) + 1
+        self._offsets = memoryview(self._mm)[HEADER.size:HEADER.size + 8 * n_offsets].cast("Q")
+        self._data_start = HEADER.size + 8 * n_offsets
+        expected = self._data_start + self.record_count * RECORD_LEN
+        if len(self._mm) != expected:
+            self.close()
+            raise StoreFormatError(f"{path}: size {len(self._mm)} != expected {expected}")
+        self._inode = os.fstat(self._fh.fileno()).st_ino
+
+    def close(self):
+        if getattr(self, "_offsets", None) is not None:
+            self._offsets.release()
+            self._offsets = None
+        if getattr(self, "_mm", None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._fh.close()
+
+    def is_stale(self) -> bool:
+        """True when the path now points at a different file (store was rebuilt)."""
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return False
+
+    def _bucket(self, digest: bytes) -> Tuple[int, int]:
+        b = int.from_bytes(digest[:4], "big") >> (32 - self.prefix_bits)
+        return self._offsets[b], self._offsets[b + 1]
+
+    def lookup(self, digest: bytes) -> int:
+        """Count for a 20-byte digest (bytes or a buffer slice), 0 if absent."""
+        if not isinstance(digest, bytes):
+            digest = bytes(digest)
+        mm, base = self._mm, self._data_start
+        lo, hi = self._bucket(digest)
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            off = base + mid * RECORD_LEN
+            key = mm[off:off + DIGEST_LEN]
+            if key < digest:
+                lo = mid + 1
+            elif key > digest:
+                hi = mid
+            else:
+                return int.from_bytes(mm[off + DIGEST_LEN:off + RECORD_LEN], "little")
+        return 0
+
+    def lookup_hex(self, sha1_hex_upper: str) -> int:
+        return self.lookup(bytes.fromhex(sha1_hex_upper))
+
+    def lookup_many_hex(self, sha1s: Sequence[str]) -> Dict[str, int]:
+        found: Dict[str, int] = {}
+        for h in sha1s:
+            count = self.lookup(bytes.fromhex(h))
+            if count:
+                found[h] = count
+        return found
+
+    def _lower_bound(self, digest: bytes) -> int:
+        mm, base = self._mm, self._data_start
+        lo, hi = self._bucket(digest)
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            off = base + mid * RECORD_LEN
+            if mm[off:off + DIGEST_LEN] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_prefix(self, prefix_hex_upper: str) -> Iterator[Tuple[str, int]]:
+        """(full hex sha1, count) for every record whose hex digest starts with the prefix."""
+        lo = self._lower_bound(bytes.fromhex(prefix_hex_upper.ljust(40, "0")))
+        mm, base = self._mm, self._data_start
+        plen = len(prefix_hex_upper)
+        for i in range(lo, self.record_count):
+            off = base + i * RECORD_LEN
+            digest, count = RECORD.unpack_from(mm, off)
+            h = digest.hex().upper()
+            if h[:plen] != prefix_hex_upper:
+                break
+            yield h, count
+
+    def info(self) -> Dict:
+        return {
+            "path": self.path,
+            "records": self.record_count,
+            "prefix_bits": self.prefix_bits,
+            "bytes": len(self._mm),
+            "built_at": self.built_at,
+        }
+
+def read_store_version(path: str) -> int:
+    """built_at stamp of the store file currently at path (0 if missing)."""
+    try:
+        with open(path, "rb") as fh:
+            magic, _, _, _, built_at = HEADER.unpack(fh.read(HEADER.size))
+    except (FileNotFoundError, struct.error):
+        return 0
+    return built_at if magic == MAGIC else 0
+
+# =========================
+# BUILDER
+# =========================
+def parse_hash_lines(lines: Iterable[bytes]) -> Iterator[bytes]:
+    """Yield packed records for valid 'SHA1:COUNT' lines, skipping anything else."""
+    for line in lines:
+        sha1, sep, count = line.strip().partition(b":")
+        if not sep or len(sha1) != 40 or not count.isdigit():
+            continue
+        try:
+            digest = bytes.fromhex(sha1.decode("ascii"))
+        except ValueError:
+            continue
+        yield RECORD.pack(digest, min(int(count), MAX_COUNT))
+
+def _write_run(records: List[bytes], tmpdir: str) -> str:
+    records.sort()
+    fd, path = tempfile.mkstemp(prefix="run-", suffix=".bin", dir=tmpdir)
+    with os.fdopen(fd, "wb", buffering=1024 * 1024) as fh:
+        fh.write(b"".join(records))
+    return path
+
+def _read_run(path: str) -> Iterator[bytes]:
+    with open(path, "rb", buffering=1024 * 1024) as fh:
+        while True:
+            rec = fh.read(RECORD_LEN)
+            if len(rec) < RECORD_LEN:
+                return
+            yield rec
+
+def write_store(records: Iterable[bytes], output_path: str, prefix_bits: int = PREFIX_BITS,
+                filter_path: str = "") -> int:
+    """
+    Write digest-sorted packed records to output_path (atomically via rename).
+    Duplicate digests are merged keeping the highest count. Returns the record count.
+    With filter_path, the Bloom filter is rebuilt from the new store before it
+    is renamed into place, so the filter never lacks hashes the store serves.
+    """
+    n_offsets = (1 << prefix_bits) + 1
+    shift = 32 - prefix_bits
+    bucket_counts = [0] * (1 << prefix_bits)
+    tmp_path = output_path + ".tmp"
+    written = 0
+    with open(tmp_path, "wb", buffering=4 * 1024 * 1024) as out:
+        out.write(b"\0" * (HEADER.size + 8 * n_offsets))  # patched at the end
+        prev_digest, prev_count = None, 0
+        for rec in records:
+            digest, count = RECORD.unpack(rec)
+            if digest == prev_digest:
+                prev_count = max(prev_count, count)
+                continue
+            if prev_digest is not None:
+                out.write(RECORD.pack(prev_digest, prev_count))
+                bucket_counts[int.from_bytes(prev_digest[:4], "big") >> shift] += 1
+                written += 1
+            prev_digest, prev_count = digest, count
+        if prev_digest is not None:
+            out.write(RECORD.pack(prev_digest, prev_count))
+            bucket_counts[int.from_bytes(prev_digest[:4], "big") >> shift] += 1
+            written += 1
+
+        offsets, total = [], 0
+        for c in bucket_counts:
+            offsets.append(total)
+            total += c
+        offsets.append(total)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, written, prefix_bits, 0, time.time_ns()))
+        out.write(struct.pack(f"<{n_offsets}Q", *offsets))
+    if filter_path:
+        from bloom_filter import build_from_store
+        build_from_store(tmp_path, filter_path)
+    os.replace(tmp_path, output_path)
+    return written
+
+def sorted_records(lines: Iterable[bytes], run_records: int = BUILD_RUN_RECORDS,
+                   tmpdir: str | None = None) -> Iterator[bytes]:
+    """
+    External sort of parsed lines: sorted runs of at most run_records are
+    spilled to temp files and k-way merged, so memory stays bounded by the
+    run size whatever the input size.
+    """
+    with tempfile.TemporaryDirectory(prefix="pwned-store-", dir=tmpdir) as workdir:
+        runs: List[str] = []
+        batch: List[bytes] = []
+        for rec in parse_hash_lines(lines):
+            batch.append(rec)
+            if len(batch) >= run_records:
+                runs.append(_write_run(batch, workdir))
+                print(f"   ... sorted run {len(runs)} ({len(runs) * run_records:,} records)")
+                batch = []
+        if not runs:
+            batch.sort()
+            yield from batch
+            return
+        if batch:
+            runs.append(_write_run(batch, workdir))
+        batch = []
+        yield from heapq.merge(*(_read_run(p) for p in runs))
+
+def build_store(input_path: str, output_path: str, run_records: int = BUILD_RUN_RECORDS,
+                filter_path: str = "") -> int:
+    """
+    Convert a 'SHA1:COUNT' text file (the load_to_postgres.py input, plain or
+    .gz/.xz/.zst/.7z) into a store file, and its Bloom filter with filter_path.
+    """
+    from importer_common import open_input  # import pipeline only; keeps API startup light
+    print(f"📥 Building {output_path} from {input_path} ...")
+    started = time.time()
+    with open_input(input_path) as fh:
+        written = write_store(sorted_records(fh, run_records, os.path.dirname(os.path.abspath(output_path))),
+                              output_path, filter_path=filter_path)
+    print(f"✅ Wrote {written:,} records in {time.time()-started:.2f}s")
+    return written
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build or query a mmap hash store")
+    sub = parser.add_subparsers(dest="cmd")
+    p_build = sub.add_parser("build")
+    p_build.add_argument("input")
+    p_build.add_argument("output")
+    p_build.add_argument("--run-records", type=int, default=BUILD_RUN_RECORDS)
+    p_build.add_argument("--filter", default=os.getenv("BLOOM_FILTER_PATH", ""),
+                         help="Bloom filter to rebuild with the store (default $BLOOM_FILTER_PATH)")
+    p_lookup = sub.add_parser("lookup")
+    p_lookup.add_argument("store")
+    p_lookup.add_argument("sha1")
+    p_info = sub.add_parser("info")
+    p_info.add_argument("store")
+    args = parser.parse_args()
+    if args.cmd == "build":
+        build_store(args.input, args.output, args.run_records, args.filter)
+    elif args.cmd == "lookup":
+        store = HashStore(args.store)
+        print(store.lookup_hex(args.sha1.strip().upper()))
+    elif args.cmd == "info":
+        print(HashStore(args.store).info())
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,144 @@
+# ratelimit.py
+"""
+Host-wide GCRA (token bucket) rate limiter shared by all uvicorn workers.
+
+State is one "theoretical arrival time" (TAT) per API key, stored in a small
+shared-memory file (RATE_LIMIT_SHM_PATH, /dev/shm by default) so every
+worker process on the host enforces the same limit. The file is split into
+buckets of SLOTS_PER_BUCKET slots; a key always lives in the bucket picked
+by its fingerprint, and each bucket stripe has its own lock (a thread lock
+plus an fcntl byte-range lock), so keys never contend on one global lock.
+
+GCRA for a key with `limit` units per RATE_LIMIT_WINDOW and `burst` units:
+    T   = window / limit         (time per unit)
+    tau = T * burst              (how far ahead of now the TAT may run)
+    new_tat = max(tat, now) + cost * T;  allow iff new_tat - now <= tau
+A TAT in the past is the same as "no state", which is what lets idle slots
+be reused without any cleanup pass. Hence cost <= burst: a larger cost can
+never be allowed, and acquire() answers TOO_LARGE for it instead of DENIED.
+"""
+from __future__ import annotations
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Dict
+
+RATE_LIMIT_WINDOW = 60  # seconds
+RATE_LIMIT_SHARED = os.getenv("RATE_LIMIT_SHARED", "1") == "1"
+_default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+RATE_LIMIT_SHM_PATH = os.getenv("RATE_LIMIT_SHM_PATH", os.path.join(_default_dir, "pwned_ratelimit"))
+
+NUM_BUCKETS = 2048
+SLOTS_PER_BUCKET = 8
+NUM_STRIPES = 64          # lock stripes (bucket % NUM_STRIPES)
+SLOT = struct.Struct("<Qd")  # key fingerprint, TAT (CLOCK_MONOTONIC seconds)
+BUCKET_BYTES = SLOT.size * SLOTS_PER_BUCKET
+TABLE_BYTES = BUCKET_BYTES * NUM_BUCKETS
+
+# acquire() results (also the AUTH_REQUESTS "result" label values)
+ALLOWED = "ok"
+DENIED = "rate_limited"
+TOO_LARGE = "too_large"
+
+class SharedRateLimiter:
+    def __init__(self, path: str = RATE_LIMIT_SHM_PATH, shared: bool = RATE_LIMIT_SHARED):
+        self.path = path if shared else None
+        self._stripe_locks = [threading.Lock() for _ in range(NUM_STRIPES)]
+        self._fd = -1
+        self._pid = -1
+        self._mm = None
+        self._init_lock = threading.Lock()
+        self._fingerprints: Dict[str, int] = {}
+        self.allowed = 0
+        self.denied = 0
+        self.too_large = 0
+        self.overflows = 0
+
+    def _table(self):
+        # (re)open per process: fcntl locks and mappings must not be shared across fork
+        if self._mm is not None and self._pid == os.getpid():
+            return self._mm
+        with self._init_lock:
+            if self._mm is None or self._pid != os.getpid():
+                if self.path is None:
+                    self._mm = mmap.mmap(-1, TABLE_BYTES)
+                else:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    if os.fstat(fd).st_size < TABLE_BYTES:
+                        os.ftruncate(fd, TABLE_BYTES)  # zero-filled; idempotent across workers
+                    self._fd = fd
+                    self._mm = mmap.mmap(fd, TABLE_BYTES)
+                self._pid = os.getpid()
+        return self._mm
+
+    def acquire(self, key: str, limit: int, burst: int, cost: int = 1) -> str:
+        """
+        Charge `cost` units to `key`. Returns ALLOWED, DENIED (retry later)
+        or TOO_LARGE (cost > burst: no retry will ever be allowed).
+        """
+        if limit <= 0:
+            self.denied += 1
+            return DENIED
+        if cost > max(burst, 1):
+            self.too_large += 1
+            return TOO_LARGE
+        mm = self._table()
+        fp = self._fingerprints.get(key)
+        if fp is None:
+            fp = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+            if len(self._fingerprints) < 100_000:
+                self._fingerprints[key] = fp
+        bucket = fp % NUM_BUCKETS
+        base = bucket * BUCKET_BYTES
+        stripe = bucket % NUM_STRIPES
+        interval = RATE_LIMIT_WINDOW / limit
+        tolerance = interval * max(burst, 1)
+
+        with self._stripe_locks[stripe]:
+            if self._fd >= 0:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, BUCKET_BYTES, base)
+            try:
+                now = time.monotonic()
+                slot_off = free_off = -1
+                for i in range(SLOTS_PER_BUCKET):
+                    off = base + i * SLOT.size
+                    slot_fp, tat = SLOT.unpack_from(mm, off)
+                    if slot_fp == fp:
+                        slot_off = off
+                        break
+                    if free_off < 0 and (slot_fp == 0 or tat <= now):
+                        free_off = off  # empty, or idle long enough to be "no state"
+                if slot_off < 0:
+                    if free_off < 0:
+                        # bucket full of active keys: fail open rather than punish
+                        self.overflows += 1
+                        self.allowed += 1
+                        return ALLOWED
+                    slot_off, tat = free_off, now
+                new_tat = max(tat, now) + cost * interval
+                # slack for float rounding, so cost == burst passes on an idle key
+                if new_tat - now > tolerance + interval * 1e-6:
+                    self.denied += 1
+                    return DENIED
+                SLOT.pack_into(mm, slot_off, fp, new_tat)
+                self.allowed += 1
+                return ALLOWED
+            finally:
+                if self._fd >= 0:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, BUCKET_BYTES, base)
+
+    def stats(self) -> Dict:
+        return {
+            "shared_path": self.path,
+            "allowed": self.allowed,
+            "denied": self.denied,
+            "too_large": self.too_large,
+            "bucket_overflows": self.overflows,
+        }
+
+limiter = SharedRateLimiter()
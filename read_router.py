@@ -0,0 +1,340 @@
+# read_router.py
+"""
+Routing of API lookups over several Postgres read endpoints.
+
+Usage:
+    DB_READ_HOSTS=replica1,replica2:5433 python3 read_router.py   (probe once and print)
+
+With DB_READ_HOSTS set (comma-separated host[:port]), db_loader.get_pool()
+returns a ReadRouter instead of a single ConnectionPool. It has the same
+interface, so every lookup path is routed:
+ - one ConnectionPool (DB_POOL_* sizes) per endpoint
+ - each connection goes to the eligible endpoint with the fewest
+   outstanding connections; if opening one fails, the next is tried, and
+   a lookup whose connection breaks mid-query is retried once on the next
+ - DB_EJECT_AFTER consecutive connection errors eject an endpoint; a
+   background probe every DB_HEALTH_INTERVAL seconds ejects unreachable
+   endpoints and reinstates recovered ones
+ - the probe also reads replay lag and dataset_version: an endpoint more
+   than DB_MAX_REPLICA_LAG seconds behind (0 = ignore lag), or still on an
+   older dataset_version than the primary after an import, is "lagging"
+   and skipped while others are eligible
+ - with nothing eligible, lookups fall back to the primary (DB_HOST)
+   unless DB_READ_FALLBACK_PRIMARY=0, in which case the least-bad endpoint
+   is tried anyway
+
+Importers, init_db() and the dataset version watcher always use the
+primary. Several local Postgres instances on different ports, or the same
+server listed twice, are enough to try it out.
+"""
+from __future__ import annotations
+import os
+import random
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import psycopg2
+
+DB_READ_HOSTS = os.getenv("DB_READ_HOSTS", "")
+DB_READ_FALLBACK_PRIMARY = os.getenv("DB_READ_FALLBACK_PRIMARY", "1") == "1"
+DB_HEALTH_INTERVAL = float(os.getenv("DB_HEALTH_INTERVAL", "5"))   # seconds between probes
+DB_HEALTH_TIMEOUT = int(os.getenv("DB_HEALTH_TIMEOUT", "2"))       # probe connect_timeout, seconds
+DB_EJECT_AFTER = int(os.getenv("DB_EJECT_AFTER", "3"))             # consecutive connection errors
+DB_MAX_REPLICA_LAG = float(os.getenv("DB_MAX_REPLICA_LAG", "0"))   # seconds; 0 = ignore lag
+
+# a replica whose WAL is fully replayed is current even if the primary has been idle
+HEALTH_SQL = """
+SELECT pg_is_in_recovery(),
+       CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            THEN 0
+            ELSE coalesce(extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0)
+       END;
+"""
+
+def connection_broken(conn, error: Exception) -> bool:
+    """
+    True when `error` lost the connection itself. Query cancellations, lock
+    timeouts and serialization failures are OperationalErrors too, but leave
+    the connection usable and say nothing about the endpoint.
+    """
+    return isinstance(error, psycopg2.InterfaceError) or bool(conn.closed)
+
+def parse_hosts(text: str, default_port: str) -> List[Tuple[str, str]]:
+    hosts = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, _, port = item.rpartition(":") if item.count(":") == 1 else (item, "", "")
+        hosts.append((host, port or default_port))
+    return hosts
+
+class Endpoint:
+    def __init__(self, host: str, port: str, pool):
+        self.name = f"{host}:{port}"
+        self.host, self.port, self.pool = host, port, pool
+        self.outstanding = 0
+        self.failures = 0          # consecutive connection errors
+        self.ejected = False
+        self.lagging = False
+        self.in_recovery: Optional[bool] = None
+        self.lag: Optional[float] = None
+        self.version: Optional[int] = None
+        self.routed = 0
+        self.ejections = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def state(self) -> str:
+        if self.ejected:
+            return "ejected"
+        return "lagging" if self.lagging else "ok"
+
+    def info(self) -> Dict:
+        return {"endpoint": self.name, "state": self.state, "outstanding": self.outstanding,
+                "in_recovery": self.in_recovery, "lag_s": self.lag, "dataset_version": self.version,
+                "routed": self.routed, "ejections": self.ejections, "failures": self.failures,
+                "last_error": self.last_error, "pool": self.pool.stats()}
+
+class ReadRouter:
+    """
+    ConnectionPool look-alike over several read endpoints (see module docstring).
+    make_pool(connect, min_size) builds one endpoint's pool; connect(host, port,
+    **kwargs) opens a raw connection.
+    """
+
+    def __init__(self, hosts: List[Tuple[str, str]], primary: Tuple[str, str],
+                 make_pool: Callable, connect: Callable, min_size: int):
+        self._connect = connect
+        self.endpoints = [Endpoint(h, p, make_pool(self._connector(h, p), min_size)) for h, p in hosts]
+        # fallback only, so it opens connections on demand
+        self.primary = Endpoint(primary[0], primary[1], make_pool(self._connector(*primary), 0))
+        self._lock = threading.Lock()
+        self._conns: Dict[int, Endpoint] = {}
+        self._stop = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+        self._min_version: Optional[int] = None  # last dataset_version seen on the primary
+
+    def _connector(self, host: str, port: str) -> Callable:
+        return lambda: self._connect(host, port)
+
+    # -------- routing --------
+    def _order(self) -> List[Endpoint]:
+        """Endpoints to try for one connection, best first."""
+        with self._lock:
+            eligible = [e for e in self.endpoints if e.state == "ok"]
+            eligible.sort(key=lambda e: (e.outstanding, random.random()))
+            if DB_READ_FALLBACK_PRIMARY:
+                return eligible + [self.primary]
+            rest = [e for e in self.endpoints if e.state != "ok"]
+            rest.sort(key=lambda e: (e.ejected, e.outstanding))
+            return eligible + rest
+
+    def getconn(self, timeout: Optional[float] = None, skip: Optional[Endpoint] = None):
+        last_error: Optional[Exception] = None
+        for ep in self._order():
+            if ep is skip:
+                continue
+            with self._lock:
+                ep.outstanding += 1
+            try:
+                conn = ep.pool.getconn(timeout)
+            except psycopg2.Error as e:
+                # could not open a connection: count it and fail over
+                with self._lock:
+                    ep.outstanding -= 1
+                self._failed(ep, e)
+                last_error = e
+                continue
+            except Exception:
+                with self._lock:
+                    ep.outstanding -= 1
+                raise  # pool saturated or closed: not the endpoint's fault
+            with self._lock:
+                self._conns[id(conn)] = ep
+                ep.routed += 1
+            return conn
+        raise last_error if last_error is not None else psycopg2.OperationalError("no read endpoint")
+
+    def putconn(self, conn, discard: bool = False):
+        with self._lock:
+            ep = self._conns.pop(id(conn))
+            ep.outstanding -= 1
+        if discard:
+            self._failed(ep, None)  # callers discard after connection errors
+        else:
+            ep.failures = 0
+        ep.pool.putconn(conn, discard)
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None, skip: Optional[Endpoint] = None):
+        conn = self.getconn(timeout, skip)
+        try:
+            yield conn
+        except psycopg2.Error as e:
+            self.putconn(conn, discard=connection_broken(conn, e))
+            raise
+        except Exception:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def run(self, fn: Callable, timeout: Optional[float] = None):
+        """
+        fn(conn) on a routed connection; returns its result. fn must be
+        read-only: when the connection breaks under it, it is discarded and
+        fn runs once more on the next endpoint, so one failing replica costs
+        a lookup a retry instead of an error.
+        """
+        failed: Optional[Endpoint] = None
+        try:
+            with self.connection(timeout) as conn:
+                with self._lock:
+                    ep = self._conns[id(conn)]
+                try:
+                    return fn(conn)
+                except psycopg2.Error as e:
+                    if connection_broken(conn, e):
+                        failed = ep
+                    raise
+        except psycopg2.Error as e:
+            if failed is None:
+                raise  # a query error, or getconn already tried every endpoint
+            print(f"⚠️ Read endpoint {failed.name} failed a lookup, retrying elsewhere: {str(e).strip()}")
+        with self.connection(timeout, skip=failed) as conn:
+            return fn(conn)
+
+    def _failed(self, ep: Endpoint, error: Optional[Exception]):
+        eject = False
+        with self._lock:
+            ep.failures += 1
+            ep.last_error = str(error).strip() if error is not None else "connection broke during a query"
+            if ep is not self.primary and not ep.ejected and ep.failures >= DB_EJECT_AFTER:
+                ep.ejected = eject = True
+                ep.ejections += 1
+        if eject:
+            print(f"⚠️ Read endpoint {ep.name} ejected after {ep.failures} errors: {ep.last_error}")
+            ep.pool.recycle()
+
+    def require_version(self, version: int):
+        """Skip endpoints last seen on an older dataset_version until a probe shows they caught up."""
+        with self._lock:
+            self._min_version = version
+            for ep in self.endpoints:
+                if ep.version is not None and ep.version < version:
+                    ep.lagging = True
+
+    # -------- health --------
+    def probe(self, ep: Endpoint) -> Dict:
+        """One short-lived connection: recovery state, replay lag, dataset version."""
+        conn = self._connect(ep.host, ep.port, connect_timeout=DB_HEALTH_TIMEOUT)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(HEALTH_SQL)
+                in_recovery, lag = cur.fetchone()
+                cur.execute("SELECT to_regclass('dataset_version') IS NOT NULL;")
+                version = None
+                if cur.fetchone()[0]:
+                    cur.execute("SELECT version FROM dataset_version WHERE id = 1;")
+                    row = cur.fetchone()
+                    version = int(row[0]) if row else 0
+            return {"in_recovery": bool(in_recovery), "lag": float(lag), "version": version}
+        finally:
+            conn.close()
+
+    def check_health(self):
+        try:
+            primary_version = self.probe(self.primary)["version"]
+            self._min_version = primary_version
+        except psycopg2.Error:
+            primary_version = self._min_version  # last known; may be None
+        for ep in self.endpoints:
+            try:
+                result = self.probe(ep)
+            except psycopg2.Error as e:
+                with self._lock:
+                    ep.last_error = str(e).strip()
+                    newly = not ep.ejected
+                    if newly:
+                        ep.ejected = True
+                        ep.ejections += 1
+                if newly:
+                    print(f"⚠️ Read endpoint {ep.name} ejected: health check failed: {ep.last_error}")
+                    ep.pool.recycle()
+                continue
+            behind = (primary_version is not None and result["version"] is not None
+                      and result["version"] < primary_version)
+            lagging = behind or bool(DB_MAX_REPLICA_LAG and result["lag"] > DB_MAX_REPLICA_LAG)
+            with self._lock:
+                reinstated = ep.ejected
+                ep.ejected = False
+                ep.failures = 0
+                ep.in_recovery, ep.lag, ep.version = result["in_recovery"], result["lag"], result["version"]
+                changed = lagging != ep.lagging
+                ep.lagging = lagging
+            if reinstated:
+                print(f"✅ Read endpoint {ep.name} reinstated")
+            if changed:
+                print(f"{'⏳' if lagging else '✅'} Read endpoint {ep.name} "
+                      f"{'is lagging' if lagging else 'caught up'} (lag {result['lag']:.1f}s, "
+                      f"dataset version {result['version']} vs primary {primary_version})")
+
+    def _health_loop(self):
+        while not self._stop.wait(DB_HEALTH_INTERVAL):
+            try:
+                self.check_health()
+            except Exception as e:
+                print(f"⚠️ read endpoint health check failed: {e}")
+
+    # -------- ConnectionPool interface --------
+    def warm(self) -> int:
+        """Warm every endpoint (unreachable ones are ejected), probe once, start the health loop."""
+        size = 0
+        for ep in self.endpoints:
+            try:
+                size += ep.pool.warm()
+            except psycopg2.Error as e:
+                for _ in range(max(1, DB_EJECT_AFTER - ep.failures)):
+                    self._failed(ep, e)
+        if not any(ep.state != "ejected" for ep in self.endpoints) and not DB_READ_FALLBACK_PRIMARY:
+            raise psycopg2.OperationalError("no read endpoint reachable")
+        self.check_health()
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=self._health_loop, name="db-health",
+                                                   daemon=True)
+            self._health_thread.start()
+        return size
+
+    def recycle(self):
+        for ep in self.endpoints + [self.primary]:
+            ep.pool.recycle()
+
+    def close(self):
+        self._stop.set()
+        for ep in self.endpoints + [self.primary]:
+            ep.pool.close()
+
+    def stats(self) -> Dict:
+        endpoints = [ep.info() for ep in self.endpoints + [self.primary]]
+        totals = {}
+        for field in ("size", "in_use", "idle", "waiting", "acquired", "timeouts", "discarded"):
+            totals[field] = sum(e["pool"].get(field, 0) for e in endpoints)
+        endpoints[-1]["endpoint"] += " (primary)"
+        return {**totals, "endpoints": endpoints}
+
+if __name__ == "__main__":
+    from db_loader import DB_HOST, DB_PORT, connect_to
+    hosts = parse_hosts(DB_READ_HOSTS, DB_PORT)
+    if not hosts:
+        raise SystemExit("DB_READ_HOSTS is not set (comma-separated host[:port]).")
+    router = ReadRouter(hosts, (DB_HOST, DB_PORT), lambda connect, min_size: None, connect_to, 0)
+    for ep in [router.primary] + router.endpoints:
+        try:
+            r = router.probe(ep)
+            role = "replica" if r["in_recovery"] else "primary"
+            print(f"✅ {ep.name}: {role}, lag {r['lag']:.1f}s, dataset version {r['version']}")
+        except psycopg2.Error as e:
+            print(f"❌ {ep.name}: {str(e).strip()}")
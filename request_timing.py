@@ -0,0 +1,202 @@
+# request_timing.py
+"""
+Per-request timing breakdown (Server-Timing header) and slow-request log.
+
+Usage:
+    python3 request_timing.py --enable [--slow-ms 250] [--no-explain]
+    python3 request_timing.py --disable
+    python3 request_timing.py --status
+
+When enabled, every request carries a Timings object in a context
+variable; auth, pool acquire (plus connection setup), the lookup query,
+the lookup as awaited by the handler, and response serialization add
+their durations to it, and the middleware returns them as
+
+    Server-Timing: auth;dur=0.08, db_acquire;dur=0.02, db_query;dur=0.61, total;dur=1.02
+
+Requests slower than slow_ms are written as one JSON line to SLOW_LOG_PATH
+(stdout if empty) with their phases, the route template, the hash prefix
+and, for single-hash lookups, EXPLAIN (ANALYZE, BUFFERS) of the lookup,
+run after the response and at most once per SLOW_EXPLAIN_INTERVAL.
+Passwords and full hashes are never logged.
+
+The switch is TIMING_CONTROL_PATH, a small JSON file shared by all workers
+and re-read at most once a second, so it flips at runtime without a
+restart. Disabled, a request costs one cached flag check.
+"""
+from __future__ import annotations
+import argparse
+import contextvars
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+_default_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+TIMING_CONTROL_PATH = os.getenv("TIMING_CONTROL_PATH", os.path.join(_default_dir, "pwned_timing.json"))
+TIMING_ENABLED = os.getenv("TIMING_ENABLED", "0") == "1"   # default when there is no control file
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "250"))
+SLOW_LOG_PATH = os.getenv("SLOW_LOG_PATH", "")
+SLOW_EXPLAIN_INTERVAL = float(os.getenv("SLOW_EXPLAIN_INTERVAL", "1.0"))  # seconds between EXPLAINs
+CONTROL_CHECK_INTERVAL = 1.0
+
+class Timings:
+    """Phase -> seconds for one request; phases that repeat are summed."""
+    __slots__ = ("phases", "key", "source", "started")
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.key: Optional[str] = None     # single-hash lookups only, for EXPLAIN
+        self.source: Optional[str] = None  # cache / filter / backend
+        self.started = time.perf_counter()
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def header(self, total: float) -> str:
+        parts = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in self.phases.items()]
+        parts.append(f"total;dur={total * 1000:.3f}")
+        return ", ".join(parts)
+
+_current: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar("request_timings",
+                                                                             default=None)
+
+def current() -> Optional[Timings]:
+    return _current.get()
+
+def start() -> contextvars.Token:
+    return _current.set(Timings())
+
+def reset(token: contextvars.Token):
+    _current.reset(token)
+
+class _Phase:
+    __slots__ = ("timings", "name", "t0")
+
+    def __init__(self, timings: Timings, name: str):
+        self.timings, self.name = timings, name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timings.add(self.name, time.perf_counter() - self.t0)
+        return False
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_PHASE = _NoPhase()
+
+def phase(name: str):
+    """Time a block into the current request's Timings (a no-op when timing is off)."""
+    timings = _current.get()
+    return _NO_PHASE if timings is None else _Phase(timings, name)
+
+# =========================
+# RUNTIME SWITCH
+# =========================
+_settings = {"enabled": TIMING_ENABLED, "slow_ms": SLOW_REQUEST_MS, "explain": True}
+_control = {"next_check": 0.0, "mtime": None}
+
+def settings() -> Dict:
+    """Current switch state; the control file is stat'ed at most once a second."""
+    now = time.monotonic()
+    if now < _control["next_check"]:
+        return _settings
+    _control["next_check"] = now + CONTROL_CHECK_INTERVAL
+    try:
+        mtime = os.stat(TIMING_CONTROL_PATH).st_mtime_ns
+    except OSError:
+        mtime = None
+    if mtime != _control["mtime"]:
+        _control["mtime"] = mtime
+        loaded = {"enabled": TIMING_ENABLED, "slow_ms": SLOW_REQUEST_MS, "explain": True}
+        if mtime is not None:
+            try:
+                with open(TIMING_CONTROL_PATH) as fh:
+                    loaded.update(json.load(fh))
+            except (OSError, ValueError) as e:
+                print(f"⚠️ ignoring {TIMING_CONTROL_PATH}: {e}")
+        _settings.update(loaded)
+    return _settings
+
+def write_control(enabled: bool, slow_ms: float, explain: bool):
+    tmp = f"{TIMING_CONTROL_PATH}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump({"enabled": enabled, "slow_ms": slow_ms, "explain": explain}, fh)
+    os.replace(tmp, TIMING_CONTROL_PATH)
+
+# =========================
+# SLOW-REQUEST LOG
+# =========================
+_log_lock = threading.Lock()
+_last_explain = [0.0]
+
+def is_slow(total: float) -> bool:
+    return total * 1000 >= _settings["slow_ms"]
+
+def slow_entry(timings: Timings, total: float, route: str, method: str, status: int) -> Dict:
+    return {
+        "ts": round(time.time(), 3),
+        "route": route,
+        "method": method,
+        "status": status,
+        "total_ms": round(total * 1000, 3),
+        "phases_ms": {k: round(v * 1000, 3) for k, v in timings.phases.items()},
+        "source": timings.source,
+        "prefix": timings.key[:5] if timings.key else None,
+    }
+
+def want_explain(timings: Timings) -> bool:
+    """At most one EXPLAIN per SLOW_EXPLAIN_INTERVAL, and only for backend lookups."""
+    if not (_settings["explain"] and timings.key and timings.source == "backend"):
+        return False
+    now = time.monotonic()
+    with _log_lock:
+        if now - _last_explain[0] < SLOW_EXPLAIN_INTERVAL:
+            return False
+        _last_explain[0] = now
+    return True
+
+def write_slow(entry: Dict, explain=None, key: Optional[str] = None):
+    """Log one slow request; explain(key) adds the lookup plan. Runs off the event loop."""
+    if explain is not None and key is not None:
+        try:
+            entry["explain"] = explain(key)
+        except Exception as e:
+            entry["explain"] = {"error": str(e)}
+    line = json.dumps(entry, separators=(",", ":"))
+    if not SLOW_LOG_PATH:
+        print(f"🐢 slow request {line}")
+        return
+    with _log_lock:
+        with open(SLOW_LOG_PATH, "a") as fh:
+            fh.write(line + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Switch request timing on or off for running servers")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--enable", action="store_true")
+    group.add_argument("--disable", action="store_true")
+    group.add_argument("--status", action="store_true")
+    parser.add_argument("--slow-ms", type=float, help=f"slow-request threshold (default {SLOW_REQUEST_MS:g})")
+    parser.add_argument("--no-explain", action="store_true", help="log slow requests without EXPLAIN")
+    args = parser.parse_args()
+
+    current_settings = dict(settings())
+    if not args.status:
+        slow_ms = args.slow_ms if args.slow_ms is not None else current_settings["slow_ms"]
+        write_control(args.enable, slow_ms, not args.no_explain)
+        _control["next_check"] = 0.0
+        current_settings = dict(settings())
+    state = "on" if current_settings["enabled"] else "off"
+    print(f"⏱️ Request timing is {state} (slow_ms={current_settings['slow_ms']:g}, "
+          f"explain={current_settings['explain']}) via {TIMING_CONTROL_PATH}")
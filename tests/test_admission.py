@@ -0,0 +1,41 @@
+# tests/test_admission.py
+import asyncio
+
+import pytest
+
+from admission import AdaptiveLimiter, Overloaded, cost_for
+
+def test_cost_for_counts_units_of_hashes():
+    assert cost_for(1) == 1
+    assert cost_for(1000) == 10
+
+def test_bulk_slot_holds_its_cost():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=8, min_limit=8, max_limit=8, max_queue=4,
+                                  queue_timeout_ms=20)
+        async with limiter.slot(cost=6):
+            assert limiter.in_flight == 6
+            async with limiter.slot():
+                assert limiter.in_flight == 7
+            with pytest.raises(Overloaded):
+                async with limiter.slot(cost=3):  # does not fit, times out in the queue
+                    pass
+        assert limiter.in_flight == 0
+        async with limiter.slot(cost=100):  # capped at the limit: runs alone
+            assert limiter.in_flight == 8
+        assert limiter.in_flight == 0
+
+    asyncio.run(scenario())
+
+def test_waiting_bulk_admitted_on_release():
+    async def scenario():
+        limiter = AdaptiveLimiter(initial=4, min_limit=4, max_limit=4, max_queue=4,
+                                  queue_timeout_ms=1000)
+        held = await limiter.acquire(cost=3)
+        waiter = asyncio.ensure_future(limiter.acquire(cost=2))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        limiter.release(None, cost=held)
+        assert await waiter == 2 and limiter.in_flight == 2
+
+    asyncio.run(scenario())
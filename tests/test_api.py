@@ -0,0 +1,139 @@
+# tests/test_api.py
+import hashlib
+import json
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+from fastapi.testclient import TestClient
+
+KEY = "testkey123"
+SMALL_BURST_KEY = "smallburst456"
+PASSWORD_SHA1 = hashlib.sha1(b"password").hexdigest().upper()
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """The API on the mmap backend over a small store, with one API key."""
+    import db_loader
+    import main
+    import metrics
+    from mmap_store import build_store
+
+    src = tmp_path / "hashes.txt"
+    src.write_text(f"{PASSWORD_SHA1}:42\n")
+    store = tmp_path / "pwned.store"
+    build_store(str(src), str(store))
+    (tmp_path / "keys.json").write_text(json.dumps({
+        KEY: {"limit": 10 ** 6},
+        SMALL_BURST_KEY: {"limit": 10 ** 6, "burst": 3},
+    }))
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(metrics, "METRICS_DIR", "")
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "mmap")
+    monkeypatch.setattr(db_loader, "HASH_STORE_PATH", str(store))
+    monkeypatch.setattr(db_loader, "_store", None)
+    with TestClient(main.app) as c:
+        yield c
+
+def test_check_found(client):
+    r = client.get(f"/check/{PASSWORD_SHA1}", headers={"x-api-key": KEY})
+    assert r.status_code == 200
+    assert r.json() == {"found": True, "count": 42}
+
+@pytest.mark.parametrize("sha1", ["Z" * 40, "G" + "0" * 39, "0" * 39 + "-"])
+def test_check_rejects_non_hex(client, sha1):
+    r = client.get(f"/check/{sha1}", headers={"x-api-key": KEY})
+    assert r.status_code == 400
+
+def test_batch_above_burst_is_rejected_as_too_large(client):
+    headers = {"x-api-key": SMALL_BURST_KEY, "content-type": "application/json"}
+    for _ in range(2):  # not a 429 to be retried: it could never pass
+        r = client.post("/check/batch", headers=headers, content=json.dumps([PASSWORD_SHA1] * 4))
+        assert r.status_code == 413
+    r = client.post("/check/batch", headers=headers, content=json.dumps([PASSWORD_SHA1] * 2))
+    assert r.status_code == 200
+
+def test_binary_above_burst_is_rejected_as_too_large(client):
+    r = client.post("/check/binary", content=bytes.fromhex(PASSWORD_SHA1) * 4,
+                    headers={"x-api-key": SMALL_BURST_KEY, "content-type": "application/octet-stream"})
+    assert r.status_code == 413
+
+def test_binary_returns_one_packed_count_per_digest_in_order(client):
+    import struct
+    absent = hashlib.sha1(b"not in the store").digest()
+    r = client.post("/check/binary", content=absent + bytes.fromhex(PASSWORD_SHA1) + absent,
+                    headers={"x-api-key": KEY, "content-type": "application/octet-stream"})
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/octet-stream"
+    assert struct.unpack("<3I", r.content) == (0, 42, 0)
+
+@pytest.mark.parametrize("body, headers, status", [
+    (b"\0" * 21, {}, 400),
+    (b"\0" * 20, {"content-type": "application/json"}, 415),
+    (b"\0" * 20, {"accept": "application/json"}, 406),
+    (b"\0" * 20, {"accept": "application/octet-stream;q=0"}, 406),
+    (b"\0" * 20, {"accept": "*/*, application/octet-stream; q=0"}, 406),
+    (b"\0" * 20, {"accept": "application/json, */*;q=0.1"}, 200),
+])
+def test_binary_rejects_malformed_requests(client, body, headers, status):
+    headers = {"x-api-key": KEY, "content-type": "application/octet-stream", **headers}
+    assert client.post("/check/binary", content=body, headers=headers).status_code == status
+
+def test_binary_body_over_the_cap_is_rejected_before_it_is_read(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "MAX_BINARY_BATCH", 2)
+    headers = {"x-api-key": KEY, "content-type": "application/octet-stream"}
+    assert client.post("/check/binary", content=b"\0" * 60, headers=headers).status_code == 413
+    chunked = (b"\0" * 20 for _ in range(3))  # no Content-Length: the streamed read stops at the cap
+    assert client.post("/check/binary", content=chunked, headers=headers).status_code == 413
+    assert client.post("/check/binary", content=b"\0" * 40, headers=headers).status_code == 200
+
+def test_server_timing_header_when_timing_is_enabled(client, tmp_path, monkeypatch):
+    import request_timing
+    monkeypatch.setattr(request_timing, "TIMING_CONTROL_PATH", str(tmp_path / "timing.json"))
+    monkeypatch.setattr(request_timing, "_settings", dict(request_timing._settings))
+    monkeypatch.setattr(request_timing, "_control", {"next_check": 0.0, "mtime": None})
+    request_timing.write_control(True, 10_000, False)
+    r = client.get(f"/check/{PASSWORD_SHA1}", headers={"x-api-key": KEY})
+    phases = [part.split(";")[0] for part in r.headers["server-timing"].split(", ")]
+    assert "auth" in phases and phases[-1] == "total"
+
+def test_readyz_waits_for_required_warm_up_phases(tmp_path, monkeypatch):
+    import threading
+    import main
+    import metrics
+
+    attempts, release = [], threading.Event()
+
+    def flaky_pool():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("database is starting up")
+        release.wait(5)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(metrics, "METRICS_DIR", "")
+    monkeypatch.setattr(main, "WARM_UP_RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(main, "_readiness", {"ready": False, "phase": None, "error": None,
+                                             "phases_s": {}, "time_to_ready_s": None})
+    monkeypatch.setattr(main, "_warm_up_phases", lambda: [
+        ("pool", flaky_pool, True),
+        ("dataset", lambda: {"version": 3, "label": None, "updated_at": None}, True),
+        ("filter", lambda: 1 / 0, False),  # optional: a failure does not block readiness
+    ])
+    with TestClient(main.app) as c:
+        assert c.get("/healthz").status_code == 200  # alive while warming up
+        r = c.get("/readyz")
+        assert r.status_code == 503 and not r.json()["ready"]
+        release.set()
+        for _ in range(200):
+            r = c.get("/readyz")
+            if r.status_code == 200:
+                break
+            time.sleep(0.01)
+    assert r.status_code == 200
+    assert len(attempts) == 2
+    assert set(r.json()["phases_s"]) >= {"startup", "pool", "dataset"}
+    assert "filter" not in r.json()["phases_s"]
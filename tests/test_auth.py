@@ -0,0 +1,24 @@
+# tests/test_auth.py
+import json
+
+import pytest
+
+pytest.importorskip("fastapi")
+import auth
+import manage_api_keys
+
+def test_key_added_by_manage_api_keys_is_labelled_by_its_name(tmp_path, monkeypatch):
+    monkeypatch.setattr(manage_api_keys, "KEYS_PATH", tmp_path / "keys.json")
+    monkeypatch.setattr(auth, "KEYS_PATH", tmp_path / "keys.json")
+    monkeypatch.setattr(auth, "_api_keys", {})
+    manage_api_keys.add_key("billing", limit=100)
+    auth.load_api_keys()
+    (token,) = [k for k, v in json.loads((tmp_path / "keys.json").read_text()).items() if "name" in v]
+    assert auth.key_label(token) == "billing"
+
+def test_older_label_field_still_names_the_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(auth, "KEYS_PATH", tmp_path / "keys.json")
+    monkeypatch.setattr(auth, "_api_keys", {})
+    (tmp_path / "keys.json").write_text(json.dumps({"k1": {"limit": 10, "label": "legacy"}}))
+    auth.load_api_keys()
+    assert auth.key_label("k1") == "legacy"
@@ -0,0 +1,33 @@
+# tests/test_bloom_filter.py
+import hashlib
+
+from bloom_filter import V1_HEADER, V1_MAGIC, BloomFilter, add_to_filter, build_from_digests, store_source
+
+def _sha1(word: str) -> bytes:
+    return hashlib.sha1(word.encode()).digest()
+
+def test_add_to_filter_covers_new_digests_and_restamps(tmp_path):
+    path = str(tmp_path / "pwned.bloom")
+    old = [_sha1(f"old{i}") for i in range(500)]
+    new = [_sha1(f"new{i}") for i in range(50)]
+    build_from_digests(iter(old), len(old) + len(new), path, source=3)
+
+    assert add_to_filter(path, iter(new), source=4) == len(new)
+
+    bloom = BloomFilter(path)
+    assert bloom.source == 4
+    assert bloom.items == len(old) + len(new)
+    assert all(bloom.might_contain(d) for d in old + new)
+
+def test_store_stamp_is_kept_whole_in_the_source_field(tmp_path):
+    path = str(tmp_path / "pwned.bloom")
+    built_at = 1_700_000_000_123_456_789  # nanoseconds: far above u32
+    build_from_digests(iter([_sha1("a")]), 1, path, source=store_source(built_at))
+    assert BloomFilter(path).source == built_at
+
+def test_version_1_files_are_still_read(tmp_path):
+    path = tmp_path / "old.bloom"
+    path.write_bytes(V1_HEADER.pack(V1_MAGIC, 0, 64, 1, 9, 0.01, 0, 0) + bytes(8))
+    bloom = BloomFilter(str(path))
+    assert bloom.source == 9
+    assert not bloom.might_contain(_sha1("a"))
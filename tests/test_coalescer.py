@@ -0,0 +1,50 @@
+# tests/test_coalescer.py
+import asyncio
+
+from coalescer import LookupCoalescer
+
+def test_same_tick_lookups_share_one_fetch_and_get_their_own_results():
+    batches = []
+
+    async def fetch(batch, priority):
+        batches.append((sorted(batch), priority))
+        return {"A": 1, "B": 2}
+
+    async def scenario():
+        coalescer = LookupCoalescer(fetch, window_ms=0)
+        results = await asyncio.gather(coalescer.lookup("A", 2), coalescer.lookup("B", 1),
+                                       coalescer.lookup("A", 2), coalescer.lookup("C", 2))
+        return coalescer, results
+
+    coalescer, results = asyncio.run(scenario())
+    assert results == [1, 2, 1, 0]
+    assert batches == [(["A", "B", "C"], 1)]
+    assert coalescer.shared == 1 and coalescer.batches == 1
+
+def test_full_batch_flushes_without_waiting_for_the_window():
+    batches = []
+
+    async def fetch(batch, priority):
+        batches.append(list(batch))
+        return {}
+
+    async def scenario():
+        coalescer = LookupCoalescer(fetch, window_ms=10_000, max_batch=2)
+        return await asyncio.wait_for(asyncio.gather(coalescer.lookup("A"), coalescer.lookup("B")), 1)
+
+    assert asyncio.run(scenario()) == [0, 0]
+    assert batches == [["A", "B"]]
+
+def test_fetch_error_reaches_every_waiter_and_clears_the_keys():
+    async def fetch(batch, priority):
+        raise RuntimeError("database down")
+
+    async def scenario():
+        coalescer = LookupCoalescer(fetch, window_ms=0)
+        results = await asyncio.gather(coalescer.lookup("A"), coalescer.lookup("B"),
+                                       return_exceptions=True)
+        return coalescer, results
+
+    coalescer, results = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert coalescer.stats()["in_flight"] == 0
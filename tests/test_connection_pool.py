@@ -0,0 +1,62 @@
+# tests/test_connection_pool.py
+import psycopg2
+import pytest
+
+from db_loader import ConnectionPool, PoolTimeout
+
+class FakeConn:
+    def __init__(self, n):
+        self.n = n
+        self.closed = 0
+        self.autocommit = False
+
+    def close(self):
+        self.closed = 1
+
+def make_pool(max_size=1, **kwargs):
+    opened, prepared = [], []
+
+    def connect():
+        opened.append(FakeConn(len(opened)))
+        return opened[-1]
+
+    pool = ConnectionPool(0, max_size, 0.05, connect=connect, on_connect=prepared.append, **kwargs)
+    return pool, opened, prepared
+
+def test_connections_are_opened_once_and_reused():
+    pool, opened, prepared = make_pool()
+    for _ in range(3):
+        with pool.connection() as conn:
+            assert conn.autocommit
+    assert len(opened) == 1 and prepared == opened
+    assert pool.stats()["acquired"] == 3
+
+def test_exhausted_pool_times_out_instead_of_blocking():
+    pool, _, _ = make_pool()
+    held = pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn(timeout=0.01)
+    pool.putconn(held)
+    assert pool.stats()["timeouts"] == 1
+    assert pool.getconn() is held
+
+def test_broken_connection_is_replaced_but_query_errors_keep_it():
+    pool, opened, _ = make_pool()
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        with pool.connection():
+            raise psycopg2.extensions.QueryCanceledError("statement timeout")
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn:
+            conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+    with pool.connection() as conn:
+        assert conn is opened[1]
+    assert pool.stats()["discarded"] == 1
+
+def test_recycle_retires_busy_connections_when_returned():
+    pool, opened, _ = make_pool()
+    busy = pool.getconn()
+    pool.recycle()
+    pool.putconn(busy)
+    assert busy.closed
+    assert pool.getconn() is opened[1]
@@ -0,0 +1,30 @@
+# tests/test_conv.py
+import hashlib
+
+import conv
+
+def _sha1(word: str) -> str:
+    return hashlib.sha1(word.encode()).hexdigest().upper()
+
+def test_reduce_sums_counts_across_chunks_and_sorts(tmp_path):
+    spill = str(tmp_path)
+    conv.hash_chunk(b"alpha\nbeta\nalpha\n", "latin-1", 1, spill)
+    conv.hash_chunk(b"beta\r\nalpha\ngamma", "latin-1", 1, spill)
+    path, unique = conv.reduce_partition(spill, 0, "text")
+    lines = open(path).read().splitlines()
+    assert unique == 3
+    assert lines == sorted(lines)
+    assert dict(line.split(":") for line in lines) == {
+        _sha1("alpha"): "3", _sha1("beta"): "2", _sha1("gamma"): "1"}
+
+def test_convert_writes_sorted_unique_hashes_with_real_counts(tmp_path, monkeypatch):
+    monkeypatch.setattr(conv, "CHUNK_BYTES", 64)  # many chunks, duplicates across them
+    words = [f"pw{i % 40}" for i in range(300)]
+    src, out = tmp_path / "words.txt", tmp_path / "pwned.txt"
+    src.write_text("\n".join(words) + "\n")
+    hashed, unique, _ = conv.convert(str(src), str(out), partitions=4, workers=1)
+    assert (hashed, unique) == (300, 40)
+    lines = out.read_text().splitlines()
+    assert lines == sorted(lines)
+    assert {line.split(":")[0]: int(line.split(":")[1]) for line in lines} == \
+        {_sha1(f"pw{i}"): 300 // 40 + (i < 300 % 40) for i in range(40)}
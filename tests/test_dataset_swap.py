@@ -0,0 +1,47 @@
+# tests/test_dataset_swap.py
+import dataset_swap
+
+class FakeCursor:
+    """Answers rollback()'s checks: hashes_prev exists and carries a label; version 7 serves."""
+
+    def __init__(self):
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        if "obj_description" in sql:
+            self.rows = [("pwned-v7.txt",)]
+        elif "SELECT version" in sql:
+            self.rows = [(7,)]
+        else:
+            self.rows = [(True,)]
+
+    def fetchone(self):
+        return self.rows.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class FakeConn:
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+def test_rollback_rebuilds_filter_and_hot_set_before_swap(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(dataset_swap, "BLOOM_FILTER_PATH", str(tmp_path / "hashes.bloom"))
+    monkeypatch.setattr(dataset_swap, "HOT_SET_PATH", str(tmp_path / "hot.store"))
+    monkeypatch.setattr(dataset_swap, "rebuild_bloom_filter",
+                        lambda conn, table, version: calls.append(("filter", table, version)))
+    monkeypatch.setattr(dataset_swap, "rebuild_hot_set",
+                        lambda conn, table: calls.append(("hot_set", table)))
+    monkeypatch.setattr(dataset_swap, "swap_tables",
+                        lambda conn, renames, label: calls.append(("swap", label)) or 8)
+
+    assert dataset_swap.rollback(FakeConn()) == 8
+    assert calls == [("filter", dataset_swap.PREV_TABLE, 8), ("hot_set", dataset_swap.PREV_TABLE),
+                     ("swap", "rollback: pwned-v7.txt")]
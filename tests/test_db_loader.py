@@ -0,0 +1,162 @@
+# tests/test_db_loader.py
+import asyncio
+import hashlib
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import pytest
+
+import db_loader
+from hot_set import HotSet, write_hot_set
+from mmap_store import build_store
+
+PASSWORD_SHA1 = hashlib.sha1(b"password").hexdigest().upper()
+
+@pytest.fixture
+def mmap_backend(tmp_path, monkeypatch):
+    """db_loader on the mmap backend, with the hash also in the hot set."""
+    src = tmp_path / "hashes.txt"
+    src.write_text(f"{PASSWORD_SHA1}:42\n")
+    store = tmp_path / "pwned.store"
+    build_store(str(src), str(store))
+    hot = tmp_path / "hot.store"
+    write_hot_set([(bytes.fromhex(PASSWORD_SHA1), 42)], str(hot))
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "mmap")
+    monkeypatch.setattr(db_loader, "HASH_STORE_PATH", str(store))
+    monkeypatch.setattr(db_loader, "_store", None)
+    monkeypatch.setattr(db_loader, "_hot_set", HotSet(str(hot)))
+
+@pytest.mark.parametrize("sha1", ["Z" * 40, "G" + "0" * 39, PASSWORD_SHA1.lower(), PASSWORD_SHA1[:-1]])
+def test_malformed_keys_never_reach_a_backend(mmap_backend, sha1):
+    assert db_loader.lookup(sha1) == 0
+    assert asyncio.run(db_loader.lookup_async(sha1)) == 0
+    assert db_loader.lookup_many([sha1, PASSWORD_SHA1]) == {PASSWORD_SHA1: 42}
+
+class FakeRangeConn:
+    """Pooled connection answering the range statement with two rows."""
+
+    def __init__(self):
+        self.rows = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.rows = [(PASSWORD_SHA1, 42), ("5BAA6" + "0" * 35, 7)]
+
+    def fetchall(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class FakePool:
+    def __init__(self):
+        self.out = 0
+
+    @contextmanager
+    def connection(self, timeout=None):
+        self.out += 1
+        try:
+            yield FakeRangeConn()
+        finally:
+            self.out -= 1
+
+    def run(self, fn, timeout=None):
+        with self.connection(timeout) as conn:
+            return fn(conn)
+
+def test_range_query_returns_connection_before_streaming(monkeypatch):
+    pool = FakePool()
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "postgres")
+    monkeypatch.setattr(db_loader, "get_pool", lambda: pool)
+    monkeypatch.setattr(db_loader, "_layout", "text")
+    rows = db_loader.range_query(PASSWORD_SHA1[:5])
+    assert pool.out == 0  # released even if the stream is never started
+    assert list(rows) == [(PASSWORD_SHA1[5:], 42), ("0" * 35, 7)]
+
+def _sha1(word):
+    return hashlib.sha1(word.encode()).hexdigest().upper()
+
+def test_bloom_filter_has_no_false_negatives_after_store_rebuild(tmp_path, monkeypatch):
+    import mmap_store
+    store, bloom = tmp_path / "pwned.store", tmp_path / "pwned.bloom"
+    # rebuilds within one second: built_at must still tell the stores apart
+    clock = iter(range(1_700_000_000 * 10 ** 9, 1_700_000_000 * 10 ** 9 + 100))
+    monkeypatch.setattr(mmap_store, "time", SimpleNamespace(time=time.time, time_ns=lambda: next(clock)))
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "mmap")
+    monkeypatch.setattr(db_loader, "HASH_STORE_PATH", str(store))
+    monkeypatch.setattr(db_loader, "BLOOM_FILTER_PATH", str(bloom))
+    monkeypatch.setattr(db_loader, "_store", None)
+    monkeypatch.setattr(db_loader, "_filter", None)
+    monkeypatch.setattr(db_loader, "_hot_set", None)
+
+    def rebuild(words, filter_path):
+        src = tmp_path / "hashes.txt"
+        src.write_text("".join(f"{_sha1(w)}:{i + 1}\n" for i, w in enumerate(words)))
+        mmap_store.build_store(str(src), str(store), filter_path=filter_path)
+        db_loader.invalidate_caches()
+
+    words = [f"old{i}" for i in range(200)]
+    rebuild(words, str(bloom))
+    assert db_loader._filter is not None
+    words += [f"new{i}" for i in range(200)]
+    rebuild(words, str(bloom))
+    assert db_loader._filter is not None
+    assert all(db_loader.lookup(_sha1(w)) for w in words)
+
+    # a store rebuilt without its filter: the old filter is left unused, not trusted
+    words += [f"newer{i}" for i in range(200)]
+    rebuild(words, "")
+    assert db_loader._filter is None
+    assert all(db_loader.lookup(_sha1(w)) for w in words)
+
+def test_postgres_filter_is_used_only_for_its_dataset_version(tmp_path, monkeypatch):
+    from bloom_filter import build_from_digests
+    bloom = tmp_path / "pwned.bloom"
+    build_from_digests([bytes.fromhex(PASSWORD_SHA1)], 1, str(bloom), source=5)
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "postgres")
+    monkeypatch.setattr(db_loader, "BLOOM_FILTER_PATH", str(bloom))
+    monkeypatch.setattr(db_loader, "_filter", None)
+    assert db_loader.load_filter(version=6) is None  # an import the filter missed
+    assert db_loader.load_filter(version=5).source == 5
+
+def test_coalesced_lookups_pass_admission_once_per_batch(monkeypatch):
+    import admission
+    from coalescer import LookupCoalescer
+
+    limiter = admission.AdaptiveLimiter(initial=8, min_limit=8, max_limit=8)
+    acquired = []
+    acquire = limiter.acquire
+
+    async def counting_acquire(priority=1, cost=1):
+        acquired.append((priority, cost))
+        return await acquire(priority, cost)
+
+    async def run_inline(fn, *args):
+        return fn(*args)
+
+    monkeypatch.setattr(limiter, "acquire", counting_acquire)
+    monkeypatch.setattr(admission, "limiter", limiter)
+    monkeypatch.setattr(db_loader, "LOOKUP_BACKEND", "postgres")
+    monkeypatch.setattr(db_loader, "cache", None)
+    monkeypatch.setattr(db_loader, "_hot_set", None)
+    monkeypatch.setattr(db_loader, "_filter", None)
+    monkeypatch.setattr(db_loader, "_run_backend", run_inline)
+    monkeypatch.setattr(db_loader, "_backend_lookup_many", lambda sha1s: {PASSWORD_SHA1: 42})
+    monkeypatch.setattr(db_loader, "_coalescer", LookupCoalescer(db_loader._coalesced_fetch))
+    monkeypatch.setattr(db_loader, "COALESCE_ENABLED", True)
+
+    async def scenario():
+        keys = [PASSWORD_SHA1] + [_sha1(f"word{i}") for i in range(20)]
+        return await asyncio.gather(*(db_loader.lookup_async(h, priority=2 if i else 0)
+                                      for i, h in enumerate(keys)))
+
+    counts = asyncio.run(scenario())
+    assert counts == [42] + [0] * 20
+    assert acquired == [(0, admission.cost_for(21))]
+    assert limiter.in_flight == 0
@@ -0,0 +1,54 @@
+# tests/test_delta_import.py
+import hashlib
+import io
+
+import pytest
+
+import delta_import
+
+def _release(counts):
+    rows = sorted((hashlib.sha1(str(i).encode()).hexdigest().upper(), c) for i, c in enumerate(counts))
+    return "".join(f"{h}:{c}\n" for h, c in rows).encode()
+
+def _buckets(data):
+    return {prefix: (digest, rows) for prefix, digest, rows, _ in delta_import.iter_buckets(io.BytesIO(data))}
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(delta_import, "CHUNK_BYTES", 300)  # buckets span chunk boundaries
+    monkeypatch.setattr(delta_import, "BUCKET_HEX", 1)
+
+def test_only_the_bucket_of_a_changed_row_gets_a_new_digest():
+    counts = list(range(1, 201))
+    before = _buckets(_release(counts))
+    counts[7] += 1
+    after = _buckets(_release(counts))
+    assert sum(before[p][1] for p in before) == 200
+    changed = [p for p in after if after[p] != before[p]]
+    assert changed == [hashlib.sha1(b"7").hexdigest().upper()[0]]
+
+def test_bucket_parts_are_the_rows_as_copy_payload():
+    data = _release([5, 6, 7])
+    parts = b"".join(b"".join(p) for *_, p in delta_import.iter_buckets(io.BytesIO(data)))
+    assert parts == data.replace(b":", b"\t")
+
+def test_unsorted_input_is_rejected():
+    data = _release(range(1, 51))
+    lines = data.splitlines(keepends=True)
+    with pytest.raises(delta_import.UnsortedInputError):
+        _buckets(b"".join(lines[25:] + lines[:25]))
+
+class ManifestCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+def test_manifest_of_another_dataset_version_is_not_trusted():
+    rows = [("0", b"\x01", 3), ("1", b"\x02", 3)]
+    assert delta_import.load_manifest(ManifestCursor(rows), 3) == {"0": b"\x01", "1": b"\x02"}
+    assert delta_import.load_manifest(ManifestCursor(rows), 4) == {}
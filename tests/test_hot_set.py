@@ -0,0 +1,54 @@
+# tests/test_hot_set.py
+import hashlib
+
+import db_loader
+from hot_set import HotSet, build_from_file, build_from_store, write_hot_set
+from mmap_store import build_store
+
+def _sha1(word: str) -> str:
+    return hashlib.sha1(word.encode()).hexdigest().upper()
+
+def _records(n):
+    return [(bytes.fromhex(_sha1(f"word{i}")), i + 1) for i in range(n)]
+
+def test_write_hot_set_keeps_only_the_highest_counts(tmp_path):
+    path = tmp_path / "hot.store"
+    assert write_hot_set(_records(100), str(path), size=10) == 10
+    hot = HotSet(str(path))
+    assert all(hot.get_hex(_sha1(f"word{i}")) == i + 1 for i in range(90, 100))
+    assert hot.get_hex(_sha1("word89")) == 0
+    assert hot.store.record_count == 10
+
+def test_stats_count_checks_and_hits(tmp_path):
+    path = tmp_path / "hot.store"
+    write_hot_set(_records(20), str(path), size=5)
+    hot = HotSet(str(path))
+    hot.get_hex(_sha1("word19"))
+    hot.get_hex(_sha1("word0"))
+    hot.get_hex(_sha1("absent"))
+    stats = hot.stats()
+    assert (stats["checks"], stats["hits"], stats["coverage"]) == (3, 1, 0.3333)
+
+def test_builders_from_file_and_store_agree(tmp_path):
+    src = tmp_path / "hashes.txt"
+    src.write_text("".join(f"{_sha1(f'word{i}')}:{i + 1}\n" for i in range(50)))
+    store = tmp_path / "pwned.store"
+    build_store(str(src), str(store))
+    from_file, from_store = tmp_path / "a.store", tmp_path / "b.store"
+    assert build_from_file(str(src), str(from_file), size=8) == 8
+    assert build_from_store(str(store), str(from_store), size=8) == 8
+    a, b = HotSet(str(from_file)), HotSet(str(from_store))
+    for i in range(50):
+        assert a.get_hex(_sha1(f"word{i}")) == b.get_hex(_sha1(f"word{i}")) == (i + 1 if i >= 42 else 0)
+
+def test_lookup_answers_from_the_hot_set_before_the_backend(tmp_path, monkeypatch):
+    path = tmp_path / "hot.store"
+    write_hot_set(_records(5), str(path), size=5)
+    monkeypatch.setattr(db_loader, "_hot_set", HotSet(str(path)))
+    monkeypatch.setattr(db_loader, "cache", None)
+    backend = []
+    monkeypatch.setattr(db_loader, "_backend_lookup", lambda h: backend.append(h) or 0)
+    assert db_loader.lookup(_sha1("word3")) == 4
+    assert backend == []
+    assert db_loader.lookup(_sha1("absent")) == 0
+    assert backend == [_sha1("absent")]
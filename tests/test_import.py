@@ -0,0 +1,75 @@
+# tests/test_import.py
+import hashlib
+
+import psycopg2
+import pytest
+
+import hibp_parallel_postgres as hibp
+
+class FailingCopyConn:
+    """Connection whose COPY always fails, as on a full disk."""
+
+    def cursor(self):
+        return self
+
+    def copy_expert(self, sql, buf):
+        raise psycopg2.OperationalError("could not extend file")
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_failing_copy_worker_stops_import_before_publish(tmp_path, monkeypatch):
+    lines = [f"{hashlib.sha1(str(i).encode()).hexdigest().upper()}:{i + 1}" for i in range(500)]
+    src = tmp_path / "pwned.txt"
+    src.write_text("\n".join(lines) + "\n")
+    built = []
+    monkeypatch.setattr(hibp, "CHUNK_BYTES", 256)  # many more chunks than queue slots
+    monkeypatch.setattr(hibp, "NUM_WORKERS", 1)
+    monkeypatch.setattr(hibp, "NUM_COPY_WORKERS", 2)
+    monkeypatch.setattr(hibp, "QUEUE_PUT_TIMEOUT", 0.05)
+    monkeypatch.setattr(hibp, "get_conn", FailingCopyConn)
+    for name in ("create_final_table", "clear_progress", "create_staging_table"):
+        monkeypatch.setattr(hibp, name, lambda *a, **k: None)
+    monkeypatch.setattr(hibp, "detect_layout", lambda cur: "text")
+    monkeypatch.setattr(hibp, "staging_partitions", lambda cur: 0)
+    monkeypatch.setattr(hibp, "build_final_table", lambda *a, **k: built.append("build"))
+    monkeypatch.setattr(hibp, "publish_shadow", lambda *a, **k: built.append("publish"))
+
+    with pytest.raises(psycopg2.OperationalError):
+        hibp.import_staged(str(src))
+    assert built == []
+
+class RecordingConn(FailingCopyConn):
+    """FailingCopyConn that records its SQL and whether it was closed."""
+
+    def __init__(self):
+        self.sql = []
+        self.closed = False
+
+    def execute(self, sql, params=None):
+        self.sql.append(sql)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+def test_failed_batch_drops_its_table_and_closes_its_connection(monkeypatch):
+    from multiprocessing import Value
+
+    conn = RecordingConn()
+    monkeypatch.setattr(hibp, "get_conn", lambda: conn)
+    with pytest.raises(psycopg2.OperationalError):
+        hibp.process_batch([f"{'A' * 40}:1"], 7, Value("q", 0))
+    assert conn.closed
+    assert conn.sql[-1] == "DROP TABLE IF EXISTS pwned_tmp_7;"
@@ -0,0 +1,71 @@
+# tests/test_importer_common.py
+import gzip
+import hashlib
+import lzma
+
+import pytest
+
+from importer_common import iter_chunks, open_input, staging_matches_progress
+
+def _lines(n: int) -> bytes:
+    return b"".join(f"{hashlib.sha1(str(i).encode()).hexdigest().upper()}:{i + 1}\n".encode()
+                    for i in range(n))
+
+@pytest.fixture
+def input_file(tmp_path):
+    path = tmp_path / "pwned.txt"
+    path.write_bytes(_lines(200))
+    return str(path)
+
+def test_resumed_run_skips_committed_chunks_and_reads_the_rest_unchanged(input_file):
+    with open_input(input_file) as fh:
+        full = list(iter_chunks(fh, 500))
+    assert all(data.endswith(b"\n") for _, data in full)
+    # a crash after committing every other chunk
+    committed = {offset: offset + len(data) for offset, data in full[::2]}
+    with open_input(input_file) as fh:
+        resumed = list(iter_chunks(fh, 500, skip=committed))
+    assert resumed == full[1::2]
+
+class CountCursor:
+    def __init__(self, exists: bool, rows: int):
+        self.answers = [(exists,), (rows,)]
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchone(self):
+        return self.answers.pop(0)
+
+def test_progress_is_only_trusted_if_the_staging_rows_add_up():
+    progress = {0: (500, 10), 500: (1000, 12)}
+    assert staging_matches_progress(CountCursor(True, 22), "staging", progress)
+    # crash recovery truncated the UNLOGGED staging table
+    assert not staging_matches_progress(CountCursor(True, 0), "staging", progress)
+    assert not staging_matches_progress(CountCursor(False, 0), "staging", progress)
+    assert staging_matches_progress(CountCursor(False, 0), "staging", {})
+
+@pytest.mark.parametrize("suffix, compress", [
+    (".gz", gzip.compress),
+    (".xz", lzma.compress),
+])
+def test_compressed_input_reads_like_the_plain_file(tmp_path, input_file, suffix, compress):
+    plain = open(input_file, "rb").read()
+    path = tmp_path / f"pwned.txt{suffix}"
+    path.write_bytes(compress(plain))
+    with open_input(str(path)) as fh:
+        assert not fh.seekable()
+        chunks = list(iter_chunks(fh, 500))
+        assert fh.position() == fh.total
+    assert b"".join(data for _, data in chunks) == plain
+    # resuming a compressed import reads past committed chunks instead of seeking
+    with open_input(str(path)) as fh:
+        assert list(iter_chunks(fh, 500, skip={0: len(chunks[0][1])})) == chunks[1:]
+
+def test_truncated_archive_fails_instead_of_ending_early(tmp_path, input_file):
+    data = gzip.compress(open(input_file, "rb").read())
+    path = tmp_path / "pwned.txt.gz"
+    path.write_bytes(data[:len(data) // 2])
+    with pytest.raises(RuntimeError):
+        with open_input(str(path)) as fh:
+            list(iter_chunks(fh, 500))
@@ -0,0 +1,43 @@
+# tests/test_lookup_cache.py
+from types import SimpleNamespace
+
+import lookup_cache
+from lookup_cache import LookupCache
+
+def fake_clock(monkeypatch, start=1000.0):
+    clock = SimpleNamespace(now=start)
+    monkeypatch.setattr(lookup_cache, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+def test_misses_are_cached_apart_from_unknown_keys_with_their_own_ttl(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    cache = LookupCache(max_entries=10, max_bytes=0, ttl=60, negative_ttl=5)
+    cache.put("FOUND", 42)
+    cache.put("MISSING", 0)
+    assert cache.get("UNKNOWN") is None
+    assert cache.get("MISSING") == 0
+    assert cache.negative_hits == 1
+
+    clock.now += 10  # past the negative TTL only
+    assert cache.get("MISSING") is None
+    assert cache.get("FOUND") == 42
+    clock.now += 60
+    assert cache.get("FOUND") is None
+    assert cache.expired == 2
+
+def test_least_recently_used_entry_is_evicted_first(monkeypatch):
+    fake_clock(monkeypatch)
+    cache = LookupCache(max_entries=2, max_bytes=0, ttl=60, negative_ttl=60)
+    cache.put("A", 1)
+    cache.put("B", 2)
+    cache.get("A")
+    cache.put("C", 3)
+    assert cache.get("B") is None
+    assert cache.get("A") == 1 and cache.get("C") == 3
+    assert cache.evictions == 1
+
+def test_zero_negative_ttl_disables_negative_caching(monkeypatch):
+    fake_clock(monkeypatch)
+    cache = LookupCache(max_entries=10, max_bytes=0, ttl=60, negative_ttl=0)
+    cache.put("MISSING", 0)
+    assert cache.get("MISSING") is None
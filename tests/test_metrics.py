@@ -0,0 +1,20 @@
+# tests/test_metrics.py
+import json
+import os
+import subprocess
+import sys
+
+import metrics
+
+def _write(directory, pid, run):
+    with open(os.path.join(directory, f"{pid}.json"), "w") as fh:
+        json.dump({"pid": pid, "run": run, "written": 0, "metrics": {}}, fh)
+
+def test_remove_stale_snapshots_keeps_other_live_servers(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    _write(tmp_path, exited.pid, f"{exited.pid}-1")           # earlier run, gone
+    _write(tmp_path, os.getppid(), metrics._run_id() + "-x")  # another server, worker alive
+    metrics.remove_stale_snapshots()
+    assert sorted(os.listdir(tmp_path)) == [f"{os.getppid()}.json"]
@@ -0,0 +1,103 @@
+# tests/test_migrate_hashes.py
+import re
+
+import psycopg2
+
+import dataset_swap
+import migrate_hashes
+
+class CatalogCursor:
+    """Just enough of pg_class/pg_inherits for migrate(): tables, partitions and renames."""
+
+    def __init__(self, tables):
+        self.tables = tables  # name -> parent (None for a top-level table)
+        self.layouts = {name: "character(40)" for name in tables}
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.rows = []
+        if "format_type" in sql:
+            self.rows = [(self.layouts.get(params[0]),)] if params[0] in self.tables else []
+        elif "pg_inherits" in sql:
+            self.rows = sorted((name,) for name, parent in self.tables.items() if parent == params[0])
+        elif "pg_constraint" in sql:
+            self.rows = [(1,)]
+        elif "RETURNING version" in sql:
+            self.rows = [(8,)]
+        elif "pg_size_pretty" in sql:
+            self.rows = [("1 GB",)]
+        for table in re.findall(r"CREATE TABLE IF NOT EXISTS (\w+) \(", sql):
+            self.tables[table] = None
+            self.layouts[table] = "bytea"
+        for part, parent in re.findall(r"CREATE TABLE IF NOT EXISTS (\w+) PARTITION OF (\w+)", sql):
+            self.tables[part] = parent
+            self.layouts[part] = "bytea"
+        for old, new in re.findall(r"ALTER TABLE (\w+) RENAME TO (\w+);", sql):
+            assert new not in self.tables, f"{new} already exists"
+            self.tables[new] = self.tables.pop(old)
+            self.layouts[new] = self.layouts.pop(old)
+            for name, parent in self.tables.items():
+                if parent == old:
+                    self.tables[name] = new
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+class FakeConn:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+def test_migrate_keeps_partitions_and_renames_them_out_of_the_way():
+    tables = {"hashes": None}
+    tables.update({f"hashes_p{i:x}": "hashes" for i in range(16)})
+    cur = CatalogCursor(tables)
+
+    migrate_hashes.migrate(FakeConn(cur))
+
+    assert cur.layouts["hashes"] == "bytea"
+    assert sorted(n for n, p in cur.tables.items() if p == "hashes") == [f"hashes_p{i:x}" for i in range(16)]
+    assert sorted(n for n, p in cur.tables.items() if p == migrate_hashes.OLD_TABLE) == \
+        [f"{migrate_hashes.OLD_TABLE}_p{i:x}" for i in range(16)]
+    assert migrate_hashes.NEW_TABLE not in cur.tables
+
+class LockTimeout(psycopg2.OperationalError):
+    pgcode = "55P03"
+
+def test_migrate_retries_the_swap_when_hashes_is_busy(monkeypatch):
+    cur = CatalogCursor({"hashes": None})
+    execute, locks = cur.execute, []
+
+    def busy_once(sql, params=None):
+        if sql.startswith("LOCK TABLE"):
+            locks.append(sql)
+            if len(locks) == 1:
+                raise LockTimeout("canceling statement due to lock timeout")
+        return execute(sql, params)
+
+    monkeypatch.setattr(cur, "execute", busy_once)
+    monkeypatch.setattr(dataset_swap.time, "sleep", lambda seconds: None)
+
+    migrate_hashes.migrate(FakeConn(cur))
+
+    assert len(locks) == 2
+    assert cur.layouts["hashes"] == "bytea"
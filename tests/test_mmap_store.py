@@ -0,0 +1,42 @@
+# tests/test_mmap_store.py
+import hashlib
+
+import pytest
+
+from mmap_store import HashStore, build_store, read_store_version
+
+def _sha1(word: str) -> str:
+    return hashlib.sha1(word.encode()).hexdigest().upper()
+
+@pytest.fixture
+def store(tmp_path):
+    """A store built from unsorted input with a duplicate, through several sorted runs."""
+    words = [f"word{i}" for i in range(300)]
+    lines = [f"{_sha1(w)}:{i + 1}" for i, w in enumerate(words)]
+    lines += [f"{_sha1('word0')}:500", "not a hash line", f"{'G' * 40}:1"]
+    src = tmp_path / "hashes.txt"
+    src.write_text("\n".join(reversed(lines)) + "\n")
+    path = tmp_path / "pwned.store"
+    assert build_store(str(src), str(path), run_records=64) == len(words)
+    return HashStore(str(path)), words
+
+def test_lookup_finds_every_record_and_keeps_the_highest_duplicate(store):
+    hs, words = store
+    assert hs.lookup_hex(_sha1("word0")) == 500
+    assert all(hs.lookup_hex(_sha1(w)) == i + 1 for i, w in enumerate(words) if i)
+    assert hs.lookup_hex(_sha1("absent")) == 0
+    assert hs.lookup_many_hex([_sha1("word7"), _sha1("absent")]) == {_sha1("word7"): 8}
+
+def test_iter_prefix_yields_exactly_the_matching_records_in_order(store):
+    hs, words = store
+    prefix = _sha1("word42")[:2]
+    expected = sorted(h for h in map(_sha1, words) if h.startswith(prefix))
+    rows = list(hs.iter_prefix(prefix))
+    assert [h for h, _ in rows] == expected
+    absent = next(p for p in ("00000", "FFFFF", "ABCDE") if not any(h.startswith(p) for h in map(_sha1, words)))
+    assert list(hs.iter_prefix(absent)) == []
+
+def test_store_version_is_its_built_at_stamp(store, tmp_path):
+    hs, _ = store
+    assert read_store_version(hs.path) == hs.built_at > 0
+    assert read_store_version(str(tmp_path / "missing.store")) == 0
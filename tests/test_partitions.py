@@ -0,0 +1,39 @@
+# tests/test_partitions.py
+import hashlib
+import re
+
+import pytest
+
+from db_loader import partition_name, partition_prefixes, partitions_ddl
+
+BOUND_RE = re.compile(r"CREATE TABLE IF NOT EXISTS (\w+) PARTITION OF hashes "
+                      r"FOR VALUES FROM \((MINVALUE|'[^']*')\) TO \((MAXVALUE|'[^']*')\);")
+
+def _key(layout, literal):
+    if literal in ("MINVALUE", "MAXVALUE"):
+        return literal
+    value = literal.strip("'")
+    return bytes.fromhex(value[2:]) if layout == "compact" else value
+
+def _route(bounds, key):
+    for name, lo, hi in bounds:
+        if (lo == "MINVALUE" or key >= lo) and (hi == "MAXVALUE" or key < hi):
+            return name
+    return None
+
+@pytest.mark.parametrize("layout", ["text", "compact"])
+@pytest.mark.parametrize("partitions", [16, 256])
+def test_partitions_cover_every_key_by_its_leading_hex_digits(layout, partitions):
+    bounds = [(name, _key(layout, lo), _key(layout, hi))
+              for name, lo, hi in BOUND_RE.findall(partitions_ddl(layout, "hashes", partitions))]
+    assert len(bounds) == partitions
+    # contiguous: each partition starts where the previous one ends
+    assert all(bounds[i][2] == bounds[i + 1][1] for i in range(partitions - 1))
+    digits = len(partition_prefixes(partitions)[0])
+    for i in range(500):
+        sha1 = hashlib.sha1(str(i).encode()).hexdigest().upper()
+        key = bytes.fromhex(sha1) if layout == "compact" else sha1
+        assert _route(bounds, key) == partition_name("hashes", sha1[:digits])
+    for sha1 in ("0" * 40, "F" * 40):
+        key = bytes.fromhex(sha1) if layout == "compact" else sha1
+        assert _route(bounds, key) == partition_name("hashes", sha1[:digits])
@@ -0,0 +1,13 @@
+# tests/test_ratelimit.py
+from ratelimit import ALLOWED, DENIED, TOO_LARGE, SharedRateLimiter
+
+def test_cost_above_burst_is_too_large_not_denied():
+    limiter = SharedRateLimiter(shared=False)
+    assert limiter.acquire("k", limit=10 ** 6, burst=3, cost=4) == TOO_LARGE
+    assert limiter.stats()["too_large"] == 1
+    assert limiter.stats()["denied"] == 0
+
+def test_cost_equal_to_burst_passes_on_an_idle_key():
+    limiter = SharedRateLimiter(shared=False)
+    assert limiter.acquire("k", limit=60, burst=3, cost=3) == ALLOWED
+    assert limiter.acquire("k", limit=60, burst=3, cost=1) == DENIED
@@ -0,0 +1,71 @@
+# tests/test_read_router.py
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+
+from read_router import ReadRouter
+
+class FakePool:
+    """One endpoint's pool; its connections just name the endpoint."""
+
+    def __init__(self, name):
+        self.name = name
+        self.discarded = 0
+
+    def getconn(self, timeout=None):
+        return SimpleNamespace(endpoint=self.name, closed=0)
+
+    def putconn(self, conn, discard=False):
+        self.discarded += discard
+
+    def recycle(self):
+        pass
+
+def make_router():
+    names = iter(["replica1:5432", "replica2:5432", "primary:5432"])
+    return ReadRouter([("replica1", "5432"), ("replica2", "5432")], ("primary", "5432"),
+                      lambda connect, min_size: FakePool(next(names)), None, 0)
+
+def test_run_retries_once_on_another_endpoint():
+    router = make_router()
+    used = []
+
+    def query(conn):
+        used.append(conn.endpoint)
+        if len(used) == 1:
+            conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        return 42
+
+    assert router.run(query) == 42
+    assert len(used) == 2 and used[0] != used[1]
+    failed = next(ep for ep in router.endpoints if ep.name == used[0])
+    assert failed.pool.discarded == 1 and failed.failures == 1
+
+def test_run_gives_up_after_one_retry():
+    router = make_router()
+    used = []
+
+    def query(conn):
+        used.append(conn.endpoint)
+        conn.closed = 2
+        raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+    with pytest.raises(psycopg2.OperationalError):
+        router.run(query)
+    assert len(used) == 2
+
+def test_query_errors_on_a_live_connection_are_not_retried_or_counted():
+    router = make_router()
+    used = []
+
+    def query(conn):
+        used.append(conn.endpoint)
+        raise psycopg2.extensions.QueryCanceledError("canceling statement due to statement timeout")
+
+    with pytest.raises(psycopg2.extensions.QueryCanceledError):
+        router.run(query)
+    assert len(used) == 1
+    ep = next(ep for ep in router.endpoints if ep.name == used[0])
+    assert ep.pool.discarded == 0 and ep.failures == 0
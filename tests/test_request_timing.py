@@ -0,0 +1,44 @@
+# tests/test_request_timing.py
+import json
+
+import request_timing
+
+SHA1 = "5BAA61E4C9B93F3F0682250B6CF8331B7EE68FD8"
+
+def test_phases_are_summed_into_the_server_timing_header():
+    token = request_timing.start()
+    try:
+        timings = request_timing.current()
+        timings.add("db_query", 0.001)
+        timings.add("db_query", 0.002)
+        assert timings.header(0.004) == "db_query;dur=3.000, total;dur=4.000"
+    finally:
+        request_timing.reset(token)
+
+def test_phase_is_a_no_op_outside_a_timed_request():
+    with request_timing.phase("auth"):
+        pass
+    assert request_timing.current() is None
+
+def test_slow_log_carries_phases_and_prefix_but_never_the_hash(tmp_path, monkeypatch):
+    log = tmp_path / "slow.log"
+    monkeypatch.setattr(request_timing, "SLOW_LOG_PATH", str(log))
+    timings = request_timing.Timings()
+    timings.key, timings.source = SHA1, "backend"
+    timings.add("db_query", 0.3)
+    entry = request_timing.slow_entry(timings, 0.4, "/check/{sha1}", "GET", 200)
+    request_timing.write_slow(entry, explain=lambda key: {"plan": "Index Scan"}, key=SHA1)
+    line = log.read_text()
+    assert SHA1 not in line
+    logged = json.loads(line)
+    assert logged["prefix"] == SHA1[:5]
+    assert logged["phases_ms"] == {"db_query": 300.0}
+    assert logged["explain"] == {"plan": "Index Scan"}
+
+def test_control_file_switches_timing_at_runtime(tmp_path, monkeypatch):
+    monkeypatch.setattr(request_timing, "TIMING_CONTROL_PATH", str(tmp_path / "timing.json"))
+    monkeypatch.setattr(request_timing, "_settings", dict(request_timing._settings))
+    monkeypatch.setattr(request_timing, "_control", {"next_check": 0.0, "mtime": None})
+    request_timing.write_control(True, 100, False)
+    assert request_timing.settings()["enabled"]
+    assert request_timing.is_slow(0.2) and not request_timing.is_slow(0.05)